@@ -0,0 +1,207 @@
+"""
+This program times and memory-profiles each stage of the proxy building code sequence on synthetic application
+data drawn by create_test_data.py (or on an existing application data file), and writes the results as JSON so that
+runs can be compared over time.
+
+Each stage is run once.  seconds is wall-clock time; peak_mb is the peak of memory allocated during the stage as
+traced by tracemalloc (which slows down stages that run Python code per record; --no-memory turns it off).
+
+Input arguments:
+
+censusdir - directory containing prepared input census geography and surname data
+--n - number of synthetic applications to draw (default 100000)
+--readfile - application data file to use instead of synthetic data, with the columns of create_test_data.py
+--indir, --app-c, --seed, --coapp-rate, --hyphen-rate - passed to create_test_data.py
+--geo-switch - geographies to build proxies for (default blkgrp tract zip)
+--procs - numbers of worker processes to run parallel_proxy.py with, e.g. --procs 1 2 4 8, to measure how its
+    throughput scales (peak_mb covers the parent process only)
+--out - JSON results file (default benchmark_<n>.json)
+
+Usage:
+
+python benchmark.py ../input_files/created_python --n 1000000 --out benchmark_1m.json
+"""
+
+import os
+import sys
+import json
+import logging
+import shutil
+import tempfile
+import time
+import platform
+import argparse
+import tracemalloc
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+import storage
+import create_test_data
+import surname_creation_lower
+import surname_parser
+import geo_name_merger_all_entities_over_18
+import combine_probs
+import parallel_proxy
+
+
+surname_census_match = {'blkgrp': ['GEOID10_BlkGrp'], 'tract': ['GEOID10_Tract'], 'zip': ['zip_sample']}
+
+
+class Benchmark(object):
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.stages = []
+
+    def stage(self, name, func, *args, **kwargs):
+        # A stage that fails is recorded with its error; the run goes on with fallback if one is given.
+        fallback = kwargs.pop('fallback', None)
+        result = {'stage': name}
+        if self.memory:
+            tracemalloc.start()
+        start = time.time()
+        try:
+            output = func(*args, **kwargs)
+        except Exception as e:
+            output = None
+            result['error'] = repr(e)
+        result['seconds'] = time.time() - start
+        if self.memory:
+            result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2.0 ** 20
+            tracemalloc.stop()
+
+        if isinstance(output, pd.DataFrame):
+            result['rows'] = output.shape[0]
+            result['rows_per_second'] = output.shape[0] / result['seconds'] if result['seconds'] else None
+            result['output_mb'] = output.memory_usage(deep=True).sum() / 2.0 ** 20
+
+        self.stages.append(result)
+        print("{:<45} {:>9.3f}s{}".format(name, result['seconds'], "  ERROR: " + result['error'] if 'error' in result else ""))
+
+        if 'error' in result:
+            if fallback is None:
+                raise RuntimeError("Stage {} failed: {}".format(name, result['error']))
+            return fallback
+        return output
+
+
+def combine(df, geoprecvar):
+    pr_precision = combine_probs.create_pr_precision(df, geoprecvar)
+    df = combine_probs.select_final_probs(df, pr_precision)
+    combine_probs.check_final_probs(df, pr_precision)
+    return df
+
+
+def run(bench, sample, censusdir, geo_switch):
+    g = geo_name_merger_all_entities_over_18
+
+    input_df = sample.reset_index()
+    matchvars = ['index']
+
+    census_index = bench.stage('load_surname_index', surname_creation_lower.load_surname_index, censusdir)
+    census_dfs = bench.stage('load_census_files', g.load_census_files, censusdir, geo_switch)
+
+    coapp_df = surname_parser.create_record_for_coapps(input_df, 'name2', matchvars=matchvars)
+    app_df = surname_parser.drop_apps_without_lname(input_df, 'name1', matchvars=matchvars)
+    combined_data = pd.concat([app_df, coapp_df])
+
+    # Cleaning every applicant and coapplicant record; the pipeline itself cleans each distinct surname once.
+    bench.stage('clean_last_names', surname_parser.clean_last_names, pd.DataFrame({'lname': combined_data['lname'].values}))
+    race_probs = bench.stage('create_race_probs_by_unique_name', surname_parser.create_race_probs_by_unique_name,
+                             combined_data, census_index, matchvars=matchvars)
+    reshaped = bench.stage('create_reshaped_race_probs_by_app', surname_parser.create_reshaped_race_probs_by_app, race_probs, matchvars=matchvars)
+    tagged = bench.stage('create_name_match_variables', surname_parser.create_name_match_variables, reshaped)
+    surname_probs = bench.stage('populate_final_surname_probs', surname_parser.populate_final_surname_probs, tagged)
+
+    merged = g.rename_post_pr_vars(input_df.merge(surname_probs, how='left', on=matchvars))
+
+    # The steps of create_BISG_by_geo, timed one by one.
+    name_vars = [var for var in list(merged) if var.startswith('name_pr_')]
+    geo_blocks = []
+    for geo_type in geo_switch:
+        census_df = census_dfs[geo_type]
+        geo_vars = [var for var in list(census_df) if var.startswith('geo_pr_') or var.startswith('here_given_')]
+
+        rows = bench.stage('lookup_geo_rows_' + geo_type, g.lookup_geo_rows, census_df, merged[surname_census_match[geo_type][0]])
+        combined = bench.stage('gather_geo_vars_' + geo_type, g.gather_geo_vars, census_df, geo_vars, rows)
+        for var in name_vars:
+            combined[var] = merged[var].values
+
+        bisg = bench.stage('create_BISG_' + geo_type, g.create_BISG, combined)
+        bisg = bench.stage('check_BISG_' + geo_type, g.check_BISG, bisg, fallback=bisg)
+
+        out_vars = [var for var in list(bisg) if var.startswith('pr_') or var.startswith('geo_pr_')] + ['prtotal']
+        geo_blocks.append(bisg[out_vars].rename(columns={var: geo_type + '18_' + var for var in out_vars}))
+
+    wide = pd.concat([merged] + geo_blocks, axis=1)
+    bench.stage('combine_probs', combine, wide, 'geo_code_precision')
+
+
+def run_parallel(bench, sample, censusdir, geo_switch, procs):
+    # The sample is written once; each worker count reads it back from the file, as parallel_proxy.py does.
+    workdir = tempfile.mkdtemp()
+    try:
+        storage.write_table(sample.reset_index(drop=True), os.path.join(workdir, 'sample.parquet'))
+        for processes in procs:
+            bench.stage('parallel_proxy_{}procs'.format(processes), parallel_proxy.create, 'name1', 'name2', workdir, workdir,
+                        'sample.parquet', censusdir, geo_switch, surname_census_match, processes=processes)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def environment():
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': multiprocessing.cpu_count()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the BISG proxy building code sequence.")
+    parser.add_argument('censusdir')
+    parser.add_argument('--n', type=int, default=100000)
+    parser.add_argument('--readfile')
+    parser.add_argument('--indir', default='../input_files')
+    parser.add_argument('--app-c', default='../input_files/app_c.csv')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--coapp-rate', type=float, default=0.25)
+    parser.add_argument('--hyphen-rate', type=float, default=0.02)
+    parser.add_argument('--geo-switch', nargs='+', default=['blkgrp', 'tract', 'zip'])
+    parser.add_argument('--procs', nargs='+', type=int, default=[])
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--out')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    bench = Benchmark(memory=not args.no_memory)
+    if args.readfile:
+        sample = bench.stage('read_sample', storage.read_table, args.readfile)
+    else:
+        sample = bench.stage('create_sample', create_test_data.create_sample, args.n, indir=args.indir, app_c_file=args.app_c,
+                             random_seed=args.seed, coapp_rate=args.coapp_rate, hyphen_rate=args.hyphen_rate)
+
+    start = time.time()
+    run(bench, sample, args.censusdir, args.geo_switch)
+    if args.procs:
+        run_parallel(bench, sample, args.censusdir, args.geo_switch, args.procs)
+
+    report = {'records': sample.shape[0],
+              'parameters': {'readfile': args.readfile, 'seed': args.seed, 'coapp_rate': args.coapp_rate,
+                             'hyphen_rate': args.hyphen_rate, 'geo_switch': args.geo_switch, 'procs': args.procs, 'memory': not args.no_memory},
+              'command': ' '.join(sys.argv),
+              'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start)),
+              'total_seconds': time.time() - start,
+              'environment': environment(),
+              'stages': bench.stages}
+
+    out = args.out or 'benchmark_{}.json'.format(sample.shape[0])
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Wrote benchmark results to {}".format(out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+This script runs the quality checks on BISG output used by check_BISG in geo_name_merger_all_entities_over_18.py.
+
+For each family of race probabilities (name_pr_*, geo_pr_*, and pr_*) found in the data, every probability must be
+missing or between 0 and 1, and the probabilities of a record must sum to 0 or to between 0.99 and 1.01.  Each
+family is checked in one pass over its block of six columns, every check is run even when an earlier one fails,
+and the result is a report with the number of records failing each check and a few of their row labels.
+
+For very large outputs, sample_size checks a random sample of that many records instead of all of them.
+"""
+
+import logging
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+race_list = ['white', 'black', 'aian', 'api', 'mult_other', 'hispanic']
+families = ['name_pr_', 'geo_pr_', 'pr_']
+sum_range = (0.99, 1.01)
+
+
+def check_family(values, row_ids, family, sample_rows=5):
+    # values is the N x 6 block of a family; NaN compares False, so missing values pass the range check.
+    missing = np.isnan(values)
+    out_of_range = ((values < 0.0) | (values > 1.0)).any(axis=1)
+    row_sum = np.sum(values, axis=1, where=~missing)
+    bad_sum = (row_sum != 0) & ((row_sum < sum_range[0]) | (row_sum > sum_range[1]))
+
+    return [{'family': family, 'check': check, 'violations': int(failed.sum()),
+             'sample_rows': row_ids[failed][:sample_rows].tolist()}
+            for check, failed in [('range', out_of_range), ('sum', bad_sum)]]
+
+
+def check(df, sample_size=None, random_seed=0, sample_rows=5):
+    rows = np.arange(df.shape[0])
+    if sample_size is not None and sample_size < df.shape[0]:
+        rows = np.sort(np.random.RandomState(random_seed).choice(df.shape[0], sample_size, replace=False))
+
+    row_ids = np.asarray(df.index)[rows]
+    report = {'records': df.shape[0], 'records_checked': rows.shape[0], 'sampled': rows.shape[0] < df.shape[0], 'checks': []}
+    for family in families:
+        cols = [family + race for race in race_list]
+        if all(col in df.columns for col in cols):
+            block = df.iloc[rows, df.columns.get_indexer(cols)] if report['sampled'] else df[cols]
+            values = block.to_numpy(dtype=np.float64)
+            report['checks'].extend(check_family(values, row_ids, family, sample_rows=sample_rows))
+
+    report['passed'] = all(result['violations'] == 0 for result in report['checks'])
+    return report
+
+
+def print_report(report):
+    logger.info("Checked {:,} of {:,} records{}.".format(report['records_checked'], report['records'], " (sampled)" if report['sampled'] else ""))
+    for result in report['checks']:
+        logger.info("---{}* {}: {:,} violations{}".format(result['family'], result['check'], result['violations'],
+                                                         " (e.g. rows {})".format(result['sample_rows']) if result['violations'] else ""))
@@ -0,0 +1,181 @@
+"""
+This script scores single applications or small batches without going through the file-based pipeline.
+A BISGScorer loads the census surname index and the block group, tract, and ZIP code tables once into
+NumPy arrays and then returns the final BISG probabilities for an application from its applicant surname,
+coapplicant surname, geography, and geocode precision.
+
+The surname cleaning and name-match rules are those of surname_parser.py, the BISG computation is that of
+create_BISG in geo_name_merger_all_entities_over_18.py, and the choice between block group, tract, and ZIP code
+is that of combine_probs.py.
+
+A geography is given either as a dict keyed by blkgrp, tract, and zip, or as a single GEOID string: a 12-digit
+block group GEOID also gives its tract (the first 11 digits), an 11-digit GEOID is a tract, and a 5-digit code is a ZCTA.
+
+The steps report their progress through logging at INFO level, which is shown only if the caller configures logging
+to show it.
+"""
+
+import numpy as np
+import pandas as pd
+
+import surname_creation_lower
+import surname_parser
+import geo_name_merger_all_entities_over_18
+import combine_probs
+
+
+race_list = ['white', 'black', 'aian', 'api', 'mult_other', 'hispanic']
+
+prefix_geo = {'blkgrp18_': 'blkgrp', 'tract18_': 'tract', 'zip18_': 'zip'}
+
+# Columns of the surname index in race_list order.
+name_cols = [surname_creation_lower.class_vars.index(var) for var in ['pctwhite', 'pctblack', 'pctaian', 'pctapi', 'pct2prace', 'pcthispanic']]
+
+
+def split_geoid(geoid):
+    if isinstance(geoid, dict):
+        return geoid
+    if not isinstance(geoid, str):
+        return {}
+    if len(geoid) == 12:
+        return {'blkgrp': geoid, 'tract': geoid[:11]}
+    if len(geoid) == 11:
+        return {'tract': geoid}
+    if len(geoid) == 5:
+        return {'zip': geoid}
+    return {}
+
+
+def select_name_probs(probs, names):
+    # probs and names are lists of the a1, a2, c1, c2 name probabilities and names (probs[i] is None if names[i] did not match).
+    # A name that repeats an earlier name on the application adds no information and is not used.
+    a1, a2, c1, c2 = names
+    matched = [p is not None for p in probs]
+    if c2 is not None and c2 in (a1, a2, c1):
+        matched[3] = False
+    if c1 is not None and c1 in (a1, a2):
+        matched[2] = False
+    if a2 is not None and a2 == a1:
+        matched[1] = False
+
+    for p, m in zip(probs, matched):
+        if m:
+            return p
+    return None
+
+
+def compute_BISG(name_pr, here_given):
+    return geo_name_merger_all_entities_over_18.BISG_kernel(name_pr, here_given)[0]
+
+
+class BISGScorer(object):
+
+    def __init__(self, censusdir, geo_switch=['blkgrp', 'tract', 'zip'], vintage='dec10'):
+        self.surname_index = surname_creation_lower.load_surname_index(censusdir)
+        self.index_names = np.asarray(self.surname_index[0])
+        self.index_probs = np.asarray(self.surname_index[1])[:, name_cols]
+
+        self.geo_index = {}
+        self.geo_rows = {}
+        self.here_given = {}
+        for geo_type in geo_switch:
+            census_df = geo_name_merger_all_entities_over_18.load_census_file(censusdir, geo_switch=geo_type, geo_ind_name='GeoInd', vintage=vintage)
+            self.geo_index[geo_type] = pd.Index(census_df['GeoInd'].values)
+            self.geo_rows[geo_type] = dict(zip(census_df['GeoInd'].values, range(census_df.shape[0])))
+            self.here_given[geo_type] = np.ascontiguousarray(census_df[['here_given_' + race for race in race_list]].values, dtype=np.float64)
+
+    def lookup_name(self, name):
+        if name is None:
+            return None
+        pos = np.searchsorted(self.index_names, name)
+        if pos < self.index_names.shape[0] and self.index_names[pos] == name:
+            return self.index_probs[pos]
+        return None
+
+    def clean_names(self, surname):
+        if not isinstance(surname, str):
+            return None, None
+        lname1, lname2 = surname_parser.split_hyphenated_lname(surname_parser.clean_lname(surname))
+        return lname1, lname2 if isinstance(lname2, str) else None
+
+    def geo_BISG(self, name_pr, geo_type, key):
+        # The BISG probabilities for one geography, or None if the geography is unknown or gives nothing to normalize by.
+        row = self.geo_rows.get(geo_type, {}).get(key)
+        if name_pr is None or row is None:
+            return None
+        u = name_pr * self.here_given[geo_type][row]
+        u_sum = np.nansum(u)
+        return u / u_sum if u_sum > 0 else None
+
+    def score(self, surname, coapp_surname, geoid, precision):
+        # Applications without an applicant surname get no surname probability, as in surname_parser.parse.
+        names = list(self.clean_names(surname)) + list(self.clean_names(coapp_surname)) if isinstance(surname, str) else [None] * 4
+        name_pr = select_name_probs([self.lookup_name(name) for name in names], names)
+
+        # Try the combine_probs rules in order and stop at the first geography with a BISG proxy.
+        geoid = split_geoid(geoid)
+        pr_precision, pr = 1, None
+        for code, geoprec_values, prefix in combine_probs.precision_rules:
+            if precision in geoprec_values:
+                pr = self.geo_BISG(name_pr, prefix_geo[prefix], geoid.get(prefix_geo[prefix]))
+                if pr is not None:
+                    pr_precision = code
+                    break
+
+        output = {'pr_' + race: pr[i] if pr is not None else np.nan for i, race in enumerate(race_list)}
+        output['pr_precision'] = pr_precision
+        return output
+
+    def name_probs_batch(self, surnames, coapp_surnames):
+        surnames = pd.Series(surnames).reset_index(drop=True)
+        coapp_surnames = pd.Series(coapp_surnames).reset_index(drop=True)
+
+        names = {}
+        probs = {}
+        for k, values in [('a', surnames), ('c', coapp_surnames)]:
+            present = values.notnull().values & surnames.notnull().values
+            cleaned = np.full(values.shape[0], None, dtype=object)
+            cleaned[present] = surname_parser.clean_lnames(values[present].values)
+            split = [surname_parser.split_hyphenated_lname(x) if x is not None else (None, None) for x in cleaned]
+            for i in [0, 1]:
+                names[k + str(i + 1)] = pd.Series([x[i] if isinstance(x[i], str) else None for x in split], dtype=object)
+                probs[k + str(i + 1)] = surname_creation_lower.lookup_surname_index(self.surname_index, names[k + str(i + 1)].values)[:, name_cols]
+
+        matched = {k: ~np.isnan(probs[k][:, 0]) for k in probs}
+        matched['c2'] &= ~(names['c2'].eq(names['a1']) | names['c2'].eq(names['a2']) | names['c2'].eq(names['c1'])).values
+        matched['c1'] &= ~(names['c1'].eq(names['a1']) | names['c1'].eq(names['a2'])).values
+        matched['a2'] &= ~names['a2'].eq(names['a1']).values
+
+        name_pr = np.full((surnames.shape[0], len(race_list)), np.nan)
+        for k in ['c2', 'c1', 'a2', 'a1']:
+            name_pr[matched[k]] = probs[k][matched[k]]
+        return name_pr
+
+    def score_batch(self, surnames, coapp_surnames, geoids, precisions):
+        # geoids is either a dict of key sequences by geography or a sequence of anything split_geoid accepts.
+        name_pr = self.name_probs_batch(surnames, coapp_surnames)
+        n = name_pr.shape[0]
+
+        if not isinstance(geoids, dict):
+            split = [split_geoid(geoid) for geoid in geoids]
+            geoids = {geo_type: [geoid.get(geo_type) for geoid in split] for geo_type in ['blkgrp', 'tract', 'zip']}
+
+        prs = {}
+        available = {}
+        for geo_type in ['blkgrp', 'tract', 'zip']:
+            here_given = np.full((n, len(race_list)), np.nan)
+            if geo_type in self.geo_index and geoids.get(geo_type) is not None:
+                rows = self.geo_index[geo_type].get_indexer(pd.Index(geoids[geo_type], dtype=object))
+                here_given[rows >= 0] = self.here_given[geo_type][rows[rows >= 0]]
+            prs[geo_type] = compute_BISG(name_pr, here_given)
+            available[geo_type + '18_'] = np.nansum(prs[geo_type], axis=1) > 0
+
+        pr_precision = combine_probs.assign_pr_precision(precisions, available)
+
+        pr = np.full((n, len(race_list)), np.nan)
+        for code, source in combine_probs.precision_sources.items():
+            pr[pr_precision == code] = prs[prefix_geo[source]][pr_precision == code]
+
+        output = pd.DataFrame(pr, columns=['pr_' + race for race in race_list])
+        output['pr_precision'] = pr_precision
+        return output
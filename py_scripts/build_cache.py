@@ -0,0 +1,141 @@
+"""
+This script decides when a prepared census table has to be rebuilt.  Each table is stored next to a small
+.cache.json manifest holding a key made from the contents of its source files, the code that builds it, and the
+parameters it was built with, so a table is rebuilt only when one of those changes.  Tables and manifests are written
+to a temporary file and then renamed into place, and a lock file keeps concurrent jobs on a shared filesystem from
+building the same table at once.  The .npy index files memory-mapped in place of some tables have a manifest holding
+the key of the table they were made from.
+"""
+
+import os
+import logging
+import json
+import time
+import uuid
+import hashlib
+import contextlib
+import numpy as np
+
+import storage
+
+
+logger = logging.getLogger(__name__)
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(source_files, code_file, params={}):
+    key = {'sources': [file_digest(path) for path in source_files],
+           'code': file_digest(code_file),
+           'params': params}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def manifest_file(path):
+    return os.path.splitext(path)[0] + '.cache.json'
+
+
+def is_current(path, key):
+    try:
+        with open(manifest_file(path)) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return False
+    return manifest.get('key') == key and os.path.isfile(path)
+
+
+def temp_file(path):
+    # Same directory and extension as path, so the rename is atomic and the format is unchanged.
+    stem, ext = os.path.splitext(path)
+    return '{}.tmp{}{}'.format(stem, os.getpid(), ext)
+
+
+def replace_atomic(write, path):
+    tmp = temp_file(path)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def write_manifest(path, key):
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump({'key': key, 'file': os.path.basename(path)}, f)
+
+    replace_atomic(write, manifest_file(path))
+
+
+def write_table(df, path, key, **kwargs):
+    # The manifest is written last, so a table is only ever current once it is complete.
+    replace_atomic(lambda tmp: storage.write_table(df, tmp, **kwargs), path)
+    write_manifest(path, key)
+
+
+def table_key(path):
+    # The key a table was built with, or None if it has no manifest.
+    try:
+        with open(manifest_file(path)) as f:
+            return json.load(f).get('key')
+    except (IOError, ValueError):
+        return None
+
+
+def write_index(arrays, table_path):
+    # .npy files derived from a table are written after it, then tied to it by a manifest of their own holding the
+    # table's key, so files left from an earlier or interrupted build are never taken for the current table's.
+    for path, array in arrays:
+        replace_atomic(lambda tmp: np.save(tmp, array), path)
+    write_manifest(arrays[0][0], table_key(table_path))
+
+
+def index_current(paths, table_path):
+    key = table_key(table_path)
+    return key is not None and is_current(paths[0], key) and all(os.path.isfile(path) for path in paths[1:])
+
+
+@contextlib.contextmanager
+def lock(path, timeout=6 * 60 * 60, poll=5):
+    # A lock older than timeout is assumed to belong to a job that died and is taken over.
+    lock_file = path + '.lock'
+    while True:
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            # Any other error, such as a missing or read-only directory, is raised rather than waited on.
+            try:
+                if time.time() - os.path.getmtime(lock_file) > timeout:
+                    # The stale lock is renamed to a name of this job's own, so that of several jobs taking it over
+                    # at once only one succeeds, and none removes a lock another job has just created.
+                    stale_file = '{}.stale.{}.{}'.format(lock_file, os.getpid(), uuid.uuid4().hex)
+                    os.rename(lock_file, stale_file)
+                    if time.time() - os.path.getmtime(stale_file) <= timeout:
+                        # Another job took the lock over between the two calls; its lock is put back.
+                        try:
+                            os.link(stale_file, lock_file)
+                        except FileExistsError:
+                            pass
+                    os.remove(stale_file)
+                    continue
+            except FileNotFoundError:
+                # The lock was released or taken over by another job first.
+                time.sleep(poll)
+                continue
+            logger.info("Waiting for another job to finish building {}".format(path))
+            time.sleep(poll)
+
+    try:
+        os.write(fd, str(os.getpid()).encode('utf-8'))
+        os.close(fd)
+        yield
+    finally:
+        os.remove(lock_file)
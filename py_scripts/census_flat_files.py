@@ -0,0 +1,65 @@
+"""
+This script reads the census flat files (blkgrp_over18_race_dec10.dta, tract_over18_race_dec10.dta, and
+zip_over18_race_dec10.dta).  Parsing a .dta file decodes every variable of every row, so each flat file is parsed
+once, in chunks, into a columnar copy, <name>_dta.parquet in cache_dir, and later runs read only the columns and rows
+they need from that copy.  cache_dir is the output directory of the caller, by default the created_python directory
+beside the .dta files, since the directory holding the raw census files is often read-only.  The copy is rebuilt when
+the .dta file or this script changes (see build_cache.py).
+
+String codes that repeat across rows, such as State_FIPS10 and County_FIPS10, are stored as categoricals; codes
+that identify a row, such as GEOID10_BlkGrp, GEOID10_Tract, and ZCTA5, stay strings so they merge as before.
+"""
+
+import os
+import logging
+import pandas as pd
+
+import storage
+import build_cache
+
+
+logger = logging.getLogger(__name__)
+
+
+def cache_file(path, cache_dir=None):
+    # _dta keeps the copy apart from the prepared table of the same geography, which is written to the same directory.
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return storage.table_file(cache_dir or os.path.join(os.path.dirname(path), 'created_python'), stem + '_dta')
+
+
+def compact_strings(df):
+    for var in list(df):
+        if df[var].dtype.kind in 'OU' or isinstance(df[var].dtype, pd.StringDtype):
+            if df[var].nunique() <= df.shape[0] // 2:
+                df[var] = df[var].astype('category')
+            else:
+                df[var] = df[var].astype(object)
+    return df
+
+
+def read_dta(path, columns=None, chunksize=100000):
+    # Value labels are not used by the flat files, so they are not converted.
+    chunks = []
+    with pd.read_stata(path, columns=columns, chunksize=chunksize, convert_categoricals=False) as reader:
+        for chunk in reader:
+            chunks.append(chunk)
+    return compact_strings(pd.concat(chunks, ignore_index=True))
+
+
+def convert_dta(path, cache_dir=None):
+    out_file = cache_file(path, cache_dir)
+    key = build_cache.cache_key([path], os.path.abspath(__file__))
+    if not os.path.isdir(os.path.dirname(out_file)):
+        os.makedirs(os.path.dirname(out_file))
+
+    with build_cache.lock(out_file):
+        if not build_cache.is_current(out_file, key):
+            logger.info("Converting {} to {}".format(path, out_file))
+            build_cache.write_table(read_dta(path), out_file, key)
+
+    return out_file
+
+
+def read_flat_file(path, columns=None, filters=None, cache_dir=None):
+    # Rows come back in the order of the .dta file.
+    return storage.read_table(convert_dta(path, cache_dir), columns=columns, filters=filters)
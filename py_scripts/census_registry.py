@@ -0,0 +1,152 @@
+"""
+This script keeps track of the census vintages and surname lists the proxies can be built from, builds their prepared
+tables ahead of time, and loads each table only when it is first used.
+
+A vintage names a set of census geography flat files, <geography><file_stem>.dta for blkgrp, tract, and zip, in the
+layout of the 2010 SF1 files read by create_attr_over18_all_geo_entities.py, with its geography key variables and state
+variable.  dec10 is the 2010 SF1 files of this repository; dec20 expects the 2020 files prepared in the same layout, with
+GEOID20_ keys and State_FIPS20.  Other vintages are added with register_vintage.  A surname list names a census surname
+.csv file in the layout of app_c.csv; the 2010 list is prepared in censusdir itself and any other in a subdirectory.
+
+CensusRegistry(censusdir, indir) finds the vintages and geography levels with a flat file in indir or a prepared table
+in censusdir, and build() prepares them all (each table is rebuilt only when its flat file or code changes, see
+build_cache.py).  geography() and surname_index() load a table on first use and keep it for later calls; prepared
+geography tables are memory-mapped from their .npy files, so a run that needs only 2020 tracts reads nothing else.
+
+Usage:
+
+registry = census_registry.CensusRegistry('../input_files/created_python', indir='../input_files')
+registry.build()
+census_dfs = registry.census_dfs('dec20', ['tract'])
+census_index = registry.surname_index('census2010')
+"""
+
+import os
+import logging
+import pandas as pd
+
+import storage
+import instrumentation
+import surname_creation_lower
+import create_attr_over18_all_geo_entities
+
+
+logger = logging.getLogger(__name__)
+
+
+geo_types = ['blkgrp', 'tract', 'zip']
+
+vintages = {'dec10': {'file_stem': '_over18_race_dec10',
+                      'geo_keys': {'blkgrp': 'GEOID10_BlkGrp', 'tract': 'GEOID10_Tract', 'zip': 'ZCTA5'},
+                      'state_var': 'State_FIPS10'},
+            'dec20': {'file_stem': '_over18_race_dec20',
+                      'geo_keys': {'blkgrp': 'GEOID20_BlkGrp', 'tract': 'GEOID20_Tract', 'zip': 'ZCTA5'},
+                      'state_var': 'State_FIPS20'}}
+
+# Surname lists by name: the .csv file in indir and the subdirectory of censusdir holding the prepared list.
+surname_lists = {'census2010': {'csv': 'app_c.csv', 'subdir': ''}}
+
+default_vintage = 'dec10'
+default_surname_list = 'census2010'
+
+
+def register_vintage(name, file_stem, geo_keys, state_var):
+    vintages[name] = {'file_stem': file_stem, 'geo_keys': geo_keys, 'state_var': state_var}
+
+
+def register_surname_list(name, csv, subdir=None):
+    surname_lists[name] = {'csv': csv, 'subdir': name if subdir is None else subdir}
+
+
+def file_stem(vintage):
+    if vintage not in vintages:
+        raise ValueError("Unknown census vintage {}; registered vintages are {}".format(vintage, sorted(vintages)))
+    return vintages[vintage]['file_stem']
+
+
+def geo_key_names(vintage):
+    # Name of the key variable of each geography in the census files of vintage; an unknown vintage raises as in file_stem.
+    file_stem(vintage)
+    return vintages[vintage]['geo_keys']
+
+
+def load_geography(censusdir, geo_type, geo_ind_name, file_stem=vintages[default_vintage]['file_stem'], keys=None):
+    # The prepared table of a geography, indexed by key, from its memory-mapped .npy files or else from the table itself.
+    # When keys is given, only those geographies are read.
+    df = create_attr_over18_all_geo_entities.load_geo_index(censusdir, geo_type + file_stem, keys=keys)
+    if df is None:
+        path = storage.find_table(censusdir, geo_type + file_stem)
+        if path is None:
+            raise IOError("No prepared census table {} in {}".format(geo_type + file_stem, censusdir))
+        filters = [('GeoInd', 'in', list(keys))] if keys is not None else None
+        df = storage.read_table(path, filters=filters)
+
+    df = df.rename(columns={'GeoInd': geo_ind_name})
+    # Index by key; pandas keeps the hash table of the index, so it is built once however many lookups follow.
+    df.index = pd.Index(df[geo_ind_name].values)
+    return df
+
+
+class CensusRegistry(object):
+
+    def __init__(self, censusdir, indir=None):
+        self.censusdir = censusdir
+        self.indir = indir
+        self.tables = {}
+        self.indexes = {}
+
+    def flat_file(self, vintage, geo_type):
+        return os.path.join(self.indir, geo_type + file_stem(vintage) + '.dta') if self.indir else None
+
+    def surname_dir(self, name):
+        return os.path.join(self.censusdir, surname_lists[name]['subdir'])
+
+    def has_flat_file(self, vintage, geo_type):
+        return self.indir is not None and os.path.isfile(self.flat_file(vintage, geo_type))
+
+    def has_table(self, vintage, geo_type):
+        return storage.find_table(self.censusdir, geo_type + file_stem(vintage)) is not None
+
+    def available(self):
+        # (vintage, geography) pairs with a prepared table or a flat file to prepare it from.
+        return [(vintage, geo_type) for vintage in sorted(vintages) for geo_type in geo_types
+                if self.has_table(vintage, geo_type) or self.has_flat_file(vintage, geo_type)]
+
+    def available_surname_lists(self):
+        return [name for name in sorted(surname_lists)
+                if storage.find_table(self.surname_dir(name), 'census_surnames_lower') is not None or
+                (self.indir is not None and os.path.isfile(os.path.join(self.indir, surname_lists[name]['csv'])))]
+
+    def build(self, vintage_list=None, geo_switch=None, surname_list_names=None):
+        # Prepares every table that has a flat file or surname .csv in indir, or only those asked for.
+        for vintage in vintage_list or sorted(vintages):
+            geo_files = [geo_type for geo_type in geo_switch or geo_types if self.has_flat_file(vintage, geo_type)]
+            if geo_files:
+                create_attr_over18_all_geo_entities.create(self.indir, self.censusdir, file_stem=file_stem(vintage),
+                                                           key_vars=vintages[vintage]['geo_keys'],
+                                                           state_var=vintages[vintage]['state_var'], geo_files=geo_files)
+
+        for name in surname_list_names or sorted(surname_lists):
+            in_csv = os.path.join(self.indir, surname_lists[name]['csv']) if self.indir else None
+            if in_csv is not None and os.path.isfile(in_csv):
+                if not os.path.isdir(self.surname_dir(name)):
+                    os.makedirs(self.surname_dir(name))
+                surname_creation_lower.create(in_csv, census_surnames_lower_dir=self.surname_dir(name))
+
+    def geography(self, vintage, geo_type):
+        if (vintage, geo_type) not in self.tables:
+            with instrumentation.stage('census_registry.load_' + vintage + '_' + geo_type) as record:
+                self.tables[(vintage, geo_type)] = load_geography(self.censusdir, geo_type, vintages[vintage]['geo_keys'][geo_type],
+                                                                  file_stem=file_stem(vintage))
+                if record is not None:
+                    record['rows_out'] = self.tables[(vintage, geo_type)].shape[0]
+            logger.info("Loaded Census Data {} {} (Shape: {})".format(vintage, geo_type, self.tables[(vintage, geo_type)].shape))
+        return self.tables[(vintage, geo_type)]
+
+    def census_dfs(self, vintage, geo_switch):
+        return {geo_type: self.geography(vintage, geo_type) for geo_type in geo_switch}
+
+    def surname_index(self, name=default_surname_list):
+        if name not in self.indexes:
+            self.indexes[name] = surname_creation_lower.load_surname_index(self.surname_dir(name))
+        return self.indexes[name]
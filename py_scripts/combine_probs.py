@@ -0,0 +1,125 @@
+"""
+This script takes the block group, tract, and ZIP code based BISG proxies created side by side by
+geo_name_merger_all_entities_over_18.py and chooses the most precise proxy given the precision of geocoding.
+
+Input arguments:
+
+output - output directory
+bisg_dir - directory containing the file with BISG proxies created by geo_name_merger_all_entities_over_18.py
+bisg_file - file with blkgrp18_, tract18_ and zip18_ prefixed BISG proxies; a geography left out is treated as unavailable
+geoprecvar - name of the geocode precision variable
+matchvars - unique record identifier
+
+For records geocoded to the street ("USAStreetName"), 9-digit ZIP code ("USAZIP4"), and 5-digit ZIP code ("USAZipcode"), use 5-digit ZIP code demographics.
+For records geocoded to the rooftop ("USAStreetAddr"), use first available: block group, tract, or 5-digit ZIP code demographics.
+Precision codes are those generated by ArcGIS.
+
+pr_precision reflects the level of geographic detail associated with the selection of the demographics.
+"""
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+import storage
+
+
+logger = logging.getLogger(__name__)
+
+
+race_list = ['white', 'black', 'hispanic', 'api', 'aian', 'mult_other']
+geo_prefixes = ['blkgrp18_', 'tract18_', 'zip18_']
+
+precision_labels = {1: "NO FINAL PROB ASSIGNED",
+                    2: "ZIP (not rooftop lat/long)",
+                    3: "BLKGRP (has rooftop lat/long)",
+                    4: "TRACT (has rooftop lat/long)",
+                    5: "ZIP (has rooftop lat/long)"}
+
+# pr_precision values in the order they are tried, with the geocode precision values they apply to and the prefix
+# of the BISG proxy they use, following the replace statements in combine_probs.do.
+precision_rules = [(2, ["USAStreetName", "USAZIP4", "USAZipcode"], 'zip18_'),
+                   (3, ["USAStreetAddr"], 'blkgrp18_'),
+                   (4, ["USAStreetAddr"], 'tract18_'),
+                   (5, ["USAStreetAddr"], 'zip18_')]
+precision_sources = {code: prefix for code, geoprec_values, prefix in precision_rules}
+
+
+def assign_pr_precision(geoprec, available):
+    # geoprec holds geocode precision values; available maps each geography prefix to whether its BISG proxy exists.
+    # The first rule that holds wins.
+    geoprec = np.asarray(geoprec, dtype=object)
+    return np.select([np.isin(geoprec, geoprec_values) & available[prefix] for code, geoprec_values, prefix in precision_rules],
+                     [code for code, geoprec_values, prefix in precision_rules], default=1)
+
+
+def built_prefixes(df):
+    # Geographies whose BISG proxies are in df; outputs built for only some geographies lack the others.
+    return [prefix for prefix in geo_prefixes if all(prefix + 'pr_' + race in list(df) for race in race_list)]
+
+
+def create_pr_precision(df, geoprecvar):
+    # A geography is available when its BISG probabilities have a positive row total (missing values count as 0);
+    # a geography that was not built is never available.
+    available = {prefix: np.zeros(df.shape[0], dtype=bool) for prefix in geo_prefixes}
+    for prefix in built_prefixes(df):
+        available[prefix] = (df[[prefix + 'pr_' + race for race in race_list]].sum(axis=1) > 0).values
+
+    return assign_pr_precision(df[geoprecvar].values, available)
+
+
+def select_final_probs(df, pr_precision):
+    codes = [code for code in sorted(precision_sources) if precision_sources[code] in built_prefixes(df)]
+    for race in race_list:
+        df['pr_' + race] = np.select([pr_precision == code for code in codes],
+                                     [df[precision_sources[code] + 'pr_' + race].values for code in codes],
+                                     default=np.nan)
+
+    return df
+
+
+def check_final_probs(df, pr_precision):
+    logger.info("Checking final probabilities sum to 1")
+    check_pr = df[['pr_' + race for race in race_list]].sum(axis=1).values
+    assert (check_pr[pr_precision == 1] == 0).all()
+    assert ((check_pr[pr_precision > 1] >= 0.99) & (check_pr[pr_precision > 1] <= 1.01)).all()
+
+
+def create(output, bisg_dir, bisg_file, geoprecvar, matchvars=[]):
+
+    logger.info("\n\n\n")
+    logger.info("************************************************")
+    logger.info("**********    Combining BISG Proxies    ********")
+    logger.info("************************************************")
+    logger.info("\n\n\n")
+
+    df = storage.read_table(os.path.join(bisg_dir, bisg_file))
+    logger.info("Loaded BISG Data {} (Shape: {})".format(bisg_file, df.shape))
+
+    if not matchvars:
+        matchvars = ['index']
+        if 'index' not in list(df):
+            df = df.reset_index()
+
+    pr_precision = create_pr_precision(df, geoprecvar)
+
+    logger.info("Check that precision assigned to all observations")
+    assert (pr_precision > 0).all()
+
+    df = select_final_probs(df, pr_precision)
+    check_final_probs(df, pr_precision)
+
+    df['pr_precision'] = pd.Categorical.from_codes(pr_precision - 1, categories=[precision_labels[code] for code in sorted(precision_labels)], ordered=True)
+    logger.info(pd.crosstab(df['pr_precision'], df[geoprecvar], dropna=False))
+
+    prefixes = built_prefixes(df)
+    out_vars = matchvars + [geoprecvar, 'pr_precision'] + ['pr_' + race for race in race_list] + \
+        [prefix + 'pr_' + race for prefix in prefixes for race in race_list] + \
+        [prefix + 'geo_pr_' + race for prefix in prefixes for race in race_list if prefix + 'geo_pr_' + race in list(df)] + \
+        [var for var in list(df) if var.startswith('name_pr')]
+    df = df[out_vars]
+
+    storage.write_table(df, storage.table_file(output, bisg_file.split('.')[0].replace('_BISG', '') + '_proxied_final'))
+
+    return df
@@ -0,0 +1,50 @@
+"""
+This script holds the opt-in compact mode of the proxy building code sequence, used by surname_parser.py and
+geo_name_merger_all_entities_over_18.py when they are called with compact=True.
+
+In compact mode string columns (surnames, geocode precision, and other codes) are stored as categoricals, the
+geography keys of the application data and of the census tables are categoricals sharing one set of categories
+(so looking them up compares integer codes rather than strings), the namematch flags are int8, and the probability
+columns are optionally float32.  Each stage prints its memory use before and after compaction.
+"""
+
+import logging
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+
+def memory_mb(df):
+    return df.memory_usage(deep=True).sum() / 2.0 ** 20
+
+
+def is_string(series):
+    return series.dtype == object or isinstance(series.dtype, pd.StringDtype)
+
+
+def shared_categories(*columns):
+    # Every value found in any of the columns, so that Categoricals built from each of them with these categories merge on their codes.
+    values = [np.asarray(column.dropna().unique(), dtype=object) for column in columns]
+    return pd.Index(np.concatenate(values)).unique() if values else pd.Index([])
+
+
+def share_categories(left, left_var, right, right_var):
+    categories = shared_categories(left[left_var], right[right_var])
+    left[left_var] = pd.Categorical(left[left_var], categories=categories)
+    right[right_var] = pd.Categorical(right[right_var], categories=categories)
+
+
+def compact_frame(df, stage, flag_vars=[], prob_vars=[], dtype=np.float64):
+    before = memory_mb(df)
+    for var in list(df):
+        if var in flag_vars:
+            df[var] = df[var].astype(np.int8)
+        elif var in prob_vars:
+            df[var] = df[var].astype(dtype)
+        elif is_string(df[var]):
+            df[var] = df[var].astype('category')
+
+    logger.info("Compact dtypes for {}: {:,.1f} MB -> {:,.1f} MB".format(stage, before, memory_mb(df)))
+    return df
@@ -3,121 +3,186 @@ This script uses the base information from the census flat files for block group
 to each group in proportion.  It creates three files (one each for block group, tract, and ZIP code) containing the geography-only
 proxy as well as the proportion of population for a given race and ethnicity residing in a given geographic area, which is 
 used to build the BISG proxy.
+
+The flat files of other census vintages with the same layout are prepared the same way given their file stem, geography key
+variables, and state variable (see census_registry.py).  Each prepared table is also saved as a sorted key array and a
+probability matrix in .npy files, which load_geo_index memory-maps while they are current for the table.
 """
 
 
 import os
+import logging
 import numpy as np
 import pandas as pd
 
+import storage
+import build_cache
+import census_flat_files
+import instrumentation
+
+
+logger = logging.getLogger(__name__)
+
+
+geo_keys = {'blkgrp': 'GEOID10_BlkGrp', 'tract': 'GEOID10_Tract', 'zip': 'ZCTA5'}
+
+count_vars = ['Total_Pop', 'Hispanic_Total', 'Non_Hispanic_Total', 'NH_White_alone', 'NH_Black_alone', 'NH_AIAN_alone',
+              'NH_API_alone', 'NH_Other_alone', 'NH_Mult_Total', 'NH_White_Other', 'NH_Black_Other', 'NH_AIAN_Other',
+              'NH_Asian_HPI', 'NH_API_Other', 'NH_Asian_HPI_Other']
+
+race_list = ['white', 'black', 'aian', 'api', 'mult_other', 'hispanic']
+
+# Variables of a prepared table other than GeoInd, in the column order of the .npy probability matrix.
+geo_vars = ['geo_pr_' + race for race in race_list] + ['here'] + ['here_given_' + race for race in race_list]
+
+
+def geo_index_files(outdir, geo_file_full):
+    return os.path.join(outdir, geo_file_full + '_keys.npy'), os.path.join(outdir, geo_file_full + '_values.npy')
+
+
+def write_geo_index(df, table_path):
+    # df is the table at table_path, sorted by GeoInd, so a key resolves to its row with a binary search.  The index is
+    # current only while that table is.
+    outdir, geo_file_full = os.path.split(os.path.splitext(table_path)[0])
+    build_cache.write_index(list(zip(geo_index_files(outdir, geo_file_full),
+                                     [np.array(df['GeoInd'].values, dtype=str), np.ascontiguousarray(df[geo_vars].values, dtype=np.float64)])),
+                            table_path)
+
+
+def load_geo_index(outdir, geo_file_full, keys=None):
+    # The prepared table from its memory-mapped .npy files, or None if they are missing or were not made from the
+    # current table.  When keys is given, only the rows of those geographies are read.
+    keys_file, values_file = geo_index_files(outdir, geo_file_full)
+    table_path = storage.find_table(outdir, geo_file_full)
+    if table_path is None or not build_cache.index_current([keys_file, values_file], table_path):
+        return None
+
+    index_keys = np.load(keys_file, mmap_mode='r')
+    values = np.load(values_file, mmap_mode='r')
+    if keys is not None:
+        query = np.unique(np.array(list(keys), dtype=str))
+        pos = np.searchsorted(index_keys, query).clip(max=max(index_keys.shape[0] - 1, 0))
+        rows = pos[index_keys[pos] == query] if index_keys.shape[0] else pos[:0]
+        index_keys, values = index_keys[rows], values[rows]
+
+    df = pd.DataFrame(values, columns=geo_vars, copy=False)
+    df.insert(0, 'GeoInd', np.asarray(index_keys, dtype=object))
+    return df
+
+
+def create_geo_file(indir, geo_file, file_stem, key_ind=None, state_var='State_FIPS10', cache_dir=None):
+    geo_file_full = geo_file + file_stem
+    logger.info("Creating {}...".format(geo_file_full))
+    key_ind = key_ind or geo_keys[geo_file]
+    raw_in = census_flat_files.read_flat_file(os.path.join(indir, geo_file_full + '.dta'), columns=[key_ind, state_var] + count_vars,
+                                              cache_dir=cache_dir)
+
+    # Step 1: From the SF1, retain population contiguous U.S., Alaska,
+    # and Hawaii in order to ensure consistency with the population
+    # covered by the census surname list.
+    logger.info("Initial Number of {} == 72: {}".format(state_var,
+        (raw_in[state_var] == '72').sum()))
+    output = raw_in[raw_in[state_var] != "72"]
+    logger.info("Updated Number of {} == 72: {}".format(state_var,
+        (output[state_var] == '72').sum()))
+
+    if geo_file == 'zip':
+        puerto_rico = ["006", "007", "008", "009"]
+        logger.info('Initial Number of {}s beginning with "006","007","008","009": {}'.format(key_ind,
+            output[key_ind].str[:3].isin(puerto_rico).sum()))
+        output = output[~output[key_ind].str[:3].isin(puerto_rico)]
+        logger.info('Updated Number of {}s beginning with "006","007","008","009": {}'.format(key_ind,
+            output[key_ind].str[:3].isin(puerto_rico).sum()))
+
+    # Counts as float64 arrays, so the sums below can't overflow the small integer types of the flat files.
+    count = {var: output[var].values.astype(np.float64) for var in count_vars}
+
+    # Step 2: Address "Other" category from 2010 Census; what is done
+    # here follows Word(2008).
+
+    for var in ['NH_White', 'NH_Black', 'NH_AIAN', 'NH_API']:
+        count[var + "_alone"] = count[var + "_alone"] + count[var + "_Other"]
+
+    # Census breaks out Asian and PI separately; since we consider them
+    # as one, we correct for this.
+    count['NH_API_alone'] = count['NH_API_alone'] + count['NH_Asian_HPI'] + count['NH_Asian_HPI_Other']
+
+    # Replace multiracial total to account for the fact that we have
+    # suppressed the Other category.
+    count['NH_Mult_Total'] = count['NH_Mult_Total'] - (count['NH_White_Other'] + count['NH_Black_Other'] + count['NH_AIAN_Other'] +
+                                                       count['NH_Asian_HPI'] + count['NH_API_Other'] + count['NH_Asian_HPI_Other'])
 
-def create(indir, outdir):
-    geo_files = ['blkgrp', 'tract', 'zip']
-    file_stem = '_over18_race_dec10'
+    # Verify the steps above by confirming that the Total Population
+    # still matches.
+    assert np.array_equal(count['Total_Pop'],
+                          count['NH_White_alone'] + count['NH_Black_alone'] + count['NH_API_alone'] + count['NH_AIAN_alone'] +
+                          count['NH_Mult_Total'] + count['NH_Other_alone'] + count['Hispanic_Total'])
+
+    # Step 3: Proportionally redistribute Non-Hispanic Other population
+    # to remaining Non-Hispanic groups within each block.  The share is the same for every group, so it is computed once.
+    # Where there is no population, every group is 0; where every Non-Hispanic is Other, Other is split evenly.
+    nh_groups = ['NH_White_alone', 'NH_Black_alone', 'NH_AIAN_alone', 'NH_API_alone', 'NH_Mult_Total']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        other_share = count['NH_Other_alone'] / (count['Total_Pop'] - count['Hispanic_Total'] - count['NH_Other_alone'])
+    no_pop = count['Total_Pop'] == 0
+    all_other = count['Non_Hispanic_Total'] == count['NH_Other_alone']
+    for var in nh_groups:
+        count[var] = count[var] + count[var] * other_share
+        count[var][no_pop] = 0
+        count[var][all_other] = count['NH_Other_alone'][all_other] / 5
+
+    # Verify the steps above by confirming that all sole-ethnicities
+    # sum to the total population.
+    races = np.column_stack([count[var] for var in ['NH_White_alone', 'NH_Black_alone', 'NH_AIAN_alone', 'NH_API_alone', 'NH_Mult_Total', 'Hispanic_Total']])
+    assert np.array_equal(count['Total_Pop'], np.round(races.sum(axis=1)))
+
+    # Collapse dataset to get the Population Totals for each group.
+    pop_totals = races.sum(axis=0)
+
+    # Multiple races or "some other race" (and not Hispanic) is the mult_other group.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        geo_pr = races / count['Total_Pop'][:, np.newaxis]
+
+    # When updating geocoded race probabilities, we require the probability that someone of a particular race lives in that block group, tract, or ZIP code.
+    # Our race counts are single race reported counts, therefore we divide the single race population within each block by the total single race population
+    # for each group.
+    here_given = races / pop_totals
+
+    logger.info("Renaming {} to GeoInd.".format(key_ind))
+
+    geo_df = pd.DataFrame({'GeoInd': output[key_ind].values})
+    for i, race in enumerate(race_list):
+        geo_df['geo_pr_' + race] = geo_pr[:, i]
+    geo_df['here'] = count['Total_Pop'] / count['Total_Pop'].sum()
+    for i, race in enumerate(race_list):
+        geo_df['here_given_' + race] = here_given[:, i]
+
+    return geo_df
+
+
+def create(indir, outdir, file_stem='_over18_race_dec10', key_vars=geo_keys, state_var='State_FIPS10', geo_files=['blkgrp', 'tract', 'zip']):
     for geo_file in geo_files:
         geo_file_full = geo_file + file_stem
-        if not os.path.isfile(os.path.join(outdir, geo_file_full + '.pkl')):
-            print("Creating {}...".format(geo_file_full))
-            raw_in = pd.read_stata(os.path.join(indir, geo_file_full + '.dta'))
-
-            # Step 1: From the SF1, retain population contiguous U.S., Alaska,
-            # and Hawaii in order to ensure consistency with the population
-            # covered by the census surname list.
-            print("Initial Number of State_FIPS10 == 72: {}".format(
-                (raw_in['State_FIPS10'] == '72').sum()))
-            output = raw_in[raw_in['State_FIPS10'] != "72"]
-            print("Updated Number of State_FIPS10 == 72: {}".format(
-                (output['State_FIPS10'] == '72').sum()))
-
-            if geo_file_full == 'zip' + file_stem:
-                print('Initial Number of ZCTA5s beginning with "006","007","008","009": {}'.format(
-                    (raw_in['State_FIPS10'].apply(lambda x: x[:3] in ["006", "007", "008", "009"])).sum()))
-                output = raw_in[(raw_in['ZCTA5'].apply(
-                    lambda x: x[:3] not in ["006", "007", "008", "009"]))]
-                print('Updated Number of ZCTA5s beginning with "006","007","008","009": {}'.format(
-                    (output['State_FIPS10'].apply(lambda x: x[:3] in ["006", "007", "008", "009"])).sum()))
-
-            # Step 2: Address "Other" category from 2010 Census; what is done
-            # here follows Word(2008).
-
-            for var in ['NH_White', 'NH_Black', 'NH_AIAN', 'NH_API']:
-                output[var + "_alone"] = output[var +
-                                                "_alone"] + output[var + "_Other"]
-
-            # Census breaks out Asian and PI separately; since we consider them
-            # as one, we correct for this.
-            output['NH_API_alone'] = output['NH_API_alone'] + \
-                output['NH_Asian_HPI'] + output['NH_Asian_HPI_Other']
-
-            # Replace multiracial total to account for the fact that we have
-            # suppressed the Other category.
-            output['NH_Mult_Total'] = output['NH_Mult_Total'] - (np.sum(
-                output[['NH_White_Other', 'NH_Black_Other', 'NH_AIAN_Other', 'NH_Asian_HPI', 'NH_API_Other', 'NH_Asian_HPI_Other']], axis=1))
-
-            # Verify the steps above by confirming that the Total Population
-            # still matches.
-            assert np.array_equal(output['Total_Pop'].values,
-                                  np.sum(output[['NH_White_alone', 'NH_Black_alone', 'NH_API_alone', 'NH_AIAN_alone', 'NH_Mult_Total', 'NH_Other_alone', 'Hispanic_Total']], axis=1).values)
-
-            # Step 3: Proportionally redistribute Non-Hispanic Other population
-            # to remaining Non-Hispanic groups within each block.
-            for var in ['NH_White_alone', 'NH_Black_alone', 'NH_AIAN_alone', 'NH_API_alone', 'NH_Mult_Total']:
-                output[var] = output[var] + (output[var] / (output['Total_Pop'] - np.sum(
-                    output[['Hispanic_Total', 'NH_Other_alone']], axis=1))) * output['NH_Other_alone']
-                output[output['Total_Pop'] == 0][var] = 0
-                output[output['Non_Hispanic_Total'] == output['NH_Other_alone']][
-                    var] = output['NH_Other_alone'] / 5
-
-            # Verify the steps above by confirming that all sole-ethnicities
-            # sum to the total population.
-            assert np.array_equal(output['Total_Pop'].values,
-                                  round(np.sum(output[['NH_White_alone', 'NH_Black_alone', 'NH_AIAN_alone', 'NH_API_alone', 'NH_Mult_Total', 'Hispanic_Total']], axis=1)).values)
-
-            # Collapse dataset to et the Population Totals for each group.
-            pop_totals_df = output[['NH_White_alone', 'NH_Black_alone', 'NH_AIAN_alone',
-                                    'NH_API_alone', 'NH_Mult_Total', 'Hispanic_Total', 'Total_Pop']].sum()
-
-            output[['geo_pr_white', 'geo_pr_black', 'geo_pr_aian', 'geo_pr_api']] = output[
-                ['NH_White_alone', 'NH_Black_alone', 'NH_AIAN_alone', 'NH_API_alone']].apply(lambda x: x / output['Total_Pop'])
-
-            # Multiple races or "some other race" (and not Hispanic).
-            output['geo_pr_mult_other'] = output['NH_Mult_Total'] / output['Total_Pop']
-            output['geo_pr_hispanic'] = output[
-                'Hispanic_Total'] / output['Total_Pop']
-
-            # When updating geocoded race probabilities, we require the probability that someone of a particular race lives in that block group, tract, or ZIP code.
-            # Our race counts are single race reported counts, therefore we divide the single race population within each block by the total single race population
-            # for each group.
-
-            output['here'] = output['Total_Pop'] / \
-                pop_totals_df['Total_Pop']
-            output['here_given_white'] = output['NH_White_alone'] / \
-                pop_totals_df['NH_White_alone']
-            output['here_given_black'] = output['NH_Black_alone'] / \
-                pop_totals_df['NH_Black_alone']
-            output['here_given_aian'] = output['NH_AIAN_alone'] / \
-                pop_totals_df['NH_AIAN_alone']
-            output['here_given_api'] = output['NH_API_alone'] / \
-                pop_totals_df['NH_API_alone']
-            output['here_given_mult_other'] = output['NH_Mult_Total'] / \
-                pop_totals_df['NH_Mult_Total']
-            output['here_given_hispanic'] = output['Hispanic_Total'] / \
-                pop_totals_df['Hispanic_Total']
-
-            if geo_file == 'blkgrp':
-                key_ind = 'GEOID10_BlkGrp'
-            elif geo_file == 'tract':
-                key_ind = 'GEOID10_Tract'
-            elif geo_file == 'zip':
-                key_ind = 'ZCTA5'
-
-            print("Renaming {} to GeoInd.".format(key_ind))
-            output.rename(columns={key_ind: 'GeoInd'}, inplace=True)
-
-            keep_cols = ['GeoInd'] + [col for col in list(output) if col.startswith('geo_pr') or col.startswith('here')]
-
-            output[keep_cols].to_pickle(os.path.join(outdir, geo_file_full + '.pkl'))
-
-        else:
-            print("{}.pkl already exists.".format(
-                os.path.join(outdir, geo_file_full + '.pkl')))
+        out_file = storage.table_file(outdir, geo_file_full)
+
+        # Rebuild only when the flat file, this script, or the geography changes.
+        key = build_cache.cache_key([os.path.join(indir, geo_file_full + '.dta')], os.path.abspath(__file__),
+                                    {'geo_file': geo_file, 'key_var': key_vars[geo_file], 'state_var': state_var})
+
+        with build_cache.lock(out_file):
+            if not build_cache.is_current(out_file, key):
+                with instrumentation.stage('create_attr_over18_all_geo_entities.' + geo_file) as record:
+                    output = create_geo_file(indir, geo_file, file_stem, key_ind=key_vars[geo_file], state_var=state_var,
+                                             cache_dir=outdir)
+                    if record is not None:
+                        record.update(rows_out=output.shape[0], zero_population=int((output['here'] == 0).sum()))
+
+                # Sorted by key so that Parquet row groups can be skipped when only some geographies are needed.
+                output = output.sort_values('GeoInd').reset_index(drop=True)
+                build_cache.write_table(output, out_file, key, row_group_size=10000)
+                write_geo_index(output, out_file)
+
+            else:
+                logger.info("{} is up to date.".format(out_file))
+                if not build_cache.index_current(geo_index_files(outdir, geo_file_full), out_file):
+                    write_geo_index(storage.read_table(out_file), out_file)
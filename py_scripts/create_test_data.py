@@ -7,82 +7,206 @@ In constructing this sample data set, created solely for the purpose of illustra
 set up the proxy building code sequence, we select a random list of ZIP codes, which will
 likely be unrelated to the tract or block groups to which they will be merged.  This
 fictitious sample data cannot be used to test the accuracy of the proxy.
+
+Run without arguments, it writes the 100-record ../test_output/fictitious_sample_data.pkl.  With --n it instead draws
+N synthetic applications for benchmarking (see benchmark.py): surnames in proportion to their counts in app_c.csv,
+block groups (or tracts, when the block group flat file is not available) and ZIP codes in proportion to their adult
+population, a coapplicant on a share --coapp-rate of applications, a hyphenated surname on a share --hyphen-rate of
+names, and geocode precision values in the shares of precision_mix.  Large samples are written in chunks.
+
+Usage:
+
+python create_test_data.py [--n N] [--out FILE] [--seed SEED] [--coapp-rate 0.25] [--hyphen-rate 0.02] [--chunksize 1000000]
 """
 
+import os
+import logging
+import argparse
+import numpy as np
 import pandas as pd
 from numpy.random import choice, uniform, seed
 
+import storage
+import census_flat_files
 
-# Read in surname data and take a random draw of 100 individuals for
-# applicant last name.
 
-app_c = pd.read_csv('../input_files/app_c.csv')
+logger = logging.getLogger(__name__)
 
-seed(1234)
 
-draw = choice(app_c.shape[0], app_c.shape[0], replace=False)
-name1 = app_c[draw < 100].name.reset_index(drop=True)
+# Geocode precision values and the share of applications given each, as in create_geo_code_precision.
+precision_mix = {"USAStreetAddr": 0.90, "USAStreetName": 0.05, "USAZIP4": 0.02, "USAZipcode": 0.03}
 
-# Read in surname data and take a random draw of 25 invididuals for
-# coapplicant last name.
+puerto_rico_zips = ["006", "007", "008", "009"]
 
-seed(5678)
 
-draw = choice(app_c.shape[0], app_c.shape[0], replace=False)
-name2 = app_c[draw < 25].name.reset_index(drop=True)
+def create_geo_code_precision(runi):
+    if runi < 0.90:
+        return "USAStreetAddr"
+    elif runi < 0.95:
+        return "USAStreetName"
+    elif runi < 0.97:
+        return "USAZIP4"
+    else:
+        return "USAZipcode"
 
-# Read in geography data from census geography files.
 
-# Block groups are nested within tracts, so merge tract and block group codes.
+def create_fictitious_sample(indir='../input_files', app_c_file='../input_files/app_c.csv'):
+    # Read in surname data and take a random draw of 100 individuals for
+    # applicant last name.
 
-tract_vars = ['GEOID10_Tract', 'State_FIPS10', 'County_FIPS10', 'Tract_FIPS10']
-tract = pd.read_stata('../input_files/tract_over18_race_dec10.dta')[tract_vars]
+    app_c = pd.read_csv(app_c_file)
 
-blk_vars = ['GEOID10_BlkGrp', 'State_FIPS10',
-            'County_FIPS10', 'Tract_FIPS10', 'BlkGrp_FIPS10']
-blkgrp = pd.read_stata('../input_files/blkgrp_over18_race_dec10.dta')[blk_vars]
+    seed(1234)
 
-merged_geo = pd.merge(tract, blkgrp, how='left', on=[
-                      'State_FIPS10', 'County_FIPS10', 'Tract_FIPS10'])
+    draw = choice(app_c.shape[0], app_c.shape[0], replace=False)
+    name1 = app_c[draw < 100].name.reset_index(drop=True)
 
-# Remove Puerto Rico
-merged_geo = merged_geo[merged_geo['State_FIPS10'] != '72']
+    # Read in surname data and take a random draw of 25 invididuals for
+    # coapplicant last name.
 
-seed(91011)
-draw = choice(merged_geo.shape[0], merged_geo.shape[0], replace=False)
-geo_sample = merged_geo[draw < 100][['GEOID10_Tract', 'GEOID10_BlkGrp']].reset_index(drop=True)
+    seed(5678)
 
-# ZIP code is not strictly nested within census geography.
-# Draw a random sample of ZIP codes, which likely not correspon to the
-# tract and block groups above.
+    draw = choice(app_c.shape[0], app_c.shape[0], replace=False)
+    name2 = app_c[draw < 25].name.reset_index(drop=True)
 
-zip_df = pd.read_stata('../input_files/zip_over18_race_dec10.dta')
+    # Read in geography data from census geography files, only the columns needed.
 
-# Remove Puerto Rico
-zip_df = zip_df[zip_df['ZCTA5'].apply(
-    lambda x: x[:3] not in ["006", "007", "008", "009"])]
+    # Block groups are nested within tracts, so merge tract and block group codes.
 
-seed(121314)
+    tract_vars = ['GEOID10_Tract', 'State_FIPS10', 'County_FIPS10', 'Tract_FIPS10']
+    tract = census_flat_files.read_flat_file(os.path.join(indir, 'tract_over18_race_dec10.dta'), columns=tract_vars)
 
-draw = choice(zip_df.shape[0], zip_df.shape[0], replace=False)
-zip_sample = zip_df[draw < 100]['ZCTA5'].reset_index(drop=True)
+    blk_vars = ['GEOID10_BlkGrp', 'State_FIPS10',
+                'County_FIPS10', 'Tract_FIPS10', 'BlkGrp_FIPS10']
+    blkgrp = census_flat_files.read_flat_file(os.path.join(indir, 'blkgrp_over18_race_dec10.dta'), columns=blk_vars)
 
-# Randomly assign a fictitious precision value for geocoding
-seed(151617)
+    merged_geo = pd.merge(tract, blkgrp, how='left', on=[
+                          'State_FIPS10', 'County_FIPS10', 'Tract_FIPS10'])
 
+    # Remove Puerto Rico
+    merged_geo = merged_geo[merged_geo['State_FIPS10'] != '72']
 
-def create_geo_code_precision(runi):
-    if runi < 0.90:
-        return "USAStreetAddr"
-    elif runi < 0.95:
-        return "USAStreetName"
-    elif runi < 0.97:
-        return "USAZIP4"
+    seed(91011)
+    draw = choice(merged_geo.shape[0], merged_geo.shape[0], replace=False)
+    geo_sample = merged_geo[draw < 100][['GEOID10_Tract', 'GEOID10_BlkGrp']].reset_index(drop=True)
+
+    # ZIP code is not strictly nested within census geography.
+    # Draw a random sample of ZIP codes, which likely not correspon to the
+    # tract and block groups above.
+
+    zip_df = census_flat_files.read_flat_file(os.path.join(indir, 'zip_over18_race_dec10.dta'), columns=['ZCTA5'])
+
+    # Remove Puerto Rico
+    zip_df = zip_df[zip_df['ZCTA5'].apply(
+        lambda x: x[:3] not in puerto_rico_zips)]
+
+    seed(121314)
+
+    draw = choice(zip_df.shape[0], zip_df.shape[0], replace=False)
+    zip_sample = zip_df[draw < 100]['ZCTA5'].reset_index(drop=True)
+
+    # Randomly assign a fictitious precision value for geocoding
+    seed(151617)
+
+    geo_code_precision = pd.Series(uniform(size=name1.shape[0])).apply(create_geo_code_precision)
+
+    return pd.DataFrame(dict(name1=name1, name2=name2, zip_sample=zip_sample, geo_code_precision=geo_code_precision)).join(geo_sample)
+
+
+def load_sample_sources(indir='../input_files', app_c_file='../input_files/app_c.csv'):
+    # Values to draw from and their probabilities, loaded once however many records are drawn.
+    app_c = pd.read_csv(app_c_file, usecols=['name', 'count'])
+    sources = {'names': app_c['name'].values.astype(str),
+               'name_p': (app_c['count'] / app_c['count'].sum()).values}
+
+    # Block group GEOIDs start with the GEOID of their tract.
+    blkgrp_file = os.path.join(indir, 'blkgrp_over18_race_dec10.dta')
+    if os.path.isfile(blkgrp_file):
+        geo = census_flat_files.read_flat_file(blkgrp_file, columns=['GEOID10_BlkGrp', 'State_FIPS10', 'Total_Pop'])
+        geo['GEOID10_Tract'] = geo['GEOID10_BlkGrp'].str[:11]
     else:
-        return "USAZipcode"
+        logger.info("{} not found, drawing tracts only.".format(blkgrp_file))
+        geo = census_flat_files.read_flat_file(os.path.join(indir, 'tract_over18_race_dec10.dta'), columns=['GEOID10_Tract', 'State_FIPS10', 'Total_Pop'])
+        geo['GEOID10_BlkGrp'] = None
+
+    # Remove Puerto Rico
+    geo = geo[(geo['State_FIPS10'] != '72') & (geo['Total_Pop'] > 0)]
+    sources['geo'] = geo[['GEOID10_Tract', 'GEOID10_BlkGrp']].reset_index(drop=True)
+    sources['geo_p'] = (geo['Total_Pop'] / geo['Total_Pop'].sum()).values
+
+    zip_df = census_flat_files.read_flat_file(os.path.join(indir, 'zip_over18_race_dec10.dta'), columns=['ZCTA5', 'Total_Pop'])
+    zip_df = zip_df[~zip_df['ZCTA5'].str[:3].isin(puerto_rico_zips) & (zip_df['Total_Pop'] > 0)]
+    sources['zips'] = zip_df['ZCTA5'].values.astype(str)
+    sources['zip_p'] = (zip_df['Total_Pop'] / zip_df['Total_Pop'].sum()).values
+
+    return sources
+
+
+def draw_names(sources, n, random_state, hyphen_rate):
+    names = sources['names'][random_state.choice(sources['names'].shape[0], n, p=sources['name_p'])].astype(object)
+    hyphenated = random_state.uniform(size=n) < hyphen_rate
+    second = sources['names'][random_state.choice(sources['names'].shape[0], hyphenated.sum(), p=sources['name_p'])]
+    names[hyphenated] = [first + '-' + last for first, last in zip(names[hyphenated], second)]
+    return names
+
+
+def draw_sample(sources, n, random_state, coapp_rate=0.25, hyphen_rate=0.02, precision_mix=precision_mix):
+    name1 = draw_names(sources, n, random_state, hyphen_rate)
+    name2 = draw_names(sources, n, random_state, hyphen_rate)
+    name2[random_state.uniform(size=n) >= coapp_rate] = None
+
+    geo_sample = sources['geo'].iloc[random_state.choice(sources['geo'].shape[0], n, p=sources['geo_p'])].reset_index(drop=True)
+    zip_sample = sources['zips'][random_state.choice(sources['zips'].shape[0], n, p=sources['zip_p'])]
+
+    precision_values = list(precision_mix)
+    precision_p = np.array([precision_mix[value] for value in precision_values], dtype=np.float64)
+    geo_code_precision = np.array(precision_values, dtype=object)[random_state.choice(len(precision_values), n, p=precision_p / precision_p.sum())]
+
+    return pd.DataFrame(dict(name1=name1, name2=name2, zip_sample=zip_sample, geo_code_precision=geo_code_precision)).join(geo_sample)
+
+
+def create_sample(n, indir='../input_files', app_c_file='../input_files/app_c.csv', random_seed=1234, **kwargs):
+    return draw_sample(load_sample_sources(indir, app_c_file), n, np.random.RandomState(random_seed), **kwargs)
+
+
+def write_sample(path, n, indir='../input_files', app_c_file='../input_files/app_c.csv', random_seed=1234, chunksize=1000000, **kwargs):
+    # Drawn and written chunksize records at a time, so samples larger than memory can be created.
+    sources = load_sample_sources(indir, app_c_file)
+    random_state = np.random.RandomState(random_seed)
+
+    def chunks():
+        for start in range(0, n, chunksize):
+            chunk = draw_sample(sources, min(chunksize, n - start), random_state, **kwargs)
+            chunk.index = pd.RangeIndex(start, start + chunk.shape[0])
+            logger.info("Drew records {:,} to {:,} of {:,}".format(start, start + chunk.shape[0], n))
+            yield chunk
+
+    return storage.write_table_chunks(chunks(), path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create fictitious or synthetic application data.")
+    parser.add_argument('--n', type=int, help="number of synthetic applications; without it the 100-record fictitious sample is created")
+    parser.add_argument('--out', help="output file (the format follows the extension)")
+    parser.add_argument('--indir', default='../input_files')
+    parser.add_argument('--app-c', default='../input_files/app_c.csv')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--coapp-rate', type=float, default=0.25)
+    parser.add_argument('--hyphen-rate', type=float, default=0.02)
+    parser.add_argument('--chunksize', type=int, default=1000000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if args.n is None:
+        sample_data = create_fictitious_sample(args.indir, args.app_c)
+        sample_data.to_pickle(args.out or '../test_output/fictitious_sample_data.pkl')
+        return
 
+    out = args.out or storage.table_file('../test_output', 'synthetic_sample_data_{}'.format(args.n))
+    write_sample(out, args.n, indir=args.indir, app_c_file=args.app_c, random_seed=args.seed, chunksize=args.chunksize,
+                 coapp_rate=args.coapp_rate, hyphen_rate=args.hyphen_rate)
+    logger.info("Wrote {:,} synthetic applications to {}".format(args.n, out))
 
-geo_code_precision = pd.Series(uniform(size=name1.shape[0])).apply(create_geo_code_precision)
 
-sample_data = pd.DataFrame(dict(name1=name1, name2=name2, zip_sample=zip_sample, geo_code_precision=geo_code_precision)).join(geo_sample)
-sample_data.to_pickle('../test_output/fictitious_sample_data.pkl')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
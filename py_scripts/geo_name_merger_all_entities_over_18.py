@@ -12,16 +12,47 @@ geofile() - institution specific geocoded data
 inst_name() - string that is use to create file name for final output dataset
 censusdir() - directory containing prepared input census geography and surname data
 geo_ind_name() - string that identifies the name of the geographic indicator in the loan or individual level analysis data (the program will change the name of the fips variable in the geocoded data to match this in order to merge)
-geo_switch() - string that identifies level of geography used taking the following values: blkgrp, tract, or zip (same values as used in geo creator)"""
+geo_switch() - string that identifies level of geography used taking the following values: blkgrp, tract, or zip (same values as used in geo creator)
+surname_census_match() - geography key in the loan or individual level data, either one list used for every geography or a dict of lists by geo_switch value
+
+compact() - when True, string columns become categoricals and each geography key shares its categories with the census table, so the lookups compare integer codes (see compact_dtypes.py)
+dtype() - np.float32 stores the name and census probabilities and the BISG posteriors in single precision
+memo() - when True, the BISG posterior is computed once for each distinct pair of surname probabilities and census row (see posterior_cache.py)
+cache_dir() - directory of a posterior cache kept from one run to the next; implies memo
+cache_size() - most surname and geography pairs kept in the cache for each geography
+vintage() - census vintage of the prepared geography tables in censusdir (see census_registry.py), dec10 by default
+
+Census tables are indexed by their geography key, and each record picks up its row of geo_pr_* and here_given_* values by
+position, so records keep their order and those whose key is not in the census file are kept with missing probabilities
+and a geo_matched of 0.  The census rows themselves are only used within a run and are not written out.
+
+When geo_switch names more than one geography, the applicant and surname data are loaded and merged once, every geography is
+attached by its own key, and the BISG probabilities for each are written side by side to a single output with
+blkgrp18_, tract18_ and zip18_ prefixed columns."""
 
 import os
+import logging
+import functools
 import pandas as pd
 import numpy as np
 
+import storage
+import bisg_qc
+import compact_dtypes
+import instrumentation
+import posterior_cache
+import census_registry
+
+
+logger = logging.getLogger(__name__)
+
+
+# Census row of a record whose geography key is missing or not in the census file.
+unmatched_row = -1
 
 def merge_geofile_and_readfile_by_matchvars(geofile, readfile, matchvars=[]):
-    geofile = pd.read_pickle(geofile)
-    readfile = pd.read_pickle(readfile)
+    geofile = storage.read_table(geofile)
+    readfile = storage.read_table(readfile)
 
     if not matchvars:
         geofile = geofile.reset_index()
@@ -31,14 +62,33 @@ def merge_geofile_and_readfile_by_matchvars(geofile, readfile, matchvars=[]):
     return geofile.merge(readfile, how='inner', on=matchvars)
 
 
-def load_census_file(censusdir, geo_switch, geo_ind_name):
-    df = pd.read_pickle(os.path.join(censusdir, geo_switch + '_over18_race_dec10.pkl'))
-    df = df.rename(columns={'GeoInd': geo_ind_name})
-    return df
+def load_census_file(censusdir, geo_switch, geo_ind_name, keys=None, vintage=census_registry.default_vintage):
+    # When keys is given, only those geographies are read.
+    return census_registry.load_geography(censusdir, geo_switch, geo_ind_name, file_stem=census_registry.file_stem(vintage), keys=keys)
+
+
+def lookup_geo_rows(census_df, keys):
+    # Row of census_df for each key, or unmatched_row.  Each distinct key (or category) is looked up once and the
+    # rows are broadcast back through its codes, so the hashing is over the census keys rather than every record.
+    keys = pd.Series(keys)
+    if isinstance(keys.dtype, pd.CategoricalDtype):
+        codes, uniques = keys.cat.codes.values, keys.cat.categories
+    else:
+        codes, uniques = pd.factorize(keys.values)
+    # Missing keys have code -1, which picks up the unmatched_row appended at the end.
+    rows_by_code = np.append(census_df.index.get_indexer(uniques), unmatched_row)
+    return rows_by_code[codes]
+
+
+def gather_geo_vars(census_df, geo_vars, rows):
+    # A row of missing values is appended so that unmatched_row (-1) gathers it.
+    values = census_df[geo_vars].values
+    values = np.vstack([values, np.full((1, len(geo_vars)), np.nan, dtype=values.dtype)])
+    return pd.DataFrame(values[rows], columns=geo_vars)
 
 
 def load_orig_data(orig_file_path, matchvars=[]):
-    df = pd.read_pickle(orig_file_path)
+    df = storage.read_table(orig_file_path)
     # for var in matchvars:
     #     if var == 'index':
 
@@ -46,12 +96,12 @@ def load_orig_data(orig_file_path, matchvars=[]):
 
 
 def load_surname_data(surname_file_path, matchvars=[]):
-    df = pd.read_pickle(surname_file_path)
+    df = storage.read_table(surname_file_path)
     for var in matchvars:
         try:
             assert var in list(df)
         except:
-            print("The match variable {} is not present in the surname data.".format(var))
+            logger.info("The match variable {} is not present in the surname data.".format(var))
 
     return df
 
@@ -64,97 +114,257 @@ def rename_post_pr_vars(df):
     return df
 
 
-def create_BISG(df):
-    race_list = ['white', 'black', 'aian', 'api', 'mult_other', 'hispanic']
+def BISG_kernel(name_pr, here_given, dtype=np.float64):
+    # name_pr and here_given are N x 6 arrays in the same race order.  The posterior is built in one output array:
+    # multiply, normalize in place by the row sum, then sum again for prtotal.  Missing values drop out of both sums,
+    # and rows whose sum is 0 come out missing.
+    pr = np.multiply(name_pr, here_given, dtype=dtype)
+    u_sum = np.sum(pr, axis=1, where=~np.isnan(pr))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(pr, u_sum[:, np.newaxis], out=pr)
+    prtotal = np.sum(pr, axis=1, where=~np.isnan(pr))
+    return pr, prtotal
 
-    for race in race_list:
-        df['u_' + race] = df['name_pr_' + race] * df['here_given_' + race]
 
-    df['u_sum'] = np.sum(df[[var for var in list(df) if var.startswith('u_')]], axis=1)
+def create_BISG(df, dtype=np.float64, kernel=BISG_kernel):
+    # dtype=np.float32 halves the memory of the posterior block at the cost of precision.  kernel computes the
+    # posterior from the name_pr and here_given arrays, e.g. memo_kernel.
+    race_list = ['white', 'black', 'aian', 'api', 'mult_other', 'hispanic']
 
-    for race in race_list:
-        df['pr_' + race] = df['u_' + race] / df['u_sum']
+    pr, prtotal = kernel(df[['name_pr_' + race for race in race_list]].values,
+                              df[['here_given_' + race for race in race_list]].values, dtype=dtype)
 
     drop_list = [var for var in list(df) if var.startswith('u_') or var.startswith('here_')]
     df = df.drop(drop_list, axis=1)
 
-    df['prtotal'] = np.sum(df[[var for var in list(df) if var.startswith('pr_')]], axis=1)
+    for i, race in enumerate(race_list):
+        df['pr_' + race] = pr[:, i]
+    df['prtotal'] = prtotal
 
     return df
 
 
-def check_BISG(df):
-    print("Beginning BISG Sanity Checks...")
+def check_BISG(df, sample_size=None, strict=True):
+    # Runs every check in bisg_qc.py and prints the report; with strict, raises once all checks are done if any failed.
+    # sample_size checks only a random sample of that many records.
+    logger.info("Beginning BISG Sanity Checks...")
     race_list = ['white', 'black', 'aian', 'api', 'mult_other', 'hispanic']
 
-    for race in race_list:
-        print("All probabilities should be between 0 and 1.")
-        if not df.ix[df['prtotal'] < 0.99].empty:
-            df = df.ix[df['prtotal'] < 0.99, 'pr_' + race] = np.NaN
+    # Records whose BISG probabilities do not sum to about 1 get no BISG probabilities.
+    df.loc[df['prtotal'] < 0.99, ['pr_' + race for race in race_list]] = np.nan
 
-        print("---Checking name_pr_{}".format(race))
-        assert (((df['name_pr_' + race] >= 0.0) & (df['name_pr_' + race] <= 1.0)) | (df['name_pr_' + race].isnull())).all()
+    report = bisg_qc.check(df, sample_size=sample_size)
+    bisg_qc.print_report(report)
+    if strict and not report['passed']:
+        raise AssertionError("BISG QC failed: " + "; ".join("{}* {}: {:,}".format(result['family'], result['check'], result['violations'])
+                                                         for result in report['checks'] if result['violations']))
 
-        print("---Checking geo_pr_{}".format(race))
-        assert (((df['geo_pr_' + race] >= 0.0) & (df['geo_pr_' + race] <= 1.0)) | (df['geo_pr_' + race].isnull())).all()
+    logger.info("All QC Checks Passed!" if report['passed'] else "QC Checks Failed.")
 
-        print("---Checking pr_{}\n".format(race))
-        assert (((df['pr_' + race] >= 0.0) & (df['pr_' + race] <= 1.0)) | (df['pr_' + race].isnull())).all()
+    return df
 
-    print("Race probabilities should sum to at least 1.")
-    for prob_type in ['name_', 'geo_', '']:
-        print("---Checking sum of probabilities for {}.".format(prob_type + 'pr'))
-        check_type = np.sum(df[[prob_type + 'pr_' + var for var in race_list]], axis=1)
-        assert ((check_type == 0) | ((check_type >= 0.99) & (check_type <= 1.01))).all()
 
-    print("All QC Checks Passed!")
+def get_geo_key(surname_census_match, geo_type):
+    if isinstance(surname_census_match, dict):
+        return surname_census_match[geo_type]
+    return surname_census_match
 
-    return df
+
+def load_merged_surname_data(orig_dir, orig_file, surname_dir, surname_file, orig_surname_match=[], surname_census_match=[]):
+    orig_data = load_orig_data(os.path.join(orig_dir, orig_file), matchvars=orig_surname_match)
+    logger.info("Loaded Original Data {} (Shape: {})".format(orig_file, orig_data.shape))
+
+    surname_data = load_surname_data(os.path.join(surname_dir, surname_file), surname_census_match)
+    logger.info("Loaded Surname Data {} (Shape: {})".format(surname_file, surname_data.shape))
+
+    # Records are joined on orig_surname_match, as in stream_proxy.py; without it, on the row numbers of the original
+    # data that surname_parser.parse keeps as index, since applications without a surname have no surname record.
+    matchvars = orig_surname_match
+    if not matchvars:
+        orig_data = orig_data.reset_index()
+        matchvars = ['index']
+    merged_surname_data = orig_data.merge(surname_data, how='left', on=matchvars)
+    logger.info("Created Merged Surname Data (Shape: {})".format(merged_surname_data.shape))
+
+    return merged_surname_data
+
+
+def memo_kernel(census_df, geo_type, rows, cache=None, record=None):
+    # BISG_kernel computing each distinct pair of surname probabilities and census row once, through cache if given.
+    return functools.partial(posterior_cache.memoized_kernel, kernel=BISG_kernel, rows=rows, geo_keys=census_df.index.values,
+                             cache=cache, geo_type=geo_type, record=record)
+
+
+def create_BISG_by_geo(df, census_df, geo_type, geo_key, prefix, dtype=np.float64, memo=False, cache=None):
+    # Every record keeps its row; records whose key is not in the census file get missing probabilities.
+    name_vars = [var for var in list(df) if var.startswith('name_pr_')]
+    geo_vars = [var for var in list(census_df) if var.startswith('geo_pr_') or var.startswith('here_given_')]
+
+    with instrumentation.stage('geo_name_merger_all_entities_over_18.' + prefix + 'BISG', rows_in=df.shape[0]) as record:
+        rows = lookup_geo_rows(census_df, df[geo_key[0]])
+        logger.info("Looked up Census Data for Surname Data by {} (Matched: {:,} of {:,})".format(
+            geo_type, (rows != unmatched_row).sum(), rows.shape[0]))
+
+        combined = gather_geo_vars(census_df, geo_vars, rows)
+        for var in name_vars:
+            combined[var] = df[var].values
+
+        kernel = memo_kernel(census_df, geo_type, rows, cache=cache, record=record) if memo or cache is not None else BISG_kernel
+        combined = check_BISG(create_BISG(combined, dtype=dtype, kernel=kernel))
+        if record is not None:
+            record.update(rows_out=combined.shape[0], geo_match_rate=instrumentation.share(rows != unmatched_row),
+                          BISG_rate=instrumentation.share(combined['prtotal'].values > 0))
+
+    out_vars = [var for var in list(combined) if var.startswith('pr_') or var.startswith('geo_pr_')] + ['prtotal']
+    output = combined[out_vars].rename(columns={var: prefix + var for var in out_vars})
+    output[prefix + 'geo_matched'] = (rows != unmatched_row) * 1
+    output.index = df.index
+
+    return output
+
+
+def create_BISG_wide(merged_surname_data, census_dfs, geo_switch, surname_census_match=[], dtype=np.float64, memo=False, cache=None):
+    # census_dfs holds the loaded census file for each geography in geo_switch.
+    merged_surname_data = rename_post_pr_vars(merged_surname_data)
+
+    geo_blocks = []
+    for geo_type in geo_switch:
+        geo_blocks.append(create_BISG_by_geo(merged_surname_data, census_dfs[geo_type], geo_type,
+                                             get_geo_key(surname_census_match, geo_type), geo_type + '18_', dtype=dtype, memo=memo, cache=cache))
+
+    return pd.concat([merged_surname_data] + geo_blocks, axis=1)
+
+
+def load_census_files(censusdir, geo_switch, keys={}, vintage=census_registry.default_vintage):
+    # keys optionally holds, by geography, the only geography keys that need to be read.
+    geo_keys = census_registry.geo_key_names(vintage)
+    census_dfs = {}
+    for geo_type in geo_switch:
+        with instrumentation.stage('geo_name_merger_all_entities_over_18.load_census_' + geo_type) as record:
+            census_dfs[geo_type] = load_census_file(censusdir, geo_switch=geo_type, geo_ind_name=geo_keys[geo_type], keys=keys.get(geo_type),
+                                                    vintage=vintage)
+            if record is not None:
+                record['rows_out'] = census_dfs[geo_type].shape[0]
+        logger.info("Loaded Census Data {} (Shape: {})".format(geo_type, census_dfs[geo_type].shape))
+
+    return census_dfs
+
+
+def compact_BISG_inputs(merged_surname_data, census_dfs, geo_switch, surname_census_match=[], dtype=np.float64,
+                        vintage=census_registry.default_vintage):
+    geo_keys = census_registry.geo_key_names(vintage)
+    for geo_type in geo_switch:
+        compact_dtypes.share_categories(merged_surname_data, get_geo_key(surname_census_match, geo_type)[0], census_dfs[geo_type], geo_keys[geo_type])
+        census_dfs[geo_type] = compact_dtypes.compact_frame(census_dfs[geo_type], 'census data ' + geo_type, dtype=dtype,
+                                                            prob_vars=[var for var in list(census_dfs[geo_type]) if var.startswith('geo_pr_') or var.startswith('here')])
+
+    merged_surname_data = compact_dtypes.compact_frame(merged_surname_data, 'merged surname data', dtype=dtype,
+                                                       flag_vars=[var for var in list(merged_surname_data) if var.startswith('namematch_')],
+                                                       prob_vars=[var for var in list(merged_surname_data) if '_pct' in var or var.startswith('post_pr_')])
+
+    return merged_surname_data, census_dfs
+
+
+def create_wide(output, orig_dir, orig_file, surname_dir, surname_file, censusdir, geo_switch,
+                orig_surname_match=[], surname_census_match=[], compact=False, dtype=np.float64, memo=False, cache=None,
+                vintage=census_registry.default_vintage):
+    merged_surname_data = load_merged_surname_data(orig_dir, orig_file, surname_dir, surname_file,
+                                                   orig_surname_match=orig_surname_match,
+                                                   surname_census_match=[var for geo_type in geo_switch for var in get_geo_key(surname_census_match, geo_type)])
+
+    census_dfs = load_census_files(censusdir, geo_switch,
+                                   keys={geo_type: merged_surname_data[get_geo_key(surname_census_match, geo_type)[0]].dropna().unique() for geo_type in geo_switch},
+                                   vintage=vintage)
+
+    if compact:
+        merged_surname_data, census_dfs = compact_BISG_inputs(merged_surname_data, census_dfs, geo_switch, surname_census_match=surname_census_match, dtype=dtype,
+                                                              vintage=vintage)
+
+    final_BISG_data = create_BISG_wide(merged_surname_data, census_dfs, geo_switch, surname_census_match=surname_census_match, dtype=dtype,
+                                       memo=memo, cache=cache)
+    if compact:
+        logger.info("Memory for BISG data: {:,.1f} MB".format(compact_dtypes.memory_mb(final_BISG_data)))
+    logger.info("Created BISG Data for {} (Shape: {})".format(", ".join(geo_switch), final_BISG_data.shape))
+
+    save_data_to_output(output, orig_file, final_BISG_data)
+
+    return final_BISG_data
 
 
 def save_data_to_output(output, orig_data, ds):
     orig_data = orig_data.split('.')[0]
-    ds.to_pickle(os.path.join(output, orig_data + '_BISG.pkl'))
+    with instrumentation.stage('geo_name_merger_all_entities_over_18.write', rows_in=ds.shape[0]):
+        storage.write_table(ds, storage.table_file(output, orig_data + '_BISG'))
+
+
+def save_posterior_cache(cache):
+    logger.info("Posterior cache hit rate: {:.1%}".format(cache.hit_rate() or 0.0))
+    cache.save()
 
 
 def create(output, orig_dir, orig_file, surname_dir, surname_file, censusdir, geo_switch,
-           orig_surname_match=[], surname_census_match=[]):
+           orig_surname_match=[], surname_census_match=[], compact=False, dtype=np.float64, memo=False, cache_dir=None, cache_size=5000000,
+           vintage=census_registry.default_vintage):
+
+    logger.info("\n\n\n")
+    logger.info("************************************************")
+    logger.info("************    Creating BISG Data    **********")
+    logger.info("************************************************")
+    logger.info("\n\n\n")
 
-    print("\n\n\n")
-    print("************************************************")
-    print("************    Creating BISG Data    **********")
-    print("************************************************")
-    print("\n\n\n")
+    cache = posterior_cache.PosteriorCache(cache_dir, censusdir, max_entries=cache_size, vintage=vintage) if cache_dir else None
 
-    geo_dict = {'blkgrp': 'GEOID10_BlkGrp',
-                'tract': 'GEOID10_Tract',
-                'zip': 'ZCTA5'}
+    if len(geo_switch) > 1:
+        final_BISG_data = create_wide(output, orig_dir, orig_file, surname_dir, surname_file, censusdir, geo_switch,
+                                      orig_surname_match=orig_surname_match, surname_census_match=surname_census_match,
+                                      compact=compact, dtype=dtype, memo=memo, cache=cache, vintage=vintage)
+        if cache is not None:
+            save_posterior_cache(cache)
+        return final_BISG_data
 
     for geo_type in geo_switch:
 
-        print("Merging {} with {}".format(geo_type, surname_file))
+        logger.info("Merging {} with {}".format(geo_type, surname_file))
 
-        geo_ind_name = geo_dict[geo_type]
+        geo_ind_name = census_registry.geo_key_names(vintage)[geo_type]
+        geo_key = get_geo_key(surname_census_match, geo_type)
 
-        orig_data = load_orig_data(os.path.join(orig_dir, orig_file), matchvars=orig_surname_match)
-        print("Loaded Original Data {} (Shape: {})".format(orig_file, orig_data.shape))
+        merged_surname_data = load_merged_surname_data(orig_dir, orig_file, surname_dir, surname_file,
+                                                       orig_surname_match=orig_surname_match, surname_census_match=geo_key)
 
-        surname_data = load_surname_data(os.path.join(surname_dir, surname_file), surname_census_match)
-        print("Loaded Surname Data {} (Shape: {})".format(surname_file, surname_data.shape))
+        census_df = load_census_file(censusdir, geo_switch=geo_type, geo_ind_name=geo_ind_name,
+                                     keys=merged_surname_data[geo_key[0]].dropna().unique(), vintage=vintage)
+        logger.info("Loaded Census Data {} (Shape: {})".format(geo_type, census_df.shape))
 
-        merged_surname_data = orig_data.merge(surname_data, how='left', left_index=True, right_index=True)
-        print("Created Merged Surname Data (Shape: {})".format(merged_surname_data.shape))
+        if compact:
+            merged_surname_data, census_dfs = compact_BISG_inputs(merged_surname_data, {geo_type: census_df}, [geo_type],
+                                                                  surname_census_match={geo_type: geo_key}, dtype=dtype, vintage=vintage)
+            census_df = census_dfs[geo_type]
 
-        census_df = load_census_file(censusdir, geo_switch=geo_type, geo_ind_name=geo_dict[geo_type])
-        print("Loaded Census Data {} (Shape: {})".format(geo_type, census_df.shape))
+        with instrumentation.stage('geo_name_merger_all_entities_over_18.' + geo_type + '18_BISG', rows_in=merged_surname_data.shape[0]) as record:
+            rows = lookup_geo_rows(census_df, merged_surname_data[geo_key[0]])
+            census_vars = [var for var in list(census_df) if var != geo_ind_name]
+            census_data = gather_geo_vars(census_df, census_vars, rows)
+            census_data.index = merged_surname_data.index
+            if geo_ind_name not in list(merged_surname_data):
+                census_data.insert(0, geo_ind_name, merged_surname_data[geo_key[0]].where(rows != unmatched_row))
+            census_data['geo_matched'] = (rows != unmatched_row) * 1
 
-        combined_proxy_and_census = census_df.merge(merged_surname_data, how='inner', left_on=geo_ind_name, right_on=surname_census_match)
-        print("Merged Census Data with Surname Data by {} (Shape: {})".format(geo_ind_name, combined_proxy_and_census.shape))
+            combined_proxy_and_census = pd.concat([census_data, merged_surname_data], axis=1)
+            logger.info("Looked up Census Data for Surname Data by {} (Matched: {:,} of {:,})".format(
+                geo_ind_name, (rows != unmatched_row).sum(), rows.shape[0]))
 
-        combined_proxy_and_census = rename_post_pr_vars(combined_proxy_and_census)
+            combined_proxy_and_census = rename_post_pr_vars(combined_proxy_and_census)
 
-        create_BISG_data = create_BISG(combined_proxy_and_census)
+            kernel = memo_kernel(census_df, geo_type, rows, cache=cache, record=record) if memo or cache is not None else BISG_kernel
+            create_BISG_data = create_BISG(combined_proxy_and_census, dtype=dtype, kernel=kernel)
 
-        final_BISG_data = check_BISG(create_BISG_data)
+            final_BISG_data = check_BISG(create_BISG_data)
+            if record is not None:
+                record.update(rows_out=final_BISG_data.shape[0], geo_match_rate=instrumentation.share(rows != unmatched_row),
+                              BISG_rate=instrumentation.share(final_BISG_data['prtotal'].values > 0))
 
         save_data_to_output(output, orig_file, final_BISG_data)
+
+    if cache is not None:
+        save_posterior_cache(cache)
@@ -0,0 +1,264 @@
+"""
+This program keeps the BISG proxies of a portfolio up to date from one run to the next, recomputing only the
+applications that are new or whose proxy inputs changed since the previous run.
+
+Each record is identified by matchvars and fingerprinted by a hash of its applicant surname, coapplicant surname,
+geography keys and geocode precision.  Results are kept in a store, a directory <readfile>_BISG_store in the output
+directory holding one Parquet partition per range of matchvars hashes, with the fingerprint of every record.  On each
+run the fingerprints of readfile are compared with those in the store; new and changed records are carried through
+surname cleaning, the census surname lookup, the geography join, and the BISG computation as in stream_proxy.py, and
+only the partitions holding new, changed or removed records are rewritten.  Only the census geographies of the
+records being recomputed are read.  The whole store is rebuilt when the census tables, the proxy code, or the
+arguments below change.
+
+A partition is replaced in one rename, so a run that stops part way leaves every partition consistent with its
+fingerprints and the next run picks up where it stopped.  read_store puts the partitions back together; records come
+out grouped by partition rather than in the order of readfile.
+
+Input arguments are those of stream_proxy.py, plus:
+
+matchvars - unique record identifier, required: it is how a record is recognised from one run to the next
+geoprecvar - name of the geocode precision variable, fingerprinted and kept in the store for combine_probs.py
+partitions - number of partitions of the store (default 64)
+vintage - census vintage of the prepared geography tables in censusdir (see census_registry.py), dec10 by default
+
+The store holds matchvars, the fingerprinted variables, keepvars, and the surname and BISG variables of
+stream_proxy.py; other variables of readfile are not kept.
+"""
+
+import os
+import logging
+import json
+import numpy as np
+import pandas as pd
+
+import storage
+import build_cache
+import instrumentation
+import surname_creation_lower
+import geo_name_merger_all_entities_over_18
+import stream_proxy
+import census_registry
+
+
+logger = logging.getLogger(__name__)
+
+
+fingerprint_var = 'proxy_fingerprint'
+manifest_name = 'store.json'
+
+# Code that determines the proxies; a change to any of them rebuilds the store.
+code_files = ['surname_creation_lower.py', 'surname_parser.py', 'geo_name_merger_all_entities_over_18.py', 'bisg_qc.py', 'stream_proxy.py']
+
+
+def store_dir(output, readfile):
+    return os.path.join(output, readfile.split('.')[0] + '_BISG_store')
+
+
+def partition_file(store, part):
+    return os.path.join(store, 'part-{:05d}.parquet'.format(part))
+
+
+def partition_files(store):
+    if not os.path.isdir(store):
+        return []
+    return sorted(os.path.join(store, f) for f in os.listdir(store) if f.startswith('part-') and f.endswith('.parquet'))
+
+
+def fingerprint_vars(app_lname, coapp_lname, geo_switch, surname_census_match, geoprecvar=None):
+    geo_keys = [var for geo_type in geo_switch for var in geo_name_merger_all_entities_over_18.get_geo_key(surname_census_match, geo_type)]
+    fp_vars = [app_lname, coapp_lname] + geo_keys + ([geoprecvar] if geoprecvar else [])
+    return [var for i, var in enumerate(fp_vars) if var not in fp_vars[:i]]
+
+
+def fingerprint(df, fp_vars):
+    # One 64-bit hash of the proxy inputs of each record.
+    return pd.util.hash_pandas_object(df[fp_vars], index=False).values
+
+
+def assign_partitions(df, matchvars, partitions):
+    return (pd.util.hash_pandas_object(df[matchvars], index=False).values % np.uint64(partitions)).astype(np.int64)
+
+
+def key_index(df, matchvars):
+    if len(matchvars) > 1:
+        return pd.MultiIndex.from_frame(df[matchvars])
+    return pd.Index(df[matchvars[0]].values)
+
+
+def run_key(censusdir, geo_switch, surname_census_match, matchvars, fp_vars, keepvars, partitions, vintage=census_registry.default_vintage):
+    # The surname and geography indexes are used only while current for these tables, so the tables identify them.
+    census_files = [storage.find_table(censusdir, 'census_surnames_lower')]
+    census_files += [storage.find_table(censusdir, geo_type + census_registry.file_stem(vintage)) for geo_type in geo_switch]
+
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    params = {'code': [build_cache.file_digest(os.path.join(code_dir, f)) for f in code_files],
+              'geo_switch': list(geo_switch), 'surname_census_match': surname_census_match,
+              'matchvars': matchvars, 'fingerprint_vars': fp_vars, 'keepvars': keepvars, 'partitions': partitions}
+    return build_cache.cache_key(census_files, os.path.abspath(__file__), params)
+
+
+def read_manifest(store):
+    try:
+        with open(os.path.join(store, manifest_name)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_manifest(store, key, partitions):
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump({'key': key, 'partitions': partitions}, f)
+
+    build_cache.replace_atomic(write, os.path.join(store, manifest_name))
+
+
+def clear_store(store):
+    for path in partition_files(store):
+        os.remove(path)
+    if os.path.isfile(os.path.join(store, manifest_name)):
+        os.remove(os.path.join(store, manifest_name))
+
+
+def read_partition(store, part, columns=None):
+    path = partition_file(store, part)
+    if not os.path.isfile(path):
+        return None
+    return storage.read_table(path, columns=columns)
+
+
+def read_store(store, columns=None):
+    # Partitions are read one by one and put together, so their column types need not match exactly.
+    parts = [storage.read_table(path, columns=columns) for path in partition_files(store)]
+    if not parts:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(parts, ignore_index=True)
+
+
+def compare_partition(current, stored, matchvars):
+    # Returns the positions in current of new or changed records, a mask of the stored records to keep (those still
+    # in current with the same fingerprint), and the number of stored records no longer in current.
+    if stored is None or stored.shape[0] == 0:
+        return np.arange(current.shape[0]), np.zeros(0, dtype=bool), 0
+
+    stored_rows = key_index(stored, matchvars).get_indexer(key_index(current, matchvars))
+    stored_fingerprints = np.append(stored[fingerprint_var].values, np.uint64(0))
+    changed = (stored_rows == -1) | (stored_fingerprints[stored_rows] != current[fingerprint_var].values)
+
+    keep = np.zeros(stored.shape[0], dtype=bool)
+    keep[stored_rows[~changed]] = True
+    return np.flatnonzero(changed), keep, stored.shape[0] - int((stored_rows >= 0).sum())
+
+
+def write_partition(store, part, df):
+    path = partition_file(store, part)
+    if df.shape[0] == 0:
+        if os.path.isfile(path):
+            os.remove(path)
+        return
+    build_cache.replace_atomic(lambda tmp: storage.write_table(df, tmp), path)
+
+
+def recompute_records(changed, app_lname, coapp_lname, census_index, census_dfs, geo_switch, surname_census_match, matchvars, keepvars=[]):
+    output_chunk = stream_proxy.create_chunk(changed.drop(columns=[fingerprint_var]), app_lname, coapp_lname, census_index, census_dfs,
+                                             geo_switch, surname_census_match, matchvars, keepvars=keepvars)
+    # create_chunk keeps the order of its records.
+    output_chunk[fingerprint_var] = changed[fingerprint_var].values
+    return output_chunk
+
+
+def create(app_lname, coapp_lname, output, readdir, readfile, censusdir, geo_switch, surname_census_match,
+           matchvars, geoprecvar=None, keepvars=[], partitions=64, chunksize=100000, vintage=census_registry.default_vintage):
+
+    logger.info("\n\n\n")
+    logger.info("************************************************")
+    logger.info("******    Updating BISG Data Incrementally    **")
+    logger.info("************************************************")
+    logger.info("\n\n\n")
+
+    if not matchvars:
+        raise ValueError("Incremental runs need matchvars that identify a record from one run to the next.")
+
+    fp_vars = fingerprint_vars(app_lname, coapp_lname, geo_switch, surname_census_match, geoprecvar=geoprecvar)
+    in_vars = matchvars + [var for var in fp_vars + keepvars if var not in matchvars]
+
+    store = store_dir(output, readfile)
+    key = run_key(censusdir, geo_switch, surname_census_match, matchvars, fp_vars, keepvars, partitions, vintage=vintage)
+    if read_manifest(store).get('key') != key:
+        if partition_files(store):
+            logger.info("Census data, proxy code or arguments changed since the last run; rebuilding {}".format(store))
+        clear_store(store)
+        if not os.path.isdir(store):
+            os.makedirs(store)
+        # Written before any partition, so that a run that stops part way keeps the partitions it has written.
+        write_manifest(store, key, partitions)
+
+    input_df = storage.read_table(os.path.join(readdir, readfile), columns=in_vars)
+    if input_df.duplicated(subset=matchvars).any():
+        raise ValueError("matchvars {} do not identify the records of {} uniquely.".format(matchvars, readfile))
+    input_df[fingerprint_var] = fingerprint(input_df, fp_vars)
+    logger.info("Loaded {:,} observations.".format(input_df.shape[0]))
+
+    # Rows of input_df by partition.
+    parts = assign_partitions(input_df, matchvars, partitions)
+    order = np.argsort(parts, kind='stable')
+    bounds = np.searchsorted(parts[order], np.arange(partitions + 1))
+
+    with instrumentation.stage('incremental_proxy.compare', rows_in=input_df.shape[0]) as record:
+        updates = {}
+        n_removed = 0
+        for part in range(partitions):
+            current = input_df.iloc[order[bounds[part]:bounds[part + 1]]]
+            stored = read_partition(store, part, columns=matchvars + [fingerprint_var])
+            changed, keep, removed = compare_partition(current, stored, matchvars)
+            n_removed += removed
+            if changed.shape[0] or not keep.all():
+                updates[part] = (current.iloc[changed], keep)
+
+        n_changed = sum(changed.shape[0] for changed, keep in updates.values())
+        if record is not None:
+            record.update(rows_out=n_changed, removed=int(n_removed), partitions_rewritten=len(updates))
+    logger.info("{:,} new or changed and {:,} removed records in {} of {} partitions.".format(n_changed, n_removed, len(updates), partitions))
+
+    if n_changed:
+        # Only the census geographies of the records being recomputed are read.
+        census_index = surname_creation_lower.load_surname_index(censusdir)
+        keys = {}
+        for geo_type in geo_switch:
+            geo_key = geo_name_merger_all_entities_over_18.get_geo_key(surname_census_match, geo_type)[0]
+            keys[geo_type] = pd.concat([changed[geo_key] for changed, keep in updates.values()]).dropna().unique()
+        census_dfs = geo_name_merger_all_entities_over_18.load_census_files(censusdir, geo_switch, keys=keys, vintage=vintage)
+
+    with instrumentation.stage('incremental_proxy.update', rows_in=n_changed) as record:
+        # The changed records of consecutive partitions are recomputed together, about chunksize at a time, so a few
+        # changes spread over many partitions cost one pass rather than one per partition.
+        batch = []
+        for part in sorted(updates):
+            batch.append(part)
+            if sum(updates[p][0].shape[0] for p in batch) < chunksize and part != max(updates):
+                continue
+
+            changed = pd.concat([updates[p][0] for p in batch])
+            if changed.shape[0]:
+                output_chunk = recompute_records(changed, app_lname, coapp_lname, census_index, census_dfs, geo_switch,
+                                                 surname_census_match, matchvars, keepvars=keepvars)
+
+            start = 0
+            for p in batch:
+                blocks = []
+                n_part, keep = updates[p][0].shape[0], updates[p][1]
+                stored = read_partition(store, p) if keep.any() else None
+                if stored is not None:
+                    blocks.append(stored[keep])
+                if n_part:
+                    blocks.append(output_chunk.iloc[start:start + n_part])
+                    start += n_part
+
+                write_partition(store, p, pd.concat(blocks, ignore_index=True) if blocks else input_df.iloc[:0])
+                logger.info("Rewrote partition {} ({:,} recomputed, {:,} kept)".format(p, n_part, keep.sum()))
+            batch = []
+        if record is not None:
+            record['partitions_rewritten'] = len(updates)
+
+    return store
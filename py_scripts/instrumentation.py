@@ -0,0 +1,103 @@
+"""
+This script records what each stage of the proxy building code sequence did: wall-clock time, CPU time, the growth
+of the peak resident memory of the process, rows in and out, and match rates such as the share of surnames found in
+the census surname list and the share of geography keys found in the census geography files.
+
+Records are dicts passed to every sink added with add_sink.  A sink is any callable taking a record; log_sink and
+JSONLinesSink write them to logging or to a .jsonl file.  With no sink added, stage does nothing but yield None,
+so the instrumented code pays almost nothing.
+
+Usage:
+
+import instrumentation
+instrumentation.add_sink(instrumentation.JSONLinesSink('../test_output/stages.jsonl'))
+"""
+
+import sys
+import json
+import time
+import logging
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+sinks = []
+
+
+def add_sink(sink):
+    sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    sinks.remove(sink)
+
+
+def enabled():
+    return bool(sinks)
+
+
+def log_sink(logger=None, level=logging.INFO):
+    logger = logger or logging.getLogger('bisg')
+
+    def sink(record):
+        logger.log(level, json.dumps(record, sort_keys=True))
+
+    return sink
+
+
+class JSONLinesSink(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2.0 ** 20 if sys.platform == 'darwin' else max_rss / 2.0 ** 10
+
+
+def share(matched):
+    # Share of True values in a boolean array or Series, or None when it is empty.
+    return float(matched.sum()) / len(matched) if len(matched) else None
+
+
+def emit(record):
+    for sink in sinks:
+        sink(record)
+
+
+@contextlib.contextmanager
+def stage(name, rows_in=None):
+    # Yields the record of the stage, for the code inside to add rows_out, match rates, and any other figures, or
+    # None when no sink is added.  The record is passed to the sinks when the stage ends, also when it fails.
+    if not sinks:
+        yield None
+        return
+
+    record = {'stage': name, 'rows_in': rows_in}
+    rss = max_rss_mb()
+    wall = time.time()
+    cpu = time.process_time()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        record['wall_seconds'] = time.time() - wall
+        record['cpu_seconds'] = time.process_time() - cpu
+        record['peak_rss_delta_mb'] = max_rss_mb() - rss if rss is not None else None
+        record['finished'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        emit(record)
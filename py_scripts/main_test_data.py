@@ -4,15 +4,20 @@ This Python script executes a series of Python scripts and subroutines that prep
 This file is set up to execute the proxy building code sequence on a set of ficitious data constructed by create_test_data.py from the publicly available census surname list and geography data. It is provided to illustrate how the main.py is set up to run the proxy building code.
 """
 import os
+import logging
 
 import surname_creation_lower
 import create_attr_over18_all_geo_entities
 import surname_parser
 import geo_name_merger_all_entities_over_18
+import combine_probs
 
 
 def main():
 
+    # The steps report their progress through logging.
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
     # Identify the input directory that contains the individual or application level data containing name and geocodes.
 
     source_dir = "../input_files"
@@ -26,7 +31,7 @@ def main():
     geo_dir = "../input_files/created_python"
 
     # Run the script that prepares the analysis version of the census surname list, including the proportions of individuals by race and ethnicities by surname.
-    census_surnames_lower = surname_creation_lower.create("../input_files/app_c.csv")
+    census_surnames_lower = surname_creation_lower.create("../input_files/app_c.csv", census_surnames_lower_dir=census_data)
 
     create_attr_over18_all_geo_entities.create(source_dir, census_data)
 
@@ -35,7 +40,12 @@ def main():
     # See script for details on arguments that need to be supplied to the program.
     surname_probabilities = surname_parser.parse(matchvars=[], app_lname='name1', coapp_lname='name2', output=out_dir, readdir='../test_output', readfile='fictitious_sample_data.pkl', censusdir=census_data)
 
-    geo_name_merger_all_entities_over_18.create(output=out_dir, orig_dir=out_dir, orig_file='fictitious_sample_data.pkl', surname_dir=out_dir, surname_file='proxy_name.pkl', orig_surname_match=[], surname_census_match=['zip_sample'], censusdir=census_data, geo_switch=['zip'])
+    # Build the block group, tract, and ZIP code BISG proxies side by side; each geography is matched on its own key.
+    geo_name_merger_all_entities_over_18.create(output=out_dir, orig_dir=out_dir, orig_file='fictitious_sample_data.pkl', surname_dir=out_dir, surname_file='proxy_name.parquet', orig_surname_match=[],
+                                                surname_census_match={'blkgrp': ['GEOID10_BlkGrp'], 'tract': ['GEOID10_Tract'], 'zip': ['zip_sample']}, censusdir=census_data, geo_switch=['blkgrp', 'tract', 'zip'])
+
+    # Choose the most precise proxy given the precision of geocoding.
+    combine_probs.create(output=out_dir, bisg_dir=out_dir, bisg_file='fictitious_sample_data_BISG.parquet', geoprecvar='geo_code_precision', matchvars=[])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+"""
+This program builds the BISG proxies on several CPU cores.  The individual or application data are split into
+contiguous row ranges, each range is carried through surname cleaning, the census surname lookup, the geography
+join, and the BISG computation in a worker process, and the results are put back together in the original row order,
+so the output is identical to a serial run.  Each worker loads the census tables once when it starts; the surname
+index is memory-mapped, so the workers share one copy of it.
+
+Workers read their own row range of a Parquet or .csv readfile (see storage.read_rows), so the data are never loaded
+whole in the parent process.  Other formats have to be loaded whole; the parent loads them once and writes each range
+to a temporary Parquet file for its worker.
+
+Input arguments are those of stream_proxy.py, plus:
+
+processes - number of worker processes (defaults to the number of CPU cores)
+shards - number of row ranges to split the data into (defaults to 4 per worker, to even out uneven ranges)
+vintage - census vintage of the prepared geography tables in censusdir (see census_registry.py), dec10 by default
+"""
+
+import os
+import logging
+import shutil
+import tempfile
+import multiprocessing
+import pandas as pd
+
+import storage
+import surname_creation_lower
+import geo_name_merger_all_entities_over_18
+import stream_proxy
+import census_registry
+
+
+logger = logging.getLogger(__name__)
+
+
+# Census tables loaded once per worker process by init_worker.
+worker_census = {}
+
+
+def init_worker(censusdir, geo_switch, vintage=census_registry.default_vintage):
+    worker_census['index'] = surname_creation_lower.load_surname_index(censusdir)
+    worker_census['geo'] = geo_name_merger_all_entities_over_18.load_census_files(censusdir, geo_switch, vintage=vintage)
+
+
+def create_shard(args):
+    # A shard is rows start to stop of path, or the whole of path when start is None.
+    (path, start, stop), app_lname, coapp_lname, geo_switch, surname_census_match, matchvars, keepvars = args
+    shard = storage.read_table(path) if start is None else storage.read_rows(path, start, stop)
+    return stream_proxy.create_chunk(shard, app_lname, coapp_lname, worker_census['index'], worker_census['geo'], geo_switch,
+                                     surname_census_match, matchvars, keepvars=keepvars)
+
+
+def split_bounds(n, shards):
+    bounds = [n * i // shards for i in range(shards + 1)]
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def plan_shards(path, shards, shard_dir):
+    # Returns the number of records and the (path, start, stop) of each shard.
+    path = storage.resolve_table(path)
+    if storage.get_format(path) in ['parquet', 'csv']:
+        n = storage.count_rows(path)
+        return n, [(path, start, stop) for start, stop in split_bounds(n, shards)]
+
+    df = storage.read_table(path)
+    shard_files = []
+    for i, (start, stop) in enumerate(split_bounds(df.shape[0], shards)):
+        shard_files.append((storage.write_table(df.iloc[start:stop], os.path.join(shard_dir, 'shard-{:05d}.parquet'.format(i))), None, None))
+    return df.shape[0], shard_files
+
+
+def create(app_lname, coapp_lname, output, readdir, readfile, censusdir, geo_switch, surname_census_match,
+           processes=None, shards=None, matchvars=[], keepvars=[], vintage=census_registry.default_vintage):
+
+    logger.info("\n\n\n")
+    logger.info("************************************************")
+    logger.info("*******    Creating BISG Data in Parallel    ***")
+    logger.info("************************************************")
+    logger.info("\n\n\n")
+
+    processes = processes or multiprocessing.cpu_count()
+    shards = shards or 4 * processes
+
+    shard_dir = tempfile.mkdtemp(dir=output)
+    try:
+        n, shard_list = plan_shards(os.path.join(readdir, readfile), shards, shard_dir)
+        logger.info("Found {:,} observations; splitting into {} shards over {} processes.".format(n, len(shard_list), processes))
+
+        tasks = [(shard, app_lname, coapp_lname, geo_switch, surname_census_match, matchvars, keepvars) for shard in shard_list]
+
+        pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(censusdir, geo_switch, vintage))
+        try:
+            # map returns results in task order, which puts the rows back in their original order.
+            results = pool.map(create_shard, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+    final_BISG_data = pd.concat(results, ignore_index=True)
+    logger.info("Created BISG Data (Shape: {})".format(final_BISG_data.shape))
+
+    geo_name_merger_all_entities_over_18.save_data_to_output(output, readfile, final_BISG_data)
+
+    return final_BISG_data
@@ -0,0 +1,176 @@
+"""
+This script memoizes the BISG posteriors computed by create_BISG in geo_name_merger_all_entities_over_18.py.  The
+posterior of a record depends only on its surname probabilities (name_pr_*) and its geography (the here_given_* of its
+census row), and (surname, geography) pairs repeat heavily across applications.  memoized_kernel computes each
+distinct pair of a batch once and broadcasts the posteriors back to every record.  Pairs are told apart by their
+exact values, not by a hash, so the result is the same as computing every record.  Finding the distinct pairs costs
+a factorization of every name_pr_* column and the census row, which can take longer than the BISG computation it
+saves: on data where few pairs repeat, the memoized path is slower than computing every record, so memo is worth
+turning on only when the printed share of repeats is high.
+
+A PosteriorCache also keeps the posteriors of pairs from one batch and one run to the next, in a Parquet file for each
+geography in cache_dir.  A file holds at most max_entries pairs; when it would hold more, the pairs least recently used
+are dropped, also from a file saved by a run with a larger max_entries.  Each file records the census table and the
+BISG code it was computed with (see build_cache.py), and is emptied when either changes.
+
+The share of records whose pair repeats another in the batch and the share of distinct pairs found in the cache are
+printed and added to the instrumentation record of the stage.
+
+Usage:
+
+geo_name_merger_all_entities_over_18.create(..., memo=True)
+geo_name_merger_all_entities_over_18.create(..., cache_dir='../test_output/posterior_cache')
+"""
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+import storage
+import build_cache
+import census_registry
+
+
+logger = logging.getLogger(__name__)
+
+
+race_list = ['white', 'black', 'aian', 'api', 'mult_other', 'hispanic']
+name_vars = ['name_pr_' + race for race in race_list]
+pr_vars = ['pr_' + race for race in race_list]
+
+
+def row_codes(columns):
+    # Exact codes of the distinct rows formed by a list of equal-length arrays: each column is factorized and combined
+    # with the codes so far, which stay below the number of rows.  Missing values are a value of their own.
+    codes = np.zeros(len(columns[0]), dtype=np.int64)
+    for column in columns:
+        column_codes, column_uniques = pd.factorize(column, use_na_sentinel=False)
+        codes = pd.factorize(codes * len(column_uniques) + column_codes)[0]
+    return codes
+
+
+def first_rows(codes):
+    # Position of the first record of each code.
+    first = np.empty(codes.max() + 1 if codes.shape[0] else 0, dtype=np.int64)
+    first[codes[::-1]] = np.arange(codes.shape[0])[::-1]
+    return first
+
+
+def most_recent(df, max_entries):
+    # The max_entries most recently used rows of a cache table, in their original order.
+    if df.shape[0] <= max_entries:
+        return df
+    return df.iloc[np.sort(np.argsort(-df['last_used'].values, kind='stable')[:max_entries])]
+
+
+def memoized_kernel(name_pr, here_given, dtype=np.float64, kernel=None, rows=None, geo_keys=None, cache=None, geo_type=None, record=None):
+    # Same output as kernel(name_pr, here_given, dtype).  rows holds the census row of each record (unmatched_row when
+    # there is none) and geo_keys the census key of each row; cache and geo_type are only needed to use a PosteriorCache.
+    codes = row_codes([name_pr[:, i] for i in range(name_pr.shape[1])] + [rows])
+    first = first_rows(codes)
+    pr = np.full((first.shape[0], name_pr.shape[1]), np.nan, dtype=dtype)
+    prtotal = np.zeros(first.shape[0], dtype=dtype)
+
+    todo = np.ones(first.shape[0], dtype=bool)
+    hits = 0
+    if cache is not None:
+        # Records without a census row or surname probabilities get no posterior, so they are not cached.
+        matched = (rows[first] >= 0) & ~np.isnan(name_pr[first]).any(axis=1)
+        found, cached_pr, cached_prtotal = cache.lookup(geo_type, geo_keys[rows[first[matched]]], name_pr[first[matched]])
+        pr[np.flatnonzero(matched)[found]] = cached_pr
+        prtotal[np.flatnonzero(matched)[found]] = cached_prtotal
+        todo[np.flatnonzero(matched)[found]] = False
+        hits = int(found.sum())
+
+    if todo.any():
+        pr[todo], prtotal[todo] = kernel(name_pr[first[todo]], here_given[first[todo]], dtype=dtype)
+        if cache is not None:
+            new = todo & matched
+            cache.add(geo_type, geo_keys[rows[first[new]]], name_pr[first[new]], pr[new], prtotal[new])
+
+    batch_hit_rate = 1.0 - float(first.shape[0]) / codes.shape[0] if codes.shape[0] else None
+    logger.info("   {:,} records, {:,} distinct surname and geography pairs ({:.1%} repeats){}".format(
+        codes.shape[0], first.shape[0], batch_hit_rate or 0.0,
+        ", {:,} found in the cache".format(hits) if cache is not None else ""))
+    if record is not None:
+        record.update(distinct_pairs=int(first.shape[0]), batch_hit_rate=batch_hit_rate,
+                      cache_hit_rate=float(hits) / first.shape[0] if cache is not None and first.shape[0] else None)
+
+    return pr[codes], prtotal[codes]
+
+
+class PosteriorCache(object):
+
+    def __init__(self, cache_dir, censusdir, max_entries=5000000, vintage=census_registry.default_vintage):
+        self.cache_dir = cache_dir
+        self.censusdir = censusdir
+        self.file_stem = census_registry.file_stem(vintage)
+        self.max_entries = max_entries
+        self.tables = {}
+        self.keys = {}
+        self.uses = 0
+        self.hits = 0
+        self.lookups = 0
+
+    def cache_file(self, geo_type):
+        return storage.table_file(self.cache_dir, 'posteriors_' + geo_type + self.file_stem, '.parquet')
+
+    def cache_key(self, geo_type):
+        # The posteriors depend on the census table of the geography and on BISG_kernel.
+        code_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geo_name_merger_all_entities_over_18.py')
+        return build_cache.cache_key([storage.find_table(self.censusdir, geo_type + self.file_stem)], code_file)
+
+    def table(self, geo_type):
+        # Loaded on first use, or started empty when the file is missing or was made from other census data.
+        if geo_type not in self.tables:
+            self.keys[geo_type] = self.cache_key(geo_type)
+            path = self.cache_file(geo_type)
+            if build_cache.is_current(path, self.keys[geo_type]):
+                df = most_recent(storage.read_table(path), self.max_entries)
+                logger.info("Loaded {:,} cached posteriors for {}".format(df.shape[0], geo_type))
+                # Uses go on from the last run, so that entries from earlier runs are the first dropped.
+                if df.shape[0]:
+                    self.uses = max(self.uses, int(df['last_used'].max()))
+            else:
+                df = pd.DataFrame({var: pd.Series(dtype=dtype) for var, dtype in
+                                   [('geo', object)] + [(var, np.float64) for var in name_vars + pr_vars + ['prtotal']] + [('last_used', np.int64)]})
+            df.index = pd.MultiIndex.from_frame(df[['geo'] + name_vars])
+            self.tables[geo_type] = df
+        return self.tables[geo_type]
+
+    def pair_index(self, geo_keys, name_pr):
+        return pd.MultiIndex.from_arrays([np.asarray(geo_keys, dtype=object)] + [name_pr[:, i] for i in range(name_pr.shape[1])])
+
+    def lookup(self, geo_type, geo_keys, name_pr):
+        # Returns which pairs were found and their pr_* and prtotal.
+        df = self.table(geo_type)
+        positions = df.index.get_indexer(self.pair_index(geo_keys, name_pr)) if df.shape[0] else np.full(len(geo_keys), -1)
+        found = positions >= 0
+        self.uses += 1
+        df.iloc[positions[found], df.columns.get_loc('last_used')] = self.uses
+        self.lookups += len(geo_keys)
+        self.hits += int(found.sum())
+        return found, df[pr_vars].values[positions[found]], df['prtotal'].values[positions[found]]
+
+    def add(self, geo_type, geo_keys, name_pr, pr, prtotal):
+        new = pd.DataFrame(name_pr.astype(np.float64), columns=name_vars)
+        new.insert(0, 'geo', np.asarray(geo_keys, dtype=object))
+        for i, var in enumerate(pr_vars):
+            new[var] = pr[:, i].astype(np.float64)
+        new['prtotal'] = prtotal.astype(np.float64)
+        new['last_used'] = self.uses
+        new.index = self.pair_index(geo_keys, name_pr)
+
+        self.tables[geo_type] = most_recent(pd.concat([self.table(geo_type), new]), self.max_entries)
+
+    def hit_rate(self):
+        return float(self.hits) / self.lookups if self.lookups else None
+
+    def save(self):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        for geo_type, df in self.tables.items():
+            df = most_recent(df, self.max_entries)
+            build_cache.write_table(df.reset_index(drop=True), self.cache_file(geo_type), self.keys[geo_type])
+            logger.info("Saved {:,} cached posteriors for {} to {}".format(df.shape[0], geo_type, self.cache_file(geo_type)))
@@ -0,0 +1,276 @@
+"""
+This program runs a small local HTTP service that scores batches of applications with a BISGScorer, so that
+several systems can share one copy of the census tables already in memory instead of each loading them.
+
+Concurrent requests are held for at most max_wait_ms and scored together in batches of up to max_batch
+applications.
+
+Endpoints:
+
+POST /score - a JSON list of records (or {"records": [...]}) or a .csv body with a header row (Content-Type: text/csv).
+              Each record has surname, coapp_surname, precision, and either geoid or any of blkgrp, tract, and zip, each
+              a string or null; a request with any other value is refused with a 400 and does not hold up others.
+              The response holds pr_white, pr_black, pr_aian, pr_api, pr_mult_other, pr_hispanic, and pr_precision
+              for each record, in the same order and format as the request.
+GET /metrics - request, record, and batch counts, mean batch size, throughput, and latency percentiles.
+GET /health - returns ok once the census tables are loaded.
+
+Usage:
+
+python scoring_service.py <censusdir> [--host 127.0.0.1] [--port 8080] [--max-batch 4096] [--max-wait-ms 5] [--verbose]
+
+Only the service's own messages are logged, unless --verbose also logs the progress messages of each batch scored.
+"""
+
+import logging
+import io
+import json
+import time
+import asyncio
+import argparse
+import collections
+import numpy as np
+import pandas as pd
+
+import bisg_scorer
+
+
+logger = logging.getLogger(__name__)
+
+
+geo_types = ['blkgrp', 'tract', 'zip']
+text_vars = ['surname', 'coapp_surname', 'precision'] + geo_types
+
+
+class Metrics(object):
+
+    def __init__(self, window=10000):
+        self.started = time.time()
+        self.requests = 0
+        self.records = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=window)
+
+    def report(self):
+        latencies = np.array(self.latencies) * 1000
+        elapsed = time.time() - self.started
+        report = {'requests': self.requests,
+                  'records': self.records,
+                  'batches': self.batches,
+                  'errors': self.errors,
+                  'mean_batch_size': self.records / self.batches if self.batches else 0,
+                  'records_per_second': self.records / elapsed if elapsed else 0,
+                  'uptime_seconds': elapsed}
+        for q in [50, 90, 99]:
+            report['latency_ms_p{}'.format(q)] = float(np.percentile(latencies, q)) if latencies.size else None
+        return report
+
+
+class MicroBatcher(object):
+    # Collects records from concurrent requests and scores them together.
+
+    def __init__(self, scorer, metrics, max_batch=4096, max_wait_ms=5):
+        self.scorer = scorer
+        self.metrics = metrics
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = asyncio.Queue()
+
+    async def score(self, records):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((records, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            size = len(pending[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                size += len(item[0])
+
+            records = pd.concat([records for records, future in pending], ignore_index=True)
+            try:
+                # Scoring is CPU-bound, so it runs off the event loop while the next batch collects.
+                scores = await loop.run_in_executor(None, score_records, self.scorer, records)
+            except Exception:
+                # The requests are scored again one by one, so that only the one at fault fails.
+                for records, future in pending:
+                    self.metrics.batches += 1
+                    try:
+                        future.set_result(await loop.run_in_executor(None, score_records, self.scorer, records))
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+
+            self.metrics.batches += 1
+            start = 0
+            for records, future in pending:
+                future.set_result(scores.iloc[start:start + len(records)].reset_index(drop=True))
+                start += len(records)
+
+
+def column_values(records, var):
+    if var not in list(records):
+        return np.full(len(records), None, dtype=object)
+    return records[var].astype(object).where(records[var].notnull(), None).values
+
+
+def normalize_records(records):
+    # Every request is put in the same form, with one key column per geography, before it is batched with others, and
+    # a request with fields of the wrong type is turned away on its own.
+    if 'surname' not in list(records) or 'precision' not in list(records):
+        raise ValueError("Records need surname and precision fields.")
+    for var in text_vars + ['geoid']:
+        values = column_values(records, var)
+        bad = np.array([value is not None and not isinstance(value, str) for value in values], dtype=bool)
+        if bad.any():
+            raise ValueError("Field {} of record {} must be a string or null.".format(var, int(np.flatnonzero(bad)[0])))
+
+    output = pd.DataFrame({var: column_values(records, var) for var in text_vars}, dtype=object)
+    if 'geoid' in list(records):
+        # A geography given in its own field is used over the one read from geoid.
+        split = [bisg_scorer.split_geoid(geoid) for geoid in column_values(records, 'geoid')]
+        for geo_type in geo_types:
+            output[geo_type] = pd.Series([key if key is not None else geoid.get(geo_type) for key, geoid in zip(output[geo_type], split)], dtype=object)
+    return output
+
+
+def score_records(scorer, records):
+    geoids = {geo_type: column_values(records, geo_type).tolist() for geo_type in geo_types}
+    return scorer.score_batch(records['surname'], records['coapp_surname'], geoids, column_values(records, 'precision'))
+
+
+def parse_records(body, content_type):
+    if content_type.startswith('text/csv'):
+        # Keys such as GEOIDs and ZIP codes keep their leading zeros.
+        return pd.read_csv(io.BytesIO(body), dtype=str, keep_default_na=False, na_values=[''])
+
+    data = json.loads(body.decode('utf-8'))
+    if isinstance(data, dict):
+        data = data.get('records', [data])
+    return pd.DataFrame(data)
+
+
+def format_scores(scores, content_type):
+    if content_type.startswith('text/csv'):
+        return scores.to_csv(index=False).encode('utf-8'), 'text/csv'
+
+    # Missing probabilities are sent as null, which JSON has and NaN does not.
+    scores = scores.astype(object).where(scores.notnull(), None)
+    return json.dumps(scores.to_dict(orient='records')).encode('utf-8'), 'application/json'
+
+
+async def read_request(reader):
+    request_line = (await reader.readline()).decode('latin-1').strip()
+    if not request_line:
+        return None
+    method, path = request_line.split(' ')[:2]
+
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, value = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, headers, body
+
+
+def write_response(writer, status, body, content_type='application/json'):
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+    writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+        status, reasons[status], content_type, len(body)).encode('latin-1') + body)
+
+
+def json_body(data):
+    return json.dumps(data).encode('utf-8')
+
+
+def create_handler(batcher, metrics):
+
+    async def handle(reader, writer):
+        try:
+            request = await read_request(reader)
+            if request is None:
+                return
+            method, path, headers, body = request
+
+            if method == 'GET' and path == '/health':
+                write_response(writer, 200, json_body({'status': 'ok'}))
+            elif method == 'GET' and path == '/metrics':
+                write_response(writer, 200, json_body(metrics.report()))
+            elif method == 'POST' and path == '/score':
+                start = time.time()
+                content_type = headers.get('content-type', 'application/json')
+                try:
+                    records = normalize_records(parse_records(body, content_type))
+                except ValueError as e:
+                    metrics.errors += 1
+                    write_response(writer, 400, json_body({'error': str(e)}))
+                else:
+                    scores = await batcher.score(records) if len(records) else pd.DataFrame()
+                    response, response_type = format_scores(scores, content_type)
+                    write_response(writer, 200, response, response_type)
+
+                    metrics.requests += 1
+                    metrics.records += len(records)
+                    metrics.latencies.append(time.time() - start)
+            else:
+                write_response(writer, 404, json_body({'error': 'Not found'}))
+        except Exception as e:
+            metrics.errors += 1
+            write_response(writer, 500, json_body({'error': str(e)}))
+        finally:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                # The client went away before reading the response.
+                pass
+            writer.close()
+
+    return handle
+
+
+async def serve(censusdir, host='127.0.0.1', port=8080, max_batch=4096, max_wait_ms=5):
+    logger.info("Loading census tables from {}".format(censusdir))
+    scorer = bisg_scorer.BISGScorer(censusdir)
+    metrics = Metrics()
+    batcher = MicroBatcher(scorer, metrics, max_batch=max_batch, max_wait_ms=max_wait_ms)
+
+    batch_task = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(create_handler(batcher, metrics), host, port)
+    logger.info("Scoring service listening on http://{}:{}".format(host, port))
+    try:
+        await server.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local BISG batch-scoring service.")
+    parser.add_argument('censusdir', help="directory containing prepared census geography and surname data")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch', type=int, default=4096)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    parser.add_argument('--verbose', action='store_true', help="also log the progress messages of the scoring steps")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(message)s')
+    logger.setLevel(logging.INFO)
+
+    asyncio.run(serve(args.censusdir, host=args.host, port=args.port, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+This script reads and writes the tables exchanged between the steps of the proxy building code sequence:
+the prepared census surname and geography files, the surname probabilities, and the BISG output.
+
+The format is chosen by file extension.  Parquet is the default for new files; it can be read back
+one column subset or one set of geography keys at a time, and it is memory-mapped when loaded.
+Feather is also supported, and pickle is kept so that files created by earlier runs can still be read
+(set default_ext to '.pkl' to keep writing them).  Parquet and Feather need pyarrow.
+
+Filters are lists of (column, op, value) tuples, with op one of ==, !=, <, <=, >, >=, in, not in,
+the same form that pyarrow uses to skip Parquet row groups.
+"""
+
+import os
+import pandas as pd
+
+
+formats = {'.parquet': 'parquet', '.feather': 'feather', '.pkl': 'pickle', '.csv': 'csv'}
+default_ext = '.parquet'
+
+
+def table_file(directory, stem, ext=None):
+    return os.path.join(directory, stem + (ext or default_ext))
+
+
+def find_table(directory, stem):
+    # The default format first, then any other format, so that files written by earlier runs are still found.
+    for ext in [default_ext] + [ext for ext in formats if ext != default_ext]:
+        path = table_file(directory, stem, ext)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def resolve_table(path):
+    # A file name given with one extension also finds the same table saved in another format.
+    if os.path.isfile(path):
+        return path
+    stem, ext = os.path.splitext(path)
+    return find_table(os.path.dirname(stem), os.path.basename(stem)) or path
+
+
+def get_format(path):
+    ext = os.path.splitext(path)[1]
+    if ext not in formats:
+        raise ValueError("Unsupported table format {} for {}".format(ext, path))
+    return formats[ext]
+
+
+def apply_filters(df, filters):
+    ops = {'==': lambda col, val: col == val,
+           '!=': lambda col, val: col != val,
+           '<': lambda col, val: col < val,
+           '<=': lambda col, val: col <= val,
+           '>': lambda col, val: col > val,
+           '>=': lambda col, val: col >= val,
+           'in': lambda col, val: col.isin(val),
+           'not in': lambda col, val: ~col.isin(val)}
+
+    for var, op, val in filters or []:
+        df = df[ops[op](df[var], val)]
+    return df
+
+
+def read_table(path, columns=None, filters=None):
+    path = resolve_table(path)
+    table_format = get_format(path)
+
+    if table_format == 'parquet':
+        # Row groups whose statistics rule out the filters are skipped rather than read.
+        return pd.read_parquet(path, columns=columns, filters=filters, memory_map=True)
+
+    # The filtered columns are read as well, since filters may use columns that are not asked for.
+    read_columns = None if columns is None else list(dict.fromkeys(list(columns) + [var for var, op, val in filters or []]))
+    if table_format == 'feather':
+        df = pd.read_feather(path, columns=read_columns)
+    elif table_format == 'csv':
+        df = pd.read_csv(path, usecols=read_columns)
+    else:
+        df = pd.read_pickle(path)
+
+    df = apply_filters(df, filters)
+    return df if columns is None else df[columns]
+
+
+def iter_table(path, chunksize, columns=None):
+    # Yields the table in chunks of at most chunksize rows.  Parquet and .csv files are read one chunk at a time;
+    # other formats have to be loaded whole first.  Chunks from Parquet and .csv files are labelled by row position.
+    path = resolve_table(path)
+    table_format = get_format(path)
+
+    if table_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        start = 0
+        for batch in pq.ParquetFile(path, memory_map=True).iter_batches(batch_size=chunksize, columns=columns):
+            chunk = batch.to_pandas()
+            chunk.index = pd.RangeIndex(start, start + chunk.shape[0])
+            start += chunk.shape[0]
+            yield chunk
+    elif table_format == 'csv':
+        for chunk in pd.read_csv(path, chunksize=chunksize, usecols=columns):
+            yield chunk
+    else:
+        df = read_table(path, columns=columns)
+        for start in range(0, df.shape[0], chunksize):
+            yield df.iloc[start:start + chunksize]
+
+
+def count_rows(path):
+    # Parquet files hold their row count in their metadata; .csv files are counted a chunk at a time.
+    path = resolve_table(path)
+    table_format = get_format(path)
+
+    if table_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        return pq.ParquetFile(path, memory_map=True).metadata.num_rows
+    if table_format == 'csv':
+        return sum(chunk.shape[0] for chunk in pd.read_csv(path, chunksize=1000000, usecols=[0]))
+    return read_table(path).shape[0]
+
+
+def read_rows(path, start, stop, columns=None, batch_size=65536):
+    # Rows start to stop of the table, labelled as in iter_table.  Parquet files are read only from the row groups
+    # holding those rows, a batch at a time, and .csv files are parsed only up to stop.
+    path = resolve_table(path)
+    table_format = get_format(path)
+
+    if table_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        groups, first, position = [], None, 0
+        for i in range(parquet_file.metadata.num_row_groups):
+            group_rows = parquet_file.metadata.row_group(i).num_rows
+            if position < stop and position + group_rows > start:
+                groups.append(i)
+                first = position if first is None else first
+            position += group_rows
+
+        chunks, position = [], first or 0
+        for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=groups, columns=columns):
+            if position + batch.num_rows > start:
+                chunks.append(batch.slice(max(start - position, 0), stop - max(start, position)).to_pandas())
+            position += batch.num_rows
+            if position >= stop:
+                break
+        df = pd.concat(chunks, ignore_index=True) if chunks else read_table(path, columns=columns).iloc[:0]
+    elif table_format == 'csv':
+        df = pd.read_csv(path, skiprows=lambda i: 0 < i <= start, nrows=stop - start, usecols=columns)
+    else:
+        # Other formats have to be loaded whole and keep their row labels, as in iter_table.
+        return read_table(path, columns=columns).iloc[start:stop]
+
+    df.index = pd.RangeIndex(start, start + df.shape[0])
+    return df
+
+
+def write_table(df, path, row_group_size=None):
+    table_format = get_format(path)
+
+    if table_format == 'parquet':
+        df.to_parquet(path, row_group_size=row_group_size)
+    elif table_format == 'feather':
+        df.reset_index(drop=True).to_feather(path)
+    elif table_format == 'csv':
+        df.to_csv(path, index=False)
+    else:
+        df.to_pickle(path)
+
+    return path
+
+
+def write_table_chunks(chunks, path):
+    # Writes DataFrames with the same columns as one table.  Parquet and .csv files are written one chunk at a time,
+    # so the table never has to fit in memory; other formats are put together first.  Chunks take the column types of the first.
+    table_format = get_format(path)
+
+    if table_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, schema=writer.schema if writer else None, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+    elif table_format == 'csv':
+        for i, chunk in enumerate(chunks):
+            chunk.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+    else:
+        write_table(pd.concat(list(chunks)), path)
+
+    return path
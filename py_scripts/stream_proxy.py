@@ -0,0 +1,82 @@
+"""
+This program builds the BISG proxies in bounded-size chunks of applications rather than loading the whole
+individual or application data into memory.  Each chunk is carried through surname cleaning, the census surname
+lookup, the geography join, and the BISG computation, and the result is appended to a .csv file in the output directory.
+
+Input arguments:
+
+app_lname - name of the applicant surname variable
+coapp_lname - name of the coapplicant surname variable
+output - output directory
+readdir - directory containing individual or application data
+readfile - individual or application data file (.parquet and .csv files are read in chunks; other formats have to be loaded whole and are then processed in chunks)
+censusdir - directory containing prepared input census geography and surname data
+geo_switch - list of geographies to build proxies for: blkgrp, tract, or zip
+surname_census_match - geography key in the application data, either one list used for every geography or a dict of lists by geography
+chunksize - number of applications processed at once; peak memory depends on this rather than on the size of readfile
+matchvars - unique record identifier
+keepvars - additional variables to carry through the surname step
+memo, cache_dir, cache_size - memoize the BISG posteriors, within each chunk or across chunks and runs (see posterior_cache.py)
+vintage - census vintage of the prepared geography tables in censusdir (see census_registry.py), dec10 by default
+"""
+
+import os
+import logging
+
+import storage
+import surname_creation_lower
+import surname_parser
+import posterior_cache
+import census_registry
+import geo_name_merger_all_entities_over_18
+
+
+logger = logging.getLogger(__name__)
+
+
+def create_chunk(chunk, app_lname, coapp_lname, census_index, census_dfs, geo_switch, surname_census_match, matchvars, keepvars=[],
+                 memo=False, cache=None):
+    if not matchvars:
+        # Chunks keep the row labels of the full file, so 'index' identifies a record across chunks.
+        chunk = chunk.reset_index()
+        matchvars = ['index']
+
+    surname_probs = surname_parser.create_surname_probs(chunk, app_lname, coapp_lname, census_index, matchvars=matchvars, keepvars=keepvars)
+
+    merged_surname_data = chunk.merge(surname_probs, how='left', on=matchvars)
+
+    return geo_name_merger_all_entities_over_18.create_BISG_wide(merged_surname_data, census_dfs, geo_switch, surname_census_match=surname_census_match,
+                                                                 memo=memo, cache=cache)
+
+
+def create(app_lname, coapp_lname, output, readdir, readfile, censusdir, geo_switch, surname_census_match,
+           chunksize=100000, matchvars=[], keepvars=[], memo=False, cache_dir=None, cache_size=5000000, vintage=census_registry.default_vintage):
+
+    logger.info("\n\n\n")
+    logger.info("************************************************")
+    logger.info("********    Creating BISG Data in Chunks    ****")
+    logger.info("************************************************")
+    logger.info("\n\n\n")
+
+    # The census tables are loaded once and shared by every chunk.
+    census_index = surname_creation_lower.load_surname_index(censusdir)
+    census_dfs = geo_name_merger_all_entities_over_18.load_census_files(censusdir, geo_switch, vintage=vintage)
+    cache = posterior_cache.PosteriorCache(cache_dir, censusdir, max_entries=cache_size, vintage=vintage) if cache_dir else None
+
+    out_file = os.path.join(output, readfile.split('.')[0] + '_BISG.csv')
+    if os.path.isfile(out_file):
+        os.remove(out_file)
+
+    total = 0
+    for i, chunk in enumerate(storage.iter_table(os.path.join(readdir, readfile), chunksize)):
+        output_chunk = create_chunk(chunk, app_lname, coapp_lname, census_index, census_dfs, geo_switch,
+                                    surname_census_match, matchvars, keepvars=keepvars, memo=memo, cache=cache)
+        output_chunk.to_csv(out_file, mode='a', header=(i == 0), index=False)
+
+        total += output_chunk.shape[0]
+        logger.info("Wrote chunk {} ({:,} records, {:,} total) to {}".format(i + 1, output_chunk.shape[0], total, out_file))
+
+    if cache is not None:
+        geo_name_merger_all_entities_over_18.save_posterior_cache(cache)
+
+    return out_file
@@ -4,49 +4,123 @@ including the proportions of individuals by race and ethnicity by surname.
 """
 
 import os
+import logging
 import numpy as np
 import pandas as pd
 
+import storage
+import build_cache
+import instrumentation
 
-def create(in_csv):
-    census_surnames_lower_file = '../input_files/created_python/census_surnames_lower.pkl'
-    if not os.path.isfile(census_surnames_lower_file):
 
-        raw_in = pd.read_csv(in_csv)
-        print("Loaded DataFrame {} of length {:,} and columns: {}".format(in_csv, raw_in.shape[0], list(raw_in.columns)))
+logger = logging.getLogger(__name__)
 
-        output = raw_in.copy()
 
-        print(raw_in['name'].iloc[:5])
-        output['name'] = output['name'].apply(lambda x: str(x).lower())
-        print(output['name'].iloc[:5])
+class_vars = ['pctwhite', 'pctblack', 'pctapi', 'pctaian', 'pct2prace', 'pcthispanic']
+index_names_file = 'census_surnames_lower_names.npy'
+index_probs_file = 'census_surnames_lower_probs.npy'
 
-        class_vars = ['pctwhite', 'pctblack', 'pctapi', 'pctaian', 'pct2prace', 'pcthispanic']
 
-        print(output[class_vars].iloc[:5])
+def build_surname_index(df):
+    # Sorted name table plus a contiguous float matrix of the class_vars in the same row order,
+    # so a surname resolves to a row offset with a binary search.
+    names = np.array(df['name'].values, dtype=str)
+    order = np.argsort(names, kind='stable')
+    probs = np.ascontiguousarray(df[class_vars].values[order], dtype=np.float64)
+    return names[order], probs
 
-        def convert_to_decimal(x):
-            try:
-                return float(x) / 100
-            except:
-                return None
 
-        output[class_vars] = output[class_vars].applymap(convert_to_decimal)
+def surname_index_files(outdir):
+    return [os.path.join(outdir, index_names_file), os.path.join(outdir, index_probs_file)]
 
-        def replace_missing_pcts(x):
-            count_miss = np.sum(x.isnull())
-            remaining = 1 - np.sum(x)
-            replacement = remaining / count_miss
-            x[x.isnull()] = replacement
-            return x
 
-        print(output[class_vars].iloc[151669, :])
-        output[class_vars] = output[class_vars].apply(replace_missing_pcts, axis=1)
-        print(output[class_vars].iloc[151669, :])
+def write_surname_index(df, table_path):
+    # Written after the census_surnames_lower table at table_path, and current only while that table is.
+    outdir = os.path.dirname(table_path)
+    build_cache.write_index(list(zip(surname_index_files(outdir), build_surname_index(df))), table_path)
+    logger.info("Wrote surname index of {:,} names to {}".format(df.shape[0], outdir))
 
-        output.to_pickle(census_surnames_lower_file)
-    else:
-        print("Loading {}".format(census_surnames_lower_file))
-        output = pd.read_pickle(census_surnames_lower_file)
+
+def load_surname_index(censusdir):
+    # The index files are memory-mapped, so worker processes reading the same censusdir share one copy.
+    table_path = storage.find_table(censusdir, 'census_surnames_lower')
+    if table_path is None:
+        raise IOError("No census_surnames_lower table in {}".format(censusdir))
+
+    names_file, probs_file = surname_index_files(censusdir)
+    if build_cache.index_current([names_file, probs_file], table_path):
+        return np.load(names_file, mmap_mode='r'), np.load(probs_file, mmap_mode='r')
+
+    logger.info("No current surname index in {}, building it from {}".format(censusdir, table_path))
+    return build_surname_index(storage.read_table(table_path, columns=['name'] + class_vars))
+
+
+def lookup_surname_index(index, names):
+    # Returns an array of class_vars probabilities for each name, NaN where the name is missing or not in the index.
+    index_names, index_probs = index
+    output = np.full((len(names), len(class_vars)), np.nan)
+
+    names = pd.Series(names)
+    present = names.notnull().values
+    if not present.any() or index_names.shape[0] == 0:
+        return output
+
+    query = np.array(names[present].values, dtype=str)
+    pos = np.searchsorted(index_names, query).clip(max=index_names.shape[0] - 1)
+    found = index_names[pos] == query
+
+    rows = np.flatnonzero(present)[found]
+    output[rows] = index_probs[pos[found]]
+    return output
+
+
+def create_surname_table(in_csv):
+    raw_in = pd.read_csv(in_csv)
+    logger.info("Loaded DataFrame {} of length {:,} and columns: {}".format(in_csv, raw_in.shape[0], list(raw_in.columns)))
+
+    output = raw_in.copy()
+
+    logger.info(raw_in['name'].iloc[:5])
+    # Names read as missing (such as NULL) are kept as 'nan', as str() gives.
+    output['name'] = pd.Series(np.asarray(output['name'].values, dtype=object).astype(str), index=output.index).str.lower()
+    logger.info(output['name'].iloc[:5])
+
+    logger.info(output[class_vars].iloc[:5])
+
+    # Formats the values in the Census data as proportions; suppressed values ("(S)") become missing.
+    pcts = output[class_vars].apply(pd.to_numeric, errors='coerce') / 100
+
+    # Missing shares split the rest of the surname's mass equally.
+    missing = pcts.isnull()
+    replacement = (1 - pcts.sum(axis=1)) / missing.sum(axis=1)
+
+    logger.info(pcts[missing.any(axis=1)].head())
+    output[class_vars] = pcts.mask(missing, np.broadcast_to(replacement.values[:, np.newaxis], pcts.shape))
+    logger.info(output.loc[missing.any(axis=1), class_vars].head())
+
+    return output
+
+
+def create(in_csv, census_surnames_lower_dir='../input_files/created_python'):
+    census_surnames_lower_file = storage.table_file(census_surnames_lower_dir, 'census_surnames_lower')
+
+    # Rebuild only when the surname list or this script changes.
+    key = build_cache.cache_key([in_csv], os.path.abspath(__file__))
+
+    with build_cache.lock(census_surnames_lower_file), instrumentation.stage('surname_creation_lower.create') as record:
+        rebuilt = not build_cache.is_current(census_surnames_lower_file, key)
+        if rebuilt:
+            output = create_surname_table(in_csv)
+            build_cache.write_table(output, census_surnames_lower_file, key)
+            write_surname_index(output, census_surnames_lower_file)
+        else:
+            logger.info("Loading {}".format(census_surnames_lower_file))
+            output = storage.read_table(census_surnames_lower_file)
+
+            if not build_cache.index_current(surname_index_files(census_surnames_lower_dir), census_surnames_lower_file):
+                write_surname_index(output, census_surnames_lower_file)
+
+        if record is not None:
+            record.update(rows_out=output.shape[0], rebuilt=rebuilt)
 
     return output
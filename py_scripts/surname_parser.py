@@ -1,12 +1,21 @@
 import os
+import logging
 import re
 import itertools
 import pandas as pd
 import numpy as np
 
+import storage
+import compact_dtypes
+import instrumentation
+import surname_creation_lower
+
+
+logger = logging.getLogger(__name__)
+
 
 def read_input_data(readdir, readfile):
-    return pd.read_pickle(os.path.join(readdir, readfile))
+    return storage.read_table(os.path.join(readdir, readfile))
 
 
 def create_record_for_coapps(df, coapp_lname, matchvars=[], keepvars=[]):
@@ -27,49 +36,69 @@ def drop_apps_without_lname(df, app_lname, matchvars=[], keepvars=[]):
     return output
 
 
-def clean_last_names(df):
-    assert 'lname' in list(df)
-    df['lname'] = df['lname'].apply(lambda x: " " + x.lower() + " ")
+# Name cleaning patterns, applied in this order by clean_lname.
+# Remove common non-letter, non-hyphen characters with spaces.
+NO_SPECIAL_CHARS = re.compile(r'[`\{}\,.0-9"]')
+# Remove apostrophes without replacement.
+NO_APOSTROPHES = re.compile("[']")
+# Any lone letters in lname are most likely initials (in most cases, middle initials); remove them.
+SINGLE_LETTER = re.compile(" [a-z] ")
+# Remove common suffixes with spaces.
+SUFFIXES = re.compile(" jr | sr | ii | iii | iv | dds | md | phd ")
+# Separates names when a whole column is cleaned as one string; none of the patterns above can match across it.
+NAME_SEP = "\x00"
 
-    # Remove common non-letter, non-hyphen characters with spaces.
-    no_special_chars = re.compile("[\`\{}\\,.0-9\"]")
-    df['lname'] = df['lname'].apply(lambda x: no_special_chars.sub(" ", x))
 
-    # Remove apostrophes without replacement.
-    no_apostrophes = re.compile("[']")
-    df['lname'] = df['lname'].apply(lambda x: no_apostrophes.sub("", x))
+CENSUS_KEEPS = ['pctwhite', 'pctblack', 'pctapi', 'pctaian', 'pcthispanic', 'pct2prace']
 
-    #  Any lone letters in lname are most likely initials (in most cases, middle initials); remove them.
-    single_letter = re.compile(" [a-z] ")
-    df['lname'] = df['lname'].apply(lambda x: single_letter.sub("", x))
 
-    # Remove common suffixes with spaces.
-    suffixes = re.compile(" jr | sr | ii | iii | iv | dds | md | phd ")
-    df['lname'] = df['lname'].apply(lambda x: suffixes.sub(" ", x))
+def clean_lname(x):
+    x = " " + x.lower() + " "
+    x = NO_SPECIAL_CHARS.sub(" ", x)
+    x = NO_APOSTROPHES.sub("", x)
+    x = SINGLE_LETTER.sub("", x)
+    x = SUFFIXES.sub(" ", x)
 
     # Remove all spaces.
-    single_space = re.compile("[ ]")
-    df['lname'] = df['lname'].apply(lambda x: single_space.sub("", x))
-    print("3. Cleaned lname in.")
+    return x.replace(" ", "")
+
+
+def clean_lnames(names):
+    # Clean a whole column of names at once by running each pattern over a single joined string,
+    # so the regex engine does the per-name work instead of the interpreter.
+    names = list(names)
+    if not names:
+        return []
+    if any(NAME_SEP in x for x in names):
+        return [clean_lname(x) for x in names]
+
+    return clean_lname((" " + NAME_SEP + " ").join(names)).split(NAME_SEP)
 
-    # Split hyphenated last names, then match race separately on each part.
 
-    def min_split(x, splitter, min_len):
-        out = x.split(splitter)
-        if len(out) < min_len:
-            out.append(np.NaN)
-            return out
-        else:
-            return out
+def split_hyphenated_lname(x):
+    parts = x.split('-')
+    if len(parts) < 2:
+        return parts[0], np.nan
+    return parts[0], parts[1]
 
-    df[['lname1', 'lname2']] = df['lname'].apply(lambda x: pd.Series(min_split(x, '-', 2)))
-    print("4. Processed hyphens in.")
+
+def clean_last_names(df):
+    assert 'lname' in list(df)
+
+    df['lname'] = clean_lnames(df['lname'].values)
+    logger.info("3. Cleaned lname in.")
+
+    # Split hyphenated last names, then match race separately on each part.
+    split = [split_hyphenated_lname(x) for x in df['lname'].values]
+    df['lname1'] = [x[0] for x in split]
+    df['lname2'] = [x[1] for x in split]
+    logger.info("4. Processed hyphens in.")
 
     return df
 
 
 def create_race_probs_by_person(df, census, matchvars=[], keepvars=[]):
-    census_keeps = ['pctwhite', 'pctblack', 'pctapi', 'pctaian', 'pcthispanic', 'pct2prace']
+    census_keeps = CENSUS_KEEPS
 
     for i in ['1', '2']:
         df = df.merge(census, how='left', left_on='lname' + i, right_on='name')
@@ -84,6 +113,73 @@ def create_race_probs_by_person(df, census, matchvars=[], keepvars=[]):
     return df[out_vars]
 
 
+def create_race_probs_by_unique_name(df, census_index, matchvars=[], keepvars=[]):
+    # Same output as clean_last_names followed by create_race_probs_by_person, but each distinct raw lname is
+    # cleaned and looked up once and the results are broadcast back to the rows through the factorized codes.
+    # census_index is the sorted name table and probability matrix from surname_creation_lower.load_surname_index.
+    assert 'lname' in list(df)
+    codes, uniques = pd.factorize(df['lname'])
+    logger.info("   Found {:,} distinct surnames in {:,} records.".format(len(uniques), len(codes)))
+
+    names = clean_last_names(pd.DataFrame({'lname': uniques}))
+
+    output = df[matchvars + ['appl_coapp_cd_enum'] + keepvars].reset_index(drop=True)
+    for i in ['1', '2']:
+        output['lname' + i] = names['lname' + i].values[codes]
+        probs = surname_creation_lower.lookup_surname_index(census_index, names['lname' + i].values)
+        for j, pct in enumerate(surname_creation_lower.class_vars):
+            output[pct + i] = probs[codes, j]
+
+    out_vars = matchvars + ['appl_coapp_cd_enum'] + \
+        [('').join(x) for x in itertools.product(['lname'] + CENSUS_KEEPS, ['1', '2'])] + \
+        keepvars
+
+    logger.info("5. Matched race probabilities in.")
+
+    return output[out_vars]
+
+
+def create_race_probs_wide(df, app_lname, coapp_lname, census_index, matchvars=[], keepvars=[]):
+    # Same output as create_race_probs_by_unique_name followed by create_reshaped_race_probs_by_app, built one row per
+    # application: the applicant and coapplicant surname columns are cleaned and looked up side by side and the a_ and
+    # c_ columns are filled directly, without stacking the two into one long frame and merging them back on matchvars.
+    apps = df[df[app_lname].notnull()]
+    coapp_present = apps[coapp_lname].notnull().values
+
+    # Each distinct raw surname in either column is cleaned and looked up once; code -1 (no coapplicant) picks up the
+    # missing row appended at the end.
+    codes, uniques = pd.factorize(pd.concat([apps[app_lname], apps[coapp_lname]], ignore_index=True))
+    logger.info("   Found {:,} distinct surnames in {:,} applications.".format(len(uniques), apps.shape[0]))
+    names = clean_last_names(pd.DataFrame({'lname': uniques}))
+
+    unique_lnames = {}
+    unique_probs = {}
+    for i in ['1', '2']:
+        unique_lnames[i] = np.append(names['lname' + i].values, np.nan)
+        unique_probs[i] = np.vstack([surname_creation_lower.lookup_surname_index(census_index, names['lname' + i].values),
+                                     np.full((1, len(surname_creation_lower.class_vars)), np.nan)])
+
+    # The columns are collected first and the frame is built once.
+    columns = {}
+    for k, k_codes in [('a', codes[:apps.shape[0]]), ('c', codes[apps.shape[0]:])]:
+        for var in ['lname'] + CENSUS_KEEPS:
+            for i in ['1', '2']:
+                if var == 'lname':
+                    columns[k + '_' + var + i] = unique_lnames[i][k_codes]
+                else:
+                    columns[k + '_' + var + i] = unique_probs[i][k_codes, surname_creation_lower.class_vars.index(var)]
+
+        for var in keepvars:
+            columns[k + '_' + var] = apps[var].values if k == 'a' else apps[var].where(coapp_present).values
+
+    output = pd.concat([apps[matchvars].reset_index(drop=True), pd.DataFrame(columns)], axis=1)
+
+    logger.info("5. Matched race probabilities in.")
+    logger.info('6. Reorganized data in.')
+
+    return output
+
+
 def create_reshaped_race_probs_by_app(df, matchvars=[], keepvars=[]):
     assert 'appl_coapp_cd_enum' in list(df)
 
@@ -100,7 +196,7 @@ def create_reshaped_race_probs_by_app(df, matchvars=[], keepvars=[]):
     apps = subset_by_appl_cd(df, 'A')
 
     output = apps.merge(coapps, how='left', on=matchvars)
-    print('6. Reorganized data in.')
+    logger.info('6. Reorganized data in.')
 
     return output
 
@@ -110,89 +206,127 @@ def create_name_match_variables(df):
         for i in ['1', '2']:
             df['namematch_' + k + i] = df[k + '_pctwhite' + i].notnull() * 1
 
-    def create_namematch_any(x):
-
-        if x['c_lname2'] in list(x[['a_lname1', 'a_lname2', 'c_lname1']]):
-            x['namematch_c2'] = 0
-
-        if x['c_lname1'] in list(x[['a_lname1', 'a_lname2']]):
-            x['namematch_c1'] = 0
-
-        if x['a_lname2'] in list(x[['a_lname1']]):
-            x['namematch_a2'] = 0
-
-        x['namematch_any'] = x[['namematch_a1', 'namematch_a2', 'namematch_c1', 'namematch_c2']].max()
+    # A name that repeats an earlier name on the application adds no information; comparisons with a missing
+    # name are False, and a missing name is never matched to begin with.
+    df.loc[df['c_lname2'].eq(df['a_lname1']) | df['c_lname2'].eq(df['a_lname2']) | df['c_lname2'].eq(df['c_lname1']), 'namematch_c2'] = 0
+    df.loc[df['c_lname1'].eq(df['a_lname1']) | df['c_lname1'].eq(df['a_lname2']), 'namematch_c1'] = 0
+    df.loc[df['a_lname2'].eq(df['a_lname1']), 'namematch_a2'] = 0
 
-        return x
+    df['namematch_any'] = df[['namematch_a1', 'namematch_a2', 'namematch_c1', 'namematch_c2']].max(axis=1)
 
-    df = df.apply(lambda x: create_namematch_any(x), axis=1)
-
-    def replace_nomatch_pct_with_zero(x):
-
-        races = ['hispanic', 'white', 'black', 'api', 'aian', '2prace']
-        for k in ['a', 'c']:
-            for i in ['1', '2']:
-                if x['namematch_' + k + i] == 0:
-                    for race in races:
-                        x[k + '_pct' + race + i] = 0
-
-        return x
-
-    df = df.apply(lambda x: replace_nomatch_pct_with_zero(x), axis=1)
+    races = ['hispanic', 'white', 'black', 'api', 'aian', '2prace']
+    for k in ['a', 'c']:
+        for i in ['1', '2']:
+            df.loc[df['namematch_' + k + i] == 0, [k + '_pct' + race + i for race in races]] = 0
 
-    print("7. Set up namematch variables.")
+    logger.info("7. Set up namematch variables.")
     return df
 
 
 def populate_final_surname_probs(df):
     races = ['hispanic', 'white', 'black', 'api', 'aian', '2prace']
+    # The first matched name of a1, a2, c1, c2 gives the probability; a later name only fills a probability still missing.
+    matched = {k: (df['namematch_' + k] == 1).values for k in ['a1', 'a2', 'c1', 'c2']}
     for race in races:
-        df.ix[df['namematch_a1'] == 1, 'post_pr_' + race] = df['a_pct' + race + '1']
-        df.ix[(df['namematch_a2'] == 1) & (df['post_pr_' + race].isnull()), 'post_pr_' + race] = df['a_pct' + race + '2']
-        df.ix[(df['namematch_c1'] == 1) & (df['post_pr_' + race].isnull()), 'post_pr_' + race] = df['c_pct' + race + '1']
-        df.ix[(df['namematch_c2'] == 1) & (df['post_pr_' + race].isnull()), 'post_pr_' + race] = df['c_pct' + race + '2']
-
-    print("8. Populated final surname probability based on availability of applicant and coapplicant name")
+        pcts = [df[k[0] + '_pct' + race + k[1]].values for k in ['a1', 'a2', 'c1', 'c2']]
+        post_pr = df['post_pr_' + race].values if 'post_pr_' + race in list(df) else np.full(df.shape[0], np.nan, dtype=np.result_type(*pcts))
+        post_pr = np.where(matched['a1'], pcts[0], post_pr)
+        for i, k in enumerate(['a2', 'c1', 'c2']):
+            post_pr = np.where(matched[k] & np.isnan(post_pr), pcts[i + 1], post_pr)
+        df['post_pr_' + race] = post_pr
+
+    logger.info("8. Populated final surname probability based on availability of applicant and coapplicant name")
     return df
 
 
-def parse(app_lname, coapp_lname, output, readdir, readfile, censusdir, matchvars=[], keepvars=[]):
-    print("1. Read files in.")
-    input_df = read_input_data(readdir, readfile)
-    print("   Loaded {:,} observations.".format(input_df.shape[0]))
+def create_reshaped_race_probs_long(input_df, app_lname, coapp_lname, census_index, matchvars, keepvars=[]):
+    # Generate a DataFrame of coapplicants
+    logger.info("2. Reformatted data.")
+    with instrumentation.stage('surname_parser.combine_applicants', rows_in=input_df.shape[0]) as record:
+        coapp_df = create_record_for_coapps(input_df, coapp_lname, matchvars=matchvars, keepvars=keepvars)
+
+        # Drop all rows without surnames and combine with coapplicant data
+        app_df = drop_apps_without_lname(input_df, app_lname, matchvars=matchvars, keepvars=keepvars)
+        combined_data = pd.concat([app_df, coapp_df])
+        if record is not None:
+            record.update(rows_out=combined_data.shape[0], applicants=app_df.shape[0], coapplicants=coapp_df.shape[0])
+
+    # Clean and match each distinct surname once, then broadcast back to every applicant and coapplicant record.
+    with instrumentation.stage('surname_parser.create_race_probs', rows_in=combined_data.shape[0]) as record:
+        race_probs_by_person = create_race_probs_by_unique_name(combined_data, census_index, matchvars=matchvars, keepvars=keepvars)
+        if record is not None:
+            record.update(rows_out=race_probs_by_person.shape[0],
+                          distinct_surnames=int(race_probs_by_person['lname1'].nunique()),
+                          lname1_match_rate=instrumentation.share(race_probs_by_person['pctwhite1'].notnull()),
+                          lname2_match_rate=instrumentation.share(race_probs_by_person['pctwhite2'][race_probs_by_person['lname2'].notnull()].notnull()))
+
+    with instrumentation.stage('surname_parser.reshape_by_app', rows_in=race_probs_by_person.shape[0]) as record:
+        reshaped_race_probs_by_app = create_reshaped_race_probs_by_app(race_probs_by_person, matchvars=matchvars, keepvars=keepvars)
+        if record is not None:
+            record['rows_out'] = reshaped_race_probs_by_app.shape[0]
+
+    return reshaped_race_probs_by_app
+
+
+def create_surname_probs(input_df, app_lname, coapp_lname, census_index, matchvars, keepvars=[], compact=False, dtype=np.float64, wide=True):
+    # wide=False stacks applicants and coapplicants into one long frame and merges them back into one row per
+    # application, as the original code did; the output is the same.
+    if wide:
+        logger.info("2. Reformatted data.")
+        with instrumentation.stage('surname_parser.create_race_probs_wide', rows_in=input_df.shape[0]) as record:
+            reshaped_race_probs_by_app = create_race_probs_wide(input_df, app_lname, coapp_lname, census_index, matchvars=matchvars, keepvars=keepvars)
+            if record is not None:
+                record.update(rows_out=reshaped_race_probs_by_app.shape[0],
+                              a_lname1_match_rate=instrumentation.share(reshaped_race_probs_by_app['a_pctwhite1'].notnull()),
+                              c_lname1_match_rate=instrumentation.share(reshaped_race_probs_by_app['c_pctwhite1'][reshaped_race_probs_by_app['c_lname1'].notnull()].notnull()))
+    else:
+        reshaped_race_probs_by_app = create_reshaped_race_probs_long(input_df, app_lname, coapp_lname, census_index, matchvars=matchvars, keepvars=keepvars)
 
-    if not matchvars:
-        input_df = input_df.reset_index()
-        matchvars = ['index']
+    # Each namematch variable is set to 1 if we matched the given name to the Census file and the name is not a duplicate of a previous name on the application.
+    # If the joint applicants share a name, this name is not providing new information (it is likely a family member), and all additional instances of
+    # the name should be discarded.
 
-    # Generate a DataFrame of coapplicants
-    print("2. Reformatted data.")
-    coapp_df = create_record_for_coapps(input_df, coapp_lname, matchvars=matchvars, keepvars=keepvars)
+    with instrumentation.stage('surname_parser.name_match', rows_in=reshaped_race_probs_by_app.shape[0]) as record:
+        match_tagged_data = create_name_match_variables(reshaped_race_probs_by_app)
 
-    # Drop all rows without surnames and combine with coapplicant data
-    app_df = drop_apps_without_lname(input_df, app_lname, matchvars=matchvars, keepvars=keepvars)
-    combined_data = pd.concat([app_df, coapp_df])
+        # Denominator below should be approximately equal to 1. It is added to reduce rounding errors.
+        final_surname_probs = populate_final_surname_probs(match_tagged_data)
+        if record is not None:
+            record.update(rows_out=final_surname_probs.shape[0],
+                          name_match_rate=instrumentation.share(final_surname_probs['namematch_any'] == 1))
 
-    clean_data = clean_last_names(combined_data)
+    if compact:
+        final_surname_probs = compact_dtypes.compact_frame(final_surname_probs, 'surname probabilities',
+                                                           flag_vars=[var for var in list(final_surname_probs) if var.startswith('namematch_')],
+                                                           prob_vars=[var for var in list(final_surname_probs) if '_pct' in var or var.startswith('post_pr_')],
+                                                           dtype=dtype)
 
-    # Load census data
-    census_df = pd.read_pickle(os.path.join(censusdir, 'census_surnames_lower.pkl'))
+    return final_surname_probs
 
-    race_probs_by_person = create_race_probs_by_person(clean_data, census_df, matchvars=matchvars, keepvars=keepvars)
 
-    reshaped_race_probs_by_app = create_reshaped_race_probs_by_app(race_probs_by_person, matchvars=matchvars, keepvars=keepvars)
+def parse(app_lname, coapp_lname, output, readdir, readfile, censusdir, matchvars=[], keepvars=[], compact=False, dtype=np.float64, wide=True):
+    # compact=True stores surnames as categoricals and namematch flags as int8; dtype=np.float32 also halves the probabilities (see compact_dtypes.py).
+    # wide=False uses the original long-form reshape of applicants and coapplicants.
+    logger.info("1. Read files in.")
+    with instrumentation.stage('surname_parser.read') as record:
+        input_df = read_input_data(readdir, readfile)
+        if record is not None:
+            record['rows_out'] = input_df.shape[0]
+    logger.info("   Loaded {:,} observations.".format(input_df.shape[0]))
 
-    # Each namematch variable is set to 1 if we matched the given name to the Census file and the name is not a duplicate of a previous name on the application.
-    # If the joint applicants share a name, this name is not providing new information (it is likely a family member), and all additional instances of
-    # the name should be discarded.
+    if not matchvars:
+        input_df = input_df.reset_index()
+        matchvars = ['index']
 
-    match_tagged_data = create_name_match_variables(reshaped_race_probs_by_app)
+    # Load the memory-mapped census surname index
+    census_index = surname_creation_lower.load_surname_index(censusdir)
 
-    # Denominator below should be approximately equal to 1. It is added to reduce rounding errors.
-    final_surname_probs = populate_final_surname_probs(match_tagged_data)
+    final_surname_probs = create_surname_probs(input_df, app_lname, coapp_lname, census_index, matchvars=matchvars, keepvars=keepvars,
+                                               compact=compact, dtype=dtype, wide=wide)
 
-    print(final_surname_probs.head())
+    logger.info(final_surname_probs.head())
 
-    final_surname_probs.to_pickle(os.path.join(output, 'proxy_name.pkl'))
+    with instrumentation.stage('surname_parser.write', rows_in=final_surname_probs.shape[0]):
+        storage.write_table(final_surname_probs, storage.table_file(output, 'proxy_name'))
 
     return final_surname_probs
@@ -0,0 +1,72 @@
+"""
+Fixtures shared by the tests: a census directory prepared from the tract and ZIP code flat files in input_files and a
+small generated surname list, and application data drawn from them.
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'py_scripts'))
+
+import storage
+import surname_creation_lower
+import create_attr_over18_all_geo_entities
+
+
+input_files = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'input_files')
+
+geo_switch = ['tract', 'zip']
+surname_census_match = {'tract': ['GEOID10_Tract'], 'zip': ['zip_sample']}
+
+syllables = ['an', 'bel', 'cor', 'dan', 'el', 'fer', 'gar', 'hol', 'ing', 'jo', 'kel', 'lin', 'mor', 'nu', 'ols', 'per']
+
+
+def surname_list(seed=0):
+    # A surname list in the layout of app_c.csv, whose shares sum to 100 for each name.
+    rng = np.random.RandomState(seed)
+    names = sorted(set(a + b for a in syllables for b in syllables))
+    shares = rng.dirichlet(np.ones(len(surname_creation_lower.class_vars)), len(names)) * 100
+    df = pd.DataFrame(shares, columns=surname_creation_lower.class_vars)
+    df.insert(0, 'name', [name.upper() for name in names])
+    df.insert(1, 'count', rng.randint(100, 100000, len(names)))
+    return df
+
+
+@pytest.fixture(scope='session')
+def censusdir(tmp_path_factory):
+    path = tmp_path_factory.mktemp('census')
+    surname_list().to_csv(str(path / 'app_c.csv'), index=False)
+    surname_creation_lower.create(str(path / 'app_c.csv'), census_surnames_lower_dir=str(path))
+    create_attr_over18_all_geo_entities.create(input_files, str(path), geo_files=geo_switch)
+    return str(path)
+
+
+def draw_applications(censusdir, n, seed=0):
+    # Applications with hyphenated, repeated, unknown and missing surnames, and some geography keys not in the census.
+    rng = np.random.RandomState(seed)
+    names = np.array(surname_list()['name'].tolist() + ['ZZTOP', "O'BRIEN"], dtype=object)
+
+    def draw_names(missing_rate):
+        drawn = names[rng.randint(0, len(names), n)].astype(object)
+        hyphenated = rng.rand(n) < 0.1
+        drawn[hyphenated] = [a + '-' + b for a, b in zip(drawn[hyphenated], names[rng.randint(0, len(names), hyphenated.sum())])]
+        drawn[rng.rand(n) < missing_rate] = None
+        return drawn
+
+    tracts = storage.read_table(storage.find_table(censusdir, 'tract_over18_race_dec10'), columns=['GeoInd'])['GeoInd'].values
+    zips = storage.read_table(storage.find_table(censusdir, 'zip_over18_race_dec10'), columns=['GeoInd'])['GeoInd'].values
+    df = pd.DataFrame({'app_id': np.arange(n) * 3 + 1,
+                       'name1': draw_names(0.1),
+                       'name2': draw_names(0.7),
+                       'GEOID10_Tract': tracts[rng.randint(0, len(tracts), n)].astype(object),
+                       'zip_sample': zips[rng.randint(0, len(zips), n)].astype(object),
+                       'geo_code_precision': rng.choice(['USAStreetAddr', 'USAStreetName', 'USAZIP4', 'USAZipcode', 'Locality'], n)})
+    df.loc[rng.rand(n) < 0.05, 'GEOID10_Tract'] = '99999999999'
+    df.loc[rng.rand(n) < 0.05, 'zip_sample'] = None
+    # The coapplicant repeats the applicant on some applications.
+    repeat = rng.rand(n) < 0.1
+    df.loc[repeat, 'name2'] = df.loc[repeat, 'name1']
+    return df
@@ -0,0 +1,97 @@
+"""
+bisg_qc.py and check_BISG in geo_name_merger_all_entities_over_18.py: on BISG output with and without faults, the
+checks must pass and fail exactly when the per-race loops of the check_BISG they replaced did, and must blank the same
+pr_* values.  The old check_BISG is kept below as the reference, with its .ix assignment written as intended.
+
+Usage:
+
+python -m pytest tests/test_bisg_qc.py
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import bisg_qc
+import geo_name_merger_all_entities_over_18
+
+
+race_list = ['white', 'black', 'aian', 'api', 'mult_other', 'hispanic']
+
+
+def old_check_BISG(df):
+    for race in race_list:
+        # All probabilities should be between 0 and 1.
+        df.loc[df['prtotal'] < 0.99, 'pr_' + race] = np.nan
+        assert (((df['name_pr_' + race] >= 0.0) & (df['name_pr_' + race] <= 1.0)) | (df['name_pr_' + race].isnull())).all()
+        assert (((df['geo_pr_' + race] >= 0.0) & (df['geo_pr_' + race] <= 1.0)) | (df['geo_pr_' + race].isnull())).all()
+        assert (((df['pr_' + race] >= 0.0) & (df['pr_' + race] <= 1.0)) | (df['pr_' + race].isnull())).all()
+
+    # Race probabilities should sum to at least 1.
+    for prob_type in ['name_', 'geo_', '']:
+        check_type = np.sum(df[[prob_type + 'pr_' + var for var in race_list]], axis=1)
+        assert ((check_type == 0) | ((check_type >= 0.99) & (check_type <= 1.01))).all()
+
+    return df
+
+
+def bisg_output(n=500, seed=0):
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame(index=np.arange(n) * 2 + 10)
+    for family in ['name_pr_', 'geo_pr_', 'pr_']:
+        values = rng.dirichlet(np.ones(len(race_list)), n)
+        for i, race in enumerate(race_list):
+            df[family + race] = values[:, i]
+    df['prtotal'] = 1.0
+
+    # Records without a surname, without a geography, and with no BISG probability.
+    df.loc[df.index[:20], ['name_pr_' + race for race in race_list]] = np.nan
+    df.loc[df.index[20:40], ['geo_pr_' + race for race in race_list]] = 0.0
+    df.loc[df.index[40:60], 'prtotal'] = 0.0
+    return df
+
+
+faults = {'none': lambda df: None,
+          'name_range': lambda df: df.__setitem__('name_pr_api', df['name_pr_api'].where(df.index != df.index[100], 1.5)),
+          'geo_negative': lambda df: df.__setitem__('geo_pr_black', df['geo_pr_black'].where(df.index != df.index[200], -0.1)),
+          'pr_sum': lambda df: df.__setitem__('pr_white', df['pr_white'].where(df.index != df.index[300], df['pr_white'] + 0.05)),
+          'geo_sum': lambda df: df.__setitem__('geo_pr_hispanic', df['geo_pr_hispanic'] + np.where(df.index == df.index[400], 0.2, 0.0)),
+          'pr_sum_blanked': lambda df: df.__setitem__('pr_aian', df['pr_aian'].where(df.index != df.index[45], 3.0)),
+          'name_missing_race': lambda df: df.__setitem__('name_pr_white', df['name_pr_white'].where(df.index != df.index[450], np.nan))}
+
+
+@pytest.mark.parametrize('fault', sorted(faults))
+def test_matches_old_check_BISG(fault):
+    df = bisg_output()
+    faults[fault](df)
+
+    try:
+        expected = old_check_BISG(df.copy())
+        old_passed = True
+    except AssertionError:
+        old_passed = False
+
+    assert bisg_qc.check(geo_name_merger_all_entities_over_18.check_BISG(df.copy(), strict=False))['passed'] == old_passed
+    if old_passed:
+        pd.testing.assert_frame_equal(geo_name_merger_all_entities_over_18.check_BISG(df.copy()), expected)
+    else:
+        with pytest.raises(AssertionError):
+            geo_name_merger_all_entities_over_18.check_BISG(df.copy())
+
+
+def test_report():
+    df = bisg_output()
+    faults['name_range'](df)
+    faults['pr_sum'](df)
+    report = bisg_qc.check(df)
+
+    failed = {(result['family'], result['check']): result for result in report['checks'] if result['violations']}
+    assert sorted(failed) == [('name_pr_', 'range'), ('name_pr_', 'sum'), ('pr_', 'sum')]
+    assert failed[('name_pr_', 'range')]['sample_rows'] == [df.index[100]]
+    assert failed[('pr_', 'sum')]['sample_rows'] == [df.index[300]]
+    assert report['records_checked'] == df.shape[0] and not report['sampled']
+
+    sampled = bisg_qc.check(df, sample_size=100)
+    assert sampled['sampled'] and sampled['records_checked'] == 100
+    assert all(result['violations'] <= failed.get((result['family'], result['check']), {'violations': 0})['violations']
+               for result in sampled['checks'])
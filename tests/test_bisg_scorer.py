@@ -0,0 +1,63 @@
+"""
+bisg_scorer.py: a BISGScorer, scoring applications one at a time or in a batch, must give the final pr_* and
+pr_precision of the file-based pipeline (surname_parser.parse, geo_name_merger_all_entities_over_18.create and
+combine_probs.create).
+
+Usage:
+
+python -m pytest tests/test_bisg_scorer.py
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import storage
+import surname_parser
+import geo_name_merger_all_entities_over_18
+import combine_probs
+import bisg_scorer
+
+from conftest import geo_switch, surname_census_match, draw_applications
+
+
+pr_vars = ['pr_' + race for race in combine_probs.race_list]
+
+
+@pytest.fixture(scope='module')
+def pipeline(tmp_path_factory, censusdir):
+    path = str(tmp_path_factory.mktemp('scorer'))
+    apps = draw_applications(censusdir, 2000, seed=1)
+    storage.write_table(apps, storage.table_file(path, 'apps'))
+
+    surname_parser.parse('name1', 'name2', path, path, 'apps.parquet', censusdir, matchvars=['app_id'])
+    geo_name_merger_all_entities_over_18.create(path, path, 'apps.parquet', path, 'proxy_name.parquet', censusdir, geo_switch,
+                                                orig_surname_match=['app_id'], surname_census_match=surname_census_match)
+    final = combine_probs.create(path, path, 'apps_BISG.parquet', 'geo_code_precision', matchvars=['app_id'])
+
+    final = apps[['app_id']].merge(final, how='left', on='app_id')
+    final['pr_precision'] = final['pr_precision'].cat.codes + 1
+    return apps, final
+
+
+def test_score_batch(censusdir, pipeline):
+    apps, final = pipeline
+    scorer = bisg_scorer.BISGScorer(censusdir, geo_switch=geo_switch)
+    scores = scorer.score_batch(apps['name1'], apps['name2'],
+                                {'tract': apps['GEOID10_Tract'].values, 'zip': apps['zip_sample'].values}, apps['geo_code_precision'].values)
+
+    assert list(scores['pr_precision']) == list(final['pr_precision'])
+    np.testing.assert_allclose(scores[pr_vars].values, final[pr_vars].values.astype(np.float64), rtol=1e-12)
+
+
+def test_score(censusdir, pipeline):
+    apps, final = pipeline
+    scorer = bisg_scorer.BISGScorer(censusdir, geo_switch=geo_switch)
+    for i in range(0, apps.shape[0], 7):
+        app = apps.iloc[i]
+        geoid = {'tract': app['GEOID10_Tract'], 'zip': app['zip_sample']}
+        score = scorer.score(app['name1'], app['name2'] if isinstance(app['name2'], str) else None, geoid, app['geo_code_precision'])
+
+        assert score['pr_precision'] == final['pr_precision'].iloc[i], i
+        np.testing.assert_allclose([score[var] for var in pr_vars], final[pr_vars].iloc[i].values.astype(np.float64), rtol=1e-12,
+                                   err_msg=str(i))
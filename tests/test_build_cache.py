@@ -0,0 +1,139 @@
+"""
+build_cache.py: a table is current only for the key it was built with and only once it is complete, and a stale lock
+is taken over by exactly one of the jobs waiting on it.
+
+Usage:
+
+python -m pytest tests/test_build_cache.py
+"""
+
+import os
+import json
+import time
+import threading
+import pandas as pd
+import pytest
+
+import storage
+import build_cache
+
+
+def table():
+    return pd.DataFrame({'GeoInd': ['a', 'b', 'c'], 'geo_pr_white': [0.1, 0.5, 0.9]})
+
+
+def test_current_for_its_own_key(tmp_path):
+    path = str(tmp_path / 'geo.parquet')
+    assert not build_cache.is_current(path, 'k1')
+
+    build_cache.write_table(table(), path, 'k1')
+    assert build_cache.is_current(path, 'k1')
+    assert not build_cache.is_current(path, 'k2')
+    pd.testing.assert_frame_equal(storage.read_table(path), table())
+
+    os.remove(path)
+    assert not build_cache.is_current(path, 'k1')
+
+
+def test_key_changes_with_sources_code_and_params(tmp_path):
+    source, code = tmp_path / 'source.csv', tmp_path / 'code.py'
+    source.write_text('a,b\n1,2\n')
+    code.write_text('x = 1\n')
+    key = build_cache.cache_key([str(source)], str(code), {'geo': 'tract'})
+
+    assert build_cache.cache_key([str(source)], str(code), {'geo': 'tract'}) == key
+    assert build_cache.cache_key([str(source)], str(code), {'geo': 'zip'}) != key
+    code.write_text('x = 2\n')
+    assert build_cache.cache_key([str(source)], str(code), {'geo': 'tract'}) != key
+
+
+def test_manifest_written_after_table(tmp_path, monkeypatch):
+    path = str(tmp_path / 'geo.parquet')
+    build_cache.write_table(table(), path, 'k1')
+
+    def fail(df, tmp, **kwargs):
+        with open(tmp, 'w') as f:
+            f.write('partial')
+        raise IOError('disk full')
+
+    # A rebuild that fails part way leaves the old table and manifest in place and no temporary file behind.
+    monkeypatch.setattr(storage, 'write_table', fail)
+    with pytest.raises(IOError):
+        build_cache.write_table(table().iloc[:1], path, 'k2')
+
+    assert build_cache.is_current(path, 'k1')
+    assert not build_cache.is_current(path, 'k2')
+    assert sorted(os.listdir(str(tmp_path))) == ['geo.cache.json', 'geo.parquet']
+    with open(build_cache.manifest_file(path)) as f:
+        assert json.load(f) == {'key': 'k1', 'file': 'geo.parquet'}
+
+
+def test_index_current_only_for_its_table(tmp_path):
+    path = str(tmp_path / 'geo.parquet')
+    index_files = [str(tmp_path / 'geo_keys.npy'), str(tmp_path / 'geo_values.npy')]
+    build_cache.write_table(table(), path, 'k1')
+    assert not build_cache.index_current(index_files, path)
+
+    build_cache.write_index(list(zip(index_files, [table()['GeoInd'].values.astype(str), table()[['geo_pr_white']].values])), path)
+    assert build_cache.index_current(index_files, path)
+
+    # A rebuilt table leaves the index of the old one behind until the index is written again.
+    build_cache.write_table(table(), path, 'k2')
+    assert not build_cache.index_current(index_files, path)
+
+    build_cache.write_index(list(zip(index_files, [table()['GeoInd'].values.astype(str), table()[['geo_pr_white']].values])), path)
+    os.remove(index_files[1])
+    assert not build_cache.index_current(index_files, path)
+
+
+def test_lock_released(tmp_path):
+    path = str(tmp_path / 'geo.parquet')
+    with build_cache.lock(path):
+        assert os.path.isfile(path + '.lock')
+    assert not os.path.exists(path + '.lock')
+
+
+def test_stale_lock_taken_over_by_one_job(tmp_path, monkeypatch):
+    path = str(tmp_path / 'geo.parquet')
+    lock_file = path + '.lock'
+    with open(lock_file, 'w') as f:
+        f.write('0')
+    os.utime(lock_file, (time.time() - 120, time.time() - 120))
+
+    # Every job finds the lock stale before any of them takes it over.
+    getmtime = os.path.getmtime
+
+    def slow_getmtime(name):
+        mtime = getmtime(name)
+        if name == lock_file:
+            time.sleep(0.05)
+        return mtime
+
+    monkeypatch.setattr(os.path, 'getmtime', slow_getmtime)
+
+    holders, most = [0], [0]
+    guard = threading.Lock()
+
+    def job():
+        with build_cache.lock(path, timeout=60, poll=0.01):
+            with guard:
+                holders[0] += 1
+                most[0] = max(most[0], holders[0])
+            time.sleep(0.05)
+            with guard:
+                holders[0] -= 1
+
+    jobs = [threading.Thread(target=job) for _ in range(8)]
+    for thread in jobs:
+        thread.start()
+    for thread in jobs:
+        thread.join()
+
+    assert most[0] == 1
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_missing_directory_raises(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        with build_cache.lock(str(tmp_path / 'missing' / 'geo.parquet')):
+            pass
@@ -0,0 +1,78 @@
+"""
+Prepared geography tables: the memory-mapped .npy index of a table is used only while it was made from that table, and
+the tables of a vintage are loaded and joined under that vintage's geography key names.
+
+Usage:
+
+python -m pytest tests/test_census_registry.py
+"""
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+import storage
+import build_cache
+import census_registry
+import surname_parser
+import create_attr_over18_all_geo_entities
+import geo_name_merger_all_entities_over_18
+
+from conftest import geo_switch, surname_census_match, draw_applications
+
+
+def copy_census(censusdir, path):
+    for f in os.listdir(censusdir):
+        if f.startswith('tract_over18_race_dec10'):
+            shutil.copy(os.path.join(censusdir, f), str(path))
+    return str(path)
+
+
+def test_stale_geography_index_not_used(tmp_path, censusdir):
+    censusdir = copy_census(censusdir, tmp_path)
+    table_path = storage.find_table(censusdir, 'tract_over18_race_dec10')
+    table = storage.read_table(table_path)
+    assert create_attr_over18_all_geo_entities.load_geo_index(censusdir, 'tract_over18_race_dec10') is not None
+
+    # A table rebuilt without its index, as when a build stops between the two.
+    rebuilt = table.copy()
+    rebuilt['geo_pr_white'] = 1 - rebuilt['geo_pr_white']
+    build_cache.write_table(rebuilt, table_path, 'rebuilt')
+    assert create_attr_over18_all_geo_entities.load_geo_index(censusdir, 'tract_over18_race_dec10') is None
+
+    loaded = census_registry.load_geography(censusdir, 'tract', 'GEOID10_Tract')
+    np.testing.assert_array_equal(loaded['geo_pr_white'].values, rebuilt['geo_pr_white'].values)
+
+    create_attr_over18_all_geo_entities.write_geo_index(rebuilt, table_path)
+    loaded = create_attr_over18_all_geo_entities.load_geo_index(censusdir, 'tract_over18_race_dec10')
+    np.testing.assert_array_equal(loaded['geo_pr_white'].values, rebuilt['geo_pr_white'].values)
+
+
+def test_vintage_key_names(tmp_path, censusdir, monkeypatch):
+    # The dec10 tables registered again under other key names.
+    monkeypatch.setitem(census_registry.vintages, 'renamed', {'file_stem': census_registry.file_stem('dec10'),
+                                                              'geo_keys': {'blkgrp': 'BG_ID', 'tract': 'TRACT_ID', 'zip': 'ZIP_ID'},
+                                                              'state_var': 'State_FIPS10'})
+
+    census_dfs = geo_name_merger_all_entities_over_18.load_census_files(censusdir, geo_switch, vintage='renamed')
+    assert 'TRACT_ID' in list(census_dfs['tract']) and 'ZIP_ID' in list(census_dfs['zip'])
+
+    storage.write_table(draw_applications(censusdir, 500), str(tmp_path / 'apps.parquet'))
+    surname_parser.parse('name1', 'name2', str(tmp_path), str(tmp_path), 'apps.parquet', censusdir, matchvars=['app_id'])
+
+    def create(vintage, geo_switch, memo):
+        output = tmp_path / '{}_{}_{}'.format(vintage, len(geo_switch), memo)
+        output.mkdir()
+        geo_name_merger_all_entities_over_18.create(str(output), str(tmp_path), 'apps.parquet', str(tmp_path), 'proxy_name.parquet',
+                                                    censusdir, geo_switch, orig_surname_match=['app_id'],
+                                                    surname_census_match=surname_census_match, memo=memo, vintage=vintage)
+        return storage.read_table(storage.table_file(str(output), 'apps_BISG'))
+
+    for switch in [geo_switch, ['tract']]:
+        for memo in [False, True]:
+            expected = create('dec10', switch, memo)
+            renamed = create('renamed', switch, memo)
+            pr_vars = [var for var in list(expected) if '_pr_' in var and not var.startswith('name_')]
+            assert pr_vars
+            pd.testing.assert_frame_equal(renamed[pr_vars], expected[pr_vars])
@@ -0,0 +1,65 @@
+"""
+Regression test for combine_probs.py: create, run on the per-geography proxies of test_output/test_proxied_final.csv
+(the output of combine_probs.do for the fictitious sample), must choose the same pr_precision and pr_* as the Stata
+code, and must treat a geography left out of the BISG file as unavailable.
+
+Usage:
+
+python -m pytest tests/test_combine_probs.py
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'py_scripts'))
+
+import storage
+import combine_probs
+
+
+test_output = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_output')
+
+pr_vars = ['pr_' + race for race in combine_probs.race_list]
+
+
+def stata_output():
+    return pd.read_csv(os.path.join(test_output, 'test_proxied_final.csv'))
+
+
+def run_create(tmp_path, bisg):
+    storage.write_table(bisg, str(tmp_path / 'sample_BISG.parquet'))
+    return combine_probs.create(str(tmp_path), str(tmp_path), 'sample_BISG.parquet', 'geo_code_precision', matchvars=['rownum'])
+
+
+def bisg_input(expected, prefixes=combine_probs.geo_prefixes):
+    # The proxies combine_probs starts from: everything but the final pr_precision and pr_* it chooses.
+    keep = ['rownum', 'geo_code_precision'] + [var for var in list(expected)
+                                               if var.startswith('name_pr_') or any(var.startswith(prefix) for prefix in prefixes)]
+    return expected[keep].copy()
+
+
+def test_matches_stata_output(tmp_path):
+    expected = stata_output()
+    result = run_create(tmp_path, bisg_input(expected))
+
+    assert list(result['pr_precision'].astype(str)) == list(expected['pr_precision'])
+    np.testing.assert_allclose(result[pr_vars].values, expected[pr_vars].values, atol=1e-8)
+
+
+def test_missing_geographies_are_unavailable(tmp_path):
+    expected = stata_output()
+    rooftop = (expected['geo_code_precision'] == 'USAStreetAddr').values
+
+    # Without block groups, rooftop records fall back to tracts.
+    result = run_create(tmp_path, bisg_input(expected, ['tract18_', 'zip18_']))
+    assert (result['pr_precision'].astype(str)[rooftop] == combine_probs.precision_labels[4]).all()
+    np.testing.assert_allclose(result[pr_vars].values[rooftop], expected[['tract18_' + var for var in pr_vars]].values[rooftop])
+    assert not any(var.startswith('blkgrp18_') for var in list(result))
+
+    # With ZIP codes alone, every record uses them.
+    result = run_create(tmp_path, bisg_input(expected, ['zip18_']))
+    assert (result['pr_precision'].astype(str)[rooftop] == combine_probs.precision_labels[5]).all()
+    assert (result['pr_precision'].astype(str)[~rooftop] == combine_probs.precision_labels[2]).all()
+    np.testing.assert_allclose(result[pr_vars].values, expected[['zip18_' + var for var in pr_vars]].values)
@@ -0,0 +1,105 @@
+"""
+incremental_proxy.py: after applications are edited, added and removed, the store updated by an incremental run must
+hold the same records and proxies as a store built from scratch on the new data, and only the new and changed
+applications must be recomputed.
+
+Usage:
+
+python -m pytest tests/test_incremental_proxy.py
+"""
+
+import numpy as np
+import pandas as pd
+
+import storage
+import instrumentation
+import incremental_proxy
+
+from conftest import geo_switch, surname_census_match, draw_applications
+
+
+def run(output, readdir, censusdir, partitions=8):
+    return incremental_proxy.create('name1', 'name2', output, readdir, 'apps.parquet', censusdir, geo_switch, surname_census_match,
+                                    ['app_id'], geoprecvar='geo_code_precision', partitions=partitions, chunksize=300)
+
+
+def by_record(store):
+    return incremental_proxy.read_store(store).sort_values('app_id').reset_index(drop=True)
+
+
+def edit(apps, censusdir):
+    # Surnames, geographies and precisions changed on some applications, some applications removed and others added.
+    rng = np.random.RandomState(5)
+    apps = apps.copy()
+    edited = rng.choice(apps.shape[0], 90, replace=False)
+    other = draw_applications(censusdir, 90, seed=6)
+    for i, var in enumerate(['name1', 'name2', 'GEOID10_Tract', 'zip_sample', 'geo_code_precision']):
+        rows = edited[i * 18:(i + 1) * 18]
+        apps.iloc[rows, apps.columns.get_loc(var)] = other[var].values[:18]
+
+    removed = rng.choice(apps.shape[0], 40, replace=False)
+    added = draw_applications(censusdir, 60, seed=7)
+    added['app_id'] = added['app_id'] + 10 ** 6
+    return pd.concat([apps.drop(apps.index[removed]), added], ignore_index=True), removed, added
+
+
+def test_update_equals_rebuild(tmp_path, censusdir):
+    apps = draw_applications(censusdir, 1500, seed=4)
+    storage.write_table(apps, str(tmp_path / 'apps.parquet'))
+    (tmp_path / 'incremental').mkdir()
+    run(str(tmp_path / 'incremental'), str(tmp_path), censusdir)
+
+    new_apps, removed, added = edit(apps, censusdir)
+    storage.write_table(new_apps, str(tmp_path / 'apps.parquet'))
+
+    records = []
+    sink = instrumentation.add_sink(records.append)
+    try:
+        store = run(str(tmp_path / 'incremental'), str(tmp_path), censusdir)
+    finally:
+        instrumentation.remove_sink(sink)
+
+    # An edit can leave an application as it was, when the new value happens to equal the old one, so the changed
+    # applications are those whose proxy inputs differ.
+    fp_vars = incremental_proxy.fingerprint_vars('name1', 'name2', geo_switch, surname_census_match, geoprecvar='geo_code_precision')
+    old = pd.Series(incremental_proxy.fingerprint(apps, fp_vars), index=apps['app_id'].values)
+    new = pd.Series(incremental_proxy.fingerprint(new_apps, fp_vars), index=new_apps['app_id'].values)
+    kept = new.index.intersection(old.index)
+    n_changed = int((new[kept] != old[kept]).sum())
+    assert n_changed > 50
+
+    compare = [record for record in records if record['stage'] == 'incremental_proxy.compare'][0]
+    assert compare['rows_out'] == n_changed + added.shape[0]
+    assert compare['removed'] == removed.shape[0]
+
+    (tmp_path / 'rebuilt').mkdir()
+    rebuilt = by_record(run(str(tmp_path / 'rebuilt'), str(tmp_path), censusdir))
+    updated = by_record(store)
+
+    assert list(updated['app_id']) == sorted(new_apps['app_id'])
+    assert list(updated) == list(rebuilt)
+    for var in list(rebuilt):
+        if rebuilt[var].dtype.kind == 'f':
+            np.testing.assert_allclose(updated[var].values, rebuilt[var].values, rtol=1e-12, err_msg=var)
+        else:
+            assert list(updated[var].astype(str)) == list(rebuilt[var].astype(str)), var
+
+    # A run with nothing changed recomputes nothing.
+    records = []
+    sink = instrumentation.add_sink(records.append)
+    try:
+        run(str(tmp_path / 'incremental'), str(tmp_path), censusdir)
+    finally:
+        instrumentation.remove_sink(sink)
+    assert [record['rows_out'] for record in records if record['stage'] == 'incremental_proxy.compare'] == [0]
+
+
+def test_new_arguments_rebuild(tmp_path, censusdir):
+    apps = draw_applications(censusdir, 500, seed=8)
+    storage.write_table(apps, str(tmp_path / 'apps.parquet'))
+    store = run(str(tmp_path), str(tmp_path), censusdir, partitions=4)
+    assert len(incremental_proxy.partition_files(store)) == 4
+
+    store = run(str(tmp_path), str(tmp_path), censusdir, partitions=6)
+    assert len(incremental_proxy.partition_files(store)) == 6
+    assert sorted(incremental_proxy.read_store(store)['app_id']) == sorted(apps['app_id'])
@@ -0,0 +1,74 @@
+"""
+The batch (surname_parser.parse then geo_name_merger_all_entities_over_18.create), streaming (stream_proxy.py) and
+parallel (parallel_proxy.py) paths must give every application the same surname and BISG probabilities, on data where
+some applicants have no surname, with and without a record identifier.
+
+Usage:
+
+python -m pytest tests/test_proxy_paths.py
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+import storage
+import surname_parser
+import geo_name_merger_all_entities_over_18
+import stream_proxy
+import parallel_proxy
+
+from conftest import geo_switch, surname_census_match, draw_applications
+
+
+races = ['white', 'black', 'aian', 'api', 'mult_other', 'hispanic']
+compare_vars = ['name_pr_' + race for race in races] + \
+    [geo_type + '18_' + var + race for geo_type in geo_switch for var in ['pr_', 'geo_pr_'] for race in races] + \
+    [geo_type + '18_geo_matched' for geo_type in geo_switch]
+
+
+def batch_path(readdir, output, censusdir, matchvars):
+    surname_parser.parse('name1', 'name2', output, readdir, 'apps.parquet', censusdir, matchvars=matchvars)
+    return geo_name_merger_all_entities_over_18.create(output, readdir, 'apps.parquet', output, 'proxy_name.parquet', censusdir, geo_switch,
+                                                       orig_surname_match=matchvars, surname_census_match=surname_census_match)
+
+
+def stream_path(readdir, output, censusdir, matchvars):
+    out_file = stream_proxy.create('name1', 'name2', output, readdir, 'apps.parquet', censusdir, geo_switch, surname_census_match,
+                                   chunksize=700, matchvars=matchvars)
+    return pd.read_csv(out_file, dtype={'GEOID10_Tract': str, 'zip_sample': str})
+
+
+def parallel_path(readdir, output, censusdir, matchvars):
+    return parallel_proxy.create('name1', 'name2', output, readdir, 'apps.parquet', censusdir, geo_switch, surname_census_match,
+                                 processes=2, shards=5, matchvars=matchvars)
+
+
+def by_record(df, key):
+    return df.sort_values(key).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('matchvars', [[], ['app_id']])
+def test_paths_agree(tmp_path, censusdir, matchvars):
+    apps = draw_applications(censusdir, 3000)
+    assert apps['name1'].isnull().any()
+    storage.write_table(apps, str(tmp_path / 'apps.parquet'))
+
+    key = matchvars or ['index']
+    results = {}
+    for name, path in [('batch', batch_path), ('stream', stream_path), ('parallel', parallel_path)]:
+        output = tmp_path / name
+        output.mkdir()
+        results[name] = by_record(path(str(tmp_path), str(output), censusdir, matchvars), key)
+        assert results[name].shape[0] == apps.shape[0]
+
+    # Each record keeps its own geography and precision.
+    expected = by_record(apps.reset_index() if not matchvars else apps, key)
+    for name, df in results.items():
+        for var in ['GEOID10_Tract', 'geo_code_precision']:
+            assert list(df[var].astype(str)) == list(expected[var].astype(str)), (name, var)
+
+    for name in ['stream', 'parallel']:
+        np.testing.assert_allclose(results[name][compare_vars].values.astype(np.float64),
+                                   results['batch'][compare_vars].values.astype(np.float64), rtol=1e-12, err_msg=name)
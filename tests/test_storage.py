@@ -0,0 +1,93 @@
+"""
+storage.py: every format gives back the table it was given, filters pick the same rows in every format, and tables
+read in chunks or row ranges put together give the whole table.
+
+Usage:
+
+python -m pytest tests/test_storage.py
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+import storage
+
+
+exts = ['.parquet', '.feather', '.pkl', '.csv']
+
+
+def table(n=1000):
+    rng = np.random.RandomState(0)
+    return pd.DataFrame({'GeoInd': ['{:011d}'.format(i) for i in rng.randint(0, 10 ** 9, n)],
+                         'state': rng.choice(['01', '06', '36', '72'], n),
+                         'count': rng.randint(0, 5000, n).astype(np.int64),
+                         'geo_pr_white': rng.rand(n)})
+
+
+def read_back(path):
+    # .csv files do not keep column types; the string columns are read as strings, as the pipeline does.
+    if storage.get_format(path) == 'csv':
+        return pd.read_csv(path, dtype={'GeoInd': str, 'state': str})
+    return storage.read_table(path)
+
+
+@pytest.mark.parametrize('ext', exts)
+def test_round_trip(tmp_path, ext):
+    path = storage.write_table(table(), str(tmp_path / ('geo' + ext)))
+    pd.testing.assert_frame_equal(read_back(path).reset_index(drop=True), table(), check_dtype=ext != '.csv')
+
+
+@pytest.mark.parametrize('ext', ['.parquet', '.feather', '.pkl'])
+def test_filters(tmp_path, ext):
+    df = table()
+    path = storage.write_table(df, storage.table_file(str(tmp_path), 'geo', ext), **({'row_group_size': 97} if ext == '.parquet' else {}))
+    keys = list(df['GeoInd'].iloc[::7])
+
+    for filters, expected in [([('state', '!=', '72')], df['state'] != '72'),
+                              ([('GeoInd', 'in', keys)], df['GeoInd'].isin(keys)),
+                              ([('GeoInd', 'not in', keys), ('count', '>=', 2500)], ~df['GeoInd'].isin(keys) & (df['count'] >= 2500)),
+                              ([('geo_pr_white', '<', 0.5), ('count', '<=', 100)], (df['geo_pr_white'] < 0.5) & (df['count'] <= 100))]:
+        filtered = storage.read_table(path, columns=['GeoInd', 'count'], filters=filters)
+        pd.testing.assert_frame_equal(filtered.reset_index(drop=True), df.loc[expected, ['GeoInd', 'count']].reset_index(drop=True))
+
+
+def test_find_table(tmp_path):
+    directory = str(tmp_path)
+    assert storage.find_table(directory, 'geo') is None
+
+    pkl = storage.write_table(table(), storage.table_file(directory, 'geo', '.pkl'))
+    assert storage.find_table(directory, 'geo') == pkl
+    assert storage.resolve_table(storage.table_file(directory, 'geo', '.parquet')) == pkl
+
+    parquet = storage.write_table(table(), storage.table_file(directory, 'geo'))
+    assert storage.find_table(directory, 'geo') == parquet
+
+    with pytest.raises(ValueError):
+        storage.get_format(os.path.join(directory, 'geo.xlsx'))
+
+
+@pytest.mark.parametrize('ext', exts)
+def test_chunks_and_row_ranges(tmp_path, ext):
+    df = table()
+    path = storage.write_table(df, storage.table_file(str(tmp_path), 'geo', ext), **({'row_group_size': 97} if ext == '.parquet' else {}))
+    assert storage.count_rows(path) == df.shape[0]
+
+    chunks = list(storage.iter_table(path, 128))
+    assert [chunk.shape[0] for chunk in chunks] == [128] * 7 + [104]
+    for start, stop in [(0, 1000), (0, 1), (96, 98), (97, 194), (450, 1000), (999, 1000), (500, 500)]:
+        rows = storage.read_rows(path, start, stop)
+        assert list(rows.index) == list(range(start, stop))
+        assert list(rows['count']) == list(df['count'].iloc[start:stop])
+
+    assert list(pd.concat(chunks)['count']) == list(df['count'])
+    assert list(pd.concat(chunks).index) == list(range(df.shape[0]))
+
+
+@pytest.mark.parametrize('ext', exts)
+def test_write_table_chunks(tmp_path, ext):
+    df = table()
+    path = storage.write_table_chunks((df.iloc[start:start + 300] for start in range(0, df.shape[0], 300)),
+                                      storage.table_file(str(tmp_path), 'geo', ext))
+    pd.testing.assert_frame_equal(read_back(path).reset_index(drop=True), df, check_dtype=ext != '.csv')